@@ -0,0 +1,218 @@
+"""
+Delta/sparse wire encoding of the metric documents.
+
+Most of a report does not change from one tick to the next (memory and disk
+totals, location, store...). In delta mode a reporter sends a full document
+(a keyframe) every `keyframe_every` reports, and in between only the fields
+that changed by more than `epsilon` (relative) since the values the receiver
+holds:
+
+    keyframe: {"_seq": 40, "_kf": 1, ...the full document...}
+    delta:    {"_seq": 41, "_d": {"cpu": 12.5, "mem.virtual.free": 1234}, "_x": ["samples"]}
+
+"_d" maps the dotted paths of the changed fields (list items by index) to
+their new values (the document keys have no dots), "_x" lists the removed
+ones. A list that changed length and a new key are sent whole. The decoder
+rebuilds the full documents and drops the deltas following a gap in the
+sequence numbers until the next keyframe.
+
+The reporters encode their documents before queueing them, so the stream
+must reach one decoder whole and in order: a spool replaying old messages
+between the live ones (spoolDir, overflow = spill, see send_queue.py), or
+messages spread over several collectors, would make the decoder drop them,
+and the agent refuses these combinations.
+
+Usage:
+    python delta_encoding.py decode < syslog.log   prints the full documents
+    python delta_encoding.py bench [reports]       compares the payload sizes
+"""
+
+import json
+import random
+import sys
+
+from syslog_transport import SYSLOG_LINE
+
+
+KEYFRAME_EVERY = 10
+EPSILON = 0.0
+SEQ = "_seq"
+KEYFRAME = "_kf"
+CHANGED = "_d"
+REMOVED = "_x"
+
+
+def _number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def diff(old, new, epsilon, path, changed, removed):
+    "Fill `changed` and `removed` with what turns `old` into `new`."
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.iteritems():
+            if key in old:
+                diff(old[key], value, epsilon, path + (key,), changed, removed)
+            else:
+                changed[".".join(path + (key,))] = value
+        for key in old:
+            if key not in new:
+                removed.append(".".join(path + (key,)))
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for idx, value in enumerate(new):
+            diff(old[idx], value, epsilon, path + (str(idx),), changed, removed)
+    elif _number(old) and _number(new):
+        if abs(new - old) > epsilon * abs(old) or (old == 0 and new != 0):
+            changed[".".join(path)] = new
+    elif old != new or isinstance(old, bool) != isinstance(new, bool):
+        changed[".".join(path)] = new
+
+
+def _container(doc, segments):
+    for segment in segments:
+        doc = doc[int(segment)] if isinstance(doc, list) else doc[segment]
+    return doc
+
+
+def apply_delta(doc, changed, removed):
+    "Apply a delta to the full document `doc`, in place."
+    for path in removed:
+        segments = path.split(".")
+        del _container(doc, segments[:-1])[segments[-1]]
+    for path, value in changed.iteritems():
+        segments = path.split(".")
+        container = _container(doc, segments[:-1])
+        if isinstance(container, list):
+            container[int(segments[-1])] = value
+        else:
+            container[segments[-1]] = value
+    return doc
+
+
+"""
+    DeltaEncoder turns the documents of one reporter into keyframes and
+    deltas. It diffs against what the receiver holds, so small changes
+    below epsilon never add up to a drift.
+"""
+class DeltaEncoder():
+    def __init__(self, keyframe_every=KEYFRAME_EVERY, epsilon=EPSILON):
+        self.keyframe_every = max(1, keyframe_every)
+        self.epsilon = epsilon
+        self.seq = 0
+        self.reference = None
+
+    def encode(self, doc):
+        self.seq += 1
+        if self.reference is None or self.seq % self.keyframe_every == 0 or not isinstance(doc, dict):
+            # the document is serialized right after, the reference is a copy
+            self.reference = json.loads(json.dumps(doc))
+            keyframe = dict(doc)
+            keyframe[SEQ] = self.seq
+            keyframe[KEYFRAME] = 1
+            return keyframe
+        changed = {}
+        removed = []
+        diff(self.reference, doc, self.epsilon, (), changed, removed)
+        apply_delta(self.reference, json.loads(json.dumps(changed)), removed)
+        delta = {SEQ: self.seq, CHANGED: changed}
+        if removed:
+            delta[REMOVED] = removed
+        return delta
+
+
+"""
+    DeltaDecoder rebuilds the full documents of one stream of keyframes and
+    deltas.
+"""
+class DeltaDecoder():
+    def __init__(self):
+        self.doc = None
+        self.seq = None
+        self.lost = 0
+        self.decoded = 0
+
+    def decode(self, message):
+        "The full document, None while waiting for a keyframe after a gap."
+        if SEQ not in message:
+            # not delta-encoded
+            return message
+        seq = message[SEQ]
+        if message.get(KEYFRAME):
+            if self.seq is not None and seq > self.seq + 1:
+                self.lost += seq - self.seq - 1
+            self.doc = dict((key, value) for key, value in message.iteritems() if key not in (SEQ, KEYFRAME))
+        else:
+            if self.doc is None or seq != self.seq + 1:
+                if self.seq is not None and seq > self.seq:
+                    self.lost += seq - self.seq - 1
+                self.seq = seq
+                self.doc = None
+                return None
+            apply_delta(self.doc, message[CHANGED], message.get(REMOVED, []))
+        self.seq = seq
+        self.decoded += 1
+        return json.loads(json.dumps(self.doc))
+
+
+def decode_stream(lines, out):
+    "Decode syslog lines (or bare JSON documents), one decoder per host and tag."
+    decoders = {}
+    for line in lines:
+        line = line.rstrip("\r\n\0")
+        match = SYSLOG_LINE.match(line)
+        key, payload = ((match.group(2), match.group(3)), match.group(4)) if match else (None, line)
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            continue
+        decoder = decoders.setdefault(key, DeltaDecoder())
+        doc = decoder.decode(message)
+        if doc is not None:
+            out.write(json.dumps(doc) + "\n")
+    return decoders
+
+
+def bench(reports):
+    "Payload bytes of the full documents and of the delta encoding, for system-like reports."
+    doc = {
+        "cpu": 10.0, "cpu_times": dict((field, 1.0) for field in ["user", "system", "idle", "nice", "irq", "softirq", "iowait", "steal"]),
+        "mem": {"virtual": {"total": 8 << 30, "available": 4 << 30, "used": 3 << 30, "free": 1 << 30, "percent": 50.0},
+                "swap": {"total": 2 << 30, "used": 0, "free": 2 << 30, "percent": 0.0}},
+        "disks": [{"name": name, "path": path, "total": 100 << 30, "used": 40 << 30, "free": 60 << 30, "percent": 40.0}
+                  for name, path in [("root", "/"), ("opt", "/opt"), ("tmp", "/tmp")]],
+        "networks": [{"name": "eth0", "bytes_sent": 0, "bytes_recv": 0, "packets_sent": 0, "packets_recv": 0}],
+        "processes": 120, "location": "38.9828591,-4.002638", "province": "CR", "city": "CiudadReal", "store": "Olivo",
+    }
+    full_bytes = 0
+    for epsilon in [0.0, 0.01]:
+        encoder = DeltaEncoder(KEYFRAME_EVERY, epsilon)
+        decoder = DeltaDecoder()
+        delta_bytes = 0
+        full_bytes = 0
+        rand = random.Random(1)
+        for _ in xrange(reports):
+            doc["cpu"] = round(rand.uniform(5, 30), 1)
+            doc["cpu_times"]["user"] = round(rand.uniform(1, 20), 1)
+            doc["cpu_times"]["idle"] = round(100 - doc["cpu_times"]["user"], 1)
+            doc["mem"]["virtual"]["free"] += rand.randint(-1 << 20, 1 << 20)
+            doc["processes"] = 120 + rand.randint(-2, 2)
+            for net in doc["networks"]:
+                for field in ["bytes_sent", "bytes_recv", "packets_sent", "packets_recv"]:
+                    net[field] = rand.randint(1000, 100000)
+            full = json.dumps(doc)
+            full_bytes += len(full)
+            encoded = json.dumps(encoder.encode(doc), separators=(",", ":"))
+            delta_bytes += len(encoded)
+            decoded = decoder.decode(json.loads(encoded))
+            if epsilon == 0:
+                assert decoded == json.loads(full)
+        print "epsilon {:<5} full {:>8} bytes, delta {:>8} bytes ({:.0f}% saved)".format(
+            epsilon, full_bytes, delta_bytes, 100 - delta_bytes * 100.0 / full_bytes)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "decode":
+        decode_stream(sys.stdin, sys.stdout)
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+    else:
+        print __doc__
@@ -0,0 +1,123 @@
+"""
+Device discovery for the monitoring agent.
+
+SystemReporter used to report one hard-coded network interface and disk
+(enp0s25, sda6) and exactly three configured paths. Discovery selects the
+network interfaces, disks and mountpoints to report with include/exclude
+patterns from the config: shell globs ("eth*", "sd?"), or regular
+expressions when prefixed with "re:" ("re:^nvme\d+n\d+$").
+
+Selections are cached: a tick only checks that the collector returned the
+same device names as the previous one, and the patterns run again when a
+device appears or disappears.
+"""
+
+import fnmatch
+import re
+
+
+REGEX_PREFIX = "re:"
+DEFAULT_EXCLUDE_INTERFACES = ["lo"]
+DEFAULT_EXCLUDE_DISKS = ["loop*", "ram*", "zram*"]
+
+
+def parse_patterns(value):
+    "A comma-separated config value as a list of patterns."
+    return [pattern.strip() for pattern in (value or "").split(",") if pattern.strip()]
+
+
+def compile_patterns(patterns):
+    "One regex matching any of the glob or re: patterns, None when there is none."
+    regexes = []
+    for pattern in patterns:
+        if pattern.startswith(REGEX_PREFIX):
+            regexes.append("(?:{})".format(pattern[len(REGEX_PREFIX):]))
+        else:
+            regexes.append("(?:{})".format(fnmatch.translate(pattern)))
+    if not regexes:
+        return None
+    return re.compile("|".join(regexes))
+
+
+"""
+    Patterns tells if a device name is selected: it matches one of the
+    include patterns (any name when there is none) and none of the exclude
+    ones.
+"""
+class Patterns():
+    def __init__(self, include=None, exclude=None):
+        self.include = compile_patterns(include or [])
+        self.exclude = compile_patterns(exclude or [])
+
+    def matches(self, name):
+        if self.include is not None and not self.include.match(name):
+            return False
+        return self.exclude is None or not self.exclude.match(name)
+
+
+"""
+    DeviceSelector keeps the names selected by its patterns among the last
+    names it was given. select() returns the same list object as long as the
+    names do not change, so callers can tell a new selection with `is`.
+"""
+class DeviceSelector():
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.names = None
+        self.selected = []
+        self.changes = 0
+
+    def select(self, names):
+        names = frozenset(names)
+        if names != self.names:
+            self.names = names
+            self.selected = sorted(name for name in names if self.patterns.matches(name))
+            self.changes += 1
+        return self.selected
+
+
+def mountpoint_name(mountpoint):
+    "The name a mountpoint is reported as: root for /, var_lib for /var/lib."
+    return mountpoint.strip("/").replace("/", "_") or "root"
+
+
+"""
+    MountSelector selects the mountpoints to report among the partitions of
+    the collector, as {"name", "path"} dicts like the configured paths.
+"""
+class MountSelector(DeviceSelector):
+    def select(self, partitions):
+        mountpoints = [partition.mountpoint for partition in partitions]
+        if frozenset(mountpoints) != self.names:
+            self.names = frozenset(mountpoints)
+            seen = set()
+            self.selected = []
+            for mountpoint in mountpoints:
+                if mountpoint not in seen and self.patterns.matches(mountpoint):
+                    seen.add(mountpoint)
+                    self.selected.append({"name": mountpoint_name(mountpoint), "path": mountpoint})
+            self.changes += 1
+        return self.selected
+
+
+"""
+    Discovery holds the selectors of the network interfaces, disks and
+    mountpoints of a reporter.
+"""
+class Discovery():
+    def __init__(self, interfaces=None, disks=None, mountpoints=None):
+        self.interfaces = DeviceSelector(interfaces or Patterns(exclude=DEFAULT_EXCLUDE_INTERFACES))
+        self.disks = DeviceSelector(disks or Patterns(exclude=DEFAULT_EXCLUDE_DISKS))
+        self.mountpoints = MountSelector(mountpoints or Patterns())
+
+    @staticmethod
+    def from_config(config, section="general"):
+        "Patterns from the interfaces, excludeInterfaces, disks, excludeDisks and mountpoints/excludeMountpoints options."
+        def option(name, default=None):
+            if config.has_option(section, name):
+                return parse_patterns(config.get(section, name))
+            return default
+
+        return Discovery(Patterns(option("interfaces"), option("excludeInterfaces", DEFAULT_EXCLUDE_INTERFACES)),
+                         Patterns(option("disks"), option("excludeDisks", DEFAULT_EXCLUDE_DISKS)),
+                         Patterns(option("mountpoints"), option("excludeMountpoints")))
@@ -0,0 +1,82 @@
+"""
+Filesystem reporter plugin: space and inode use of the mountpoints, usually
+at a longer interval than the system reporter ([filesystem] pollingInSec).
+
+The mountpoints are the [general] paths, or the ones selected by the
+mountpoints/excludeMountpoints patterns, like for the system reporter.
+"""
+
+import os
+
+from discovery import Discovery
+from proc_collector import create_collector, percent
+from reporter import AReporter
+from send_queue import QUEUE_SIZE, DROP_OLDEST, REPLAY_RATE
+
+
+"""
+    FilesystemReporter reports the space and inodes used on each mountpoint.
+"""
+class FilesystemReporter(AReporter):
+    # one statvfs() per mountpoint
+    COLLECT_COST = 0.0002
+
+    def __init__(self, syslog_host, syslog_hostname, syslog_port, interval, paths, transport=None,
+                 queue_size=QUEUE_SIZE, overflow=DROP_OLDEST, spool=None, replay_rate=REPLAY_RATE, collector=None, discovery=None):
+        super(FilesystemReporter, self).__init__("monitoring-agent-filesystems", syslog_host, syslog_hostname, syslog_port, interval,
+                                                 transport, queue_size, overflow, spool, replay_rate)
+        self.paths = paths
+        self.collector = collector
+        self.discovery = discovery or Discovery()
+        self.filesystems = []
+
+    def current_paths(self):
+        if self.paths:
+            return self.paths
+        return self.discovery.mountpoints.select(self.collector.disk_partitions())
+
+    def collect(self):
+        super(FilesystemReporter, self).collect()
+        filesystems = []
+        for path in self.current_paths():
+            try:
+                filesystems.append((path, os.statvfs(path["path"])))
+            except OSError:
+                # unmounted since, or a stale network filesystem
+                pass
+        self.filesystems = filesystems
+
+    def process(self):
+        rows = []
+        for path, st in self.filesystems:
+            free = st.f_bavail * st.f_frsize
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize
+            inodes_used = st.f_files - st.f_ffree
+            rows.append({
+                "name": path["name"],
+                "path": path["path"],
+                "total": st.f_blocks * st.f_frsize,
+                "used": used,
+                "free": free,
+                "percent": percent(used, used + free),
+                "inodes_total": st.f_files,
+                "inodes_used": inodes_used,
+                "inodes_free": st.f_favail,
+                "inodes_percent": percent(inodes_used, st.f_files),
+            })
+        return {"filesystems": rows}
+
+
+def create_reporter(context):
+    config = context.config
+    collector = "psutil"
+    if config.has_option("general", "collector"):
+        collector = config.get('general', 'collector')
+    paths = []
+    if config.has_option("general", "paths"):
+        for p in config.get('general', 'paths').split(","):
+            name, path = p.split(":")[:2]
+            paths.append({"name": name, "path": path})
+    return FilesystemReporter(context.syslog_host, context.syslog_hostname, context.syslog_port, context.interval_for("filesystem"),
+                              paths, context.transport(), context.queue_size, context.overflow_for(None), None, context.replay_rate,
+                              None if paths else create_collector(collector), Discovery.from_config(config))
@@ -0,0 +1,116 @@
+"""
+Self-instrumentation of the monitoring agent.
+
+The agent times the stages of every report with the monotonic nanosecond
+clock: collect, process, serialize (json.dumps), send (hand-off to the
+logging handler) and deliver (the transport write, in the sender thread).
+Each duration goes into a fixed-bucket histogram per reporter and stage:
+bucket i counts the durations up to 2^i microseconds, so recording is one
+bisect and one increment, and the memory used does not grow with the
+number of reports. The self reporter (self_reporter.py) emits and resets
+them periodically with the agent's own CPU use and resident memory.
+"""
+
+import bisect
+import os
+import threading
+from array import array
+
+
+# 1 us .. about 17 s
+BUCKETS = [1000 << i for i in range(25)]
+STAGES = ["collect", "process", "serialize", "send", "deliver"]
+PERCENTILES = [50, 95, 99]
+
+
+def rss_bytes():
+    "Resident memory of this process."
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except IOError:
+        import resource
+        # ru_maxrss is the peak, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+"""
+    Histogram counts durations in nanoseconds into the BUCKETS, the last
+    slot counting the ones over the largest bucket.
+
+    record() takes no lock: a report may rarely be lost when two threads
+    record into the same histogram at once, which is fine for timings.
+"""
+class Histogram():
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = array('L', [0] * (len(bounds) + 1))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        self.counts[bisect.bisect_left(self.bounds, ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, pct):
+        "Upper bound of the bucket holding the `pct` percentile (at most the max), in ns."
+        rank = self.count * pct / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bounds[idx], self.max) if idx < len(self.bounds) else self.max
+        return 0
+
+    def summary(self):
+        "count, mean/max/percentiles in us, and the non-empty buckets as {upper bound in us: count}."
+        summary = {"count": self.count, "mean_us": round(self.total / 1000.0 / self.count, 1) if self.count else 0.0,
+                   "max_us": round(self.max / 1000.0, 1)}
+        for pct in PERCENTILES:
+            summary["p{}_us".format(pct)] = round(self.percentile(pct) / 1000.0, 1)
+        summary["buckets"] = dict((str(self.bounds[idx] // 1000) if idx < len(self.bounds) else "inf", count)
+                                  for idx, count in enumerate(self.counts) if count)
+        return summary
+
+
+"""
+    Timings holds the histograms of every (reporter, stage).
+"""
+class Timings():
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, reporter, stage):
+        key = (reporter, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def summary(self):
+        "reporter -> stage -> histogram summary, resetting the histograms."
+        with self.lock:
+            histograms = self.histograms
+            # the reporters hold their histograms, they are reset in place
+            snapshots = dict((key, (h.counts[:], h.count, h.total, h.max)) for key, h in histograms.items())
+            for h in histograms.values():
+                h.counts = array('L', [0] * len(h.counts))
+                h.count = 0
+                h.total = 0
+                h.max = 0
+        summary = {}
+        for (reporter, stage), (counts, count, total, maximum) in snapshots.items():
+            snapshot = Histogram()
+            snapshot.counts, snapshot.count, snapshot.total, snapshot.max = counts, count, total, maximum
+            summary.setdefault(reporter, {})[stage] = snapshot.summary()
+        return summary
+
+
+# shared by all the reporters of the agent
+timings = Timings()
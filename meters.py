@@ -0,0 +1,293 @@
+"""
+Array-backed meter registry for the reporters.
+
+The reporters used to keep one SimpleMeter/DeltaMeter object per metric in a
+dict keyed by strings such as "enp0s25.bytes_sent", rebuilding the keys and
+looking them up on every report. MeterRegistry allocates the meters in groups
+once, at register() time: the last values of a group are a contiguous slice
+of an array('d') (floats), array('l') (integers) or array('L') (counters),
+and a whole group is updated with one call per tick.
+
+Counter groups also return per-second rates over the monotonic time elapsed
+since their previous update, and tell counter wraps (32 or 64 bits) from
+counter resets (device reattached, hot-plugged disk) instead of reporting
+a huge bogus increment.
+
+Usage: python meters.py [interfaces] [ticks] compares the dict of meters and
+the registry for a host with that many network interfaces and disks.
+"""
+
+import ctypes
+import ctypes.util
+import sys
+import time
+from array import array
+from itertools import izip
+
+
+WRAP32 = 1 << 32
+WRAP64 = 1 << 64
+# a counter that goes down from the top quarter of its range wrapped, otherwise it was reset
+WRAP_ZONE = 0.75
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_monotonic():
+    "clock_gettime(CLOCK_MONOTONIC) through ctypes in seconds and nanoseconds, time.time where it is missing."
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time, lambda: int(time.time() * 1e9)
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    # one timespec per call: the call releases the GIL and several threads read the clock
+    def monotonic():
+        spec = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            return time.time()
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+
+    def monotonic_ns():
+        spec = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            return int(time.time() * 1e9)
+        return spec.tv_sec * 1000000000 + spec.tv_nsec
+    return monotonic, monotonic_ns
+
+monotonic, monotonic_ns = _load_monotonic()
+
+
+def counter_delta(value, last):
+    """
+    Increment of a counter from `last` to `value`. A counter going down
+    wrapped when `last` was close to 2^32 or 2^64, otherwise it was reset
+    and counts from 0 again.
+    """
+    if value >= last:
+        return value - last
+    for wrap in (WRAP32, WRAP64):
+        if last < wrap:
+            if last >= wrap * WRAP_ZONE:
+                return wrap - last + value
+            break
+    return value
+
+
+"""
+    MeterGroup is a set of simple meters, `fields` for each of `names` (e.g.
+    the counters of every network interface), stored row by row.
+
+    update() takes the new values as one flat list in that order, casts them
+    and returns them.
+"""
+class MeterGroup():
+    def __init__(self, store, start, names, fields, cast):
+        self.store = store
+        self.start = start
+        self.names = names
+        self.fields = fields
+        self.width = len(fields)
+        self.end = start + len(names) * self.width
+        self.cast = cast
+        self.offsets = dict((name, idx * self.width) for idx, name in enumerate(names))
+
+    def row(self, values, name):
+        "The values of `name`, as a field -> value dict."
+        offset = self.offsets[name]
+        return dict(izip(self.fields, values[offset:offset + self.width]))
+
+    def last(self):
+        return self.store[self.start:self.end].tolist()
+
+    def update(self, values):
+        values = map(self.cast, values)
+        self.store[self.start:self.end] = array(self.store.typecode, values)
+        return values
+
+
+"""
+    DeltaGroup is a set of counters: update() returns the increments since the
+    previous update, rates() the matching per-second rates.
+
+    `wraps` and `resets` count the counters seen going down.
+"""
+class DeltaGroup(MeterGroup):
+    def __init__(self, store, start, names, fields, now=None):
+        MeterGroup.__init__(self, store, start, names, fields, long)
+        self.last_time = monotonic() if now is None else now
+        self.elapsed = 0.0
+        self.wraps = 0
+        self.resets = 0
+
+    def update(self, values, now=None):
+        now = monotonic() if now is None else now
+        self.elapsed = now - self.last_time
+        self.last_time = now
+
+        new = array(self.store.typecode, values)
+        old = self.store[self.start:self.end]
+        deltas = [value - last for value, last in izip(new, old)]
+        if deltas and min(deltas) < 0:
+            for idx, delta in enumerate(deltas):
+                if delta < 0:
+                    deltas[idx] = counter_delta(new[idx], old[idx])
+                    if deltas[idx] == new[idx]:
+                        self.resets += 1
+                    else:
+                        self.wraps += 1
+        self.store[self.start:self.end] = new
+        return deltas
+
+    def rates(self, deltas):
+        "Per-second rates of the increments returned by the last update()."
+        if self.elapsed <= 0:
+            return [0.0] * len(deltas)
+        elapsed = self.elapsed
+        return [round(delta / elapsed, 2) for delta in deltas]
+
+
+"""
+    MeterRegistry owns the arrays the meter groups live in.
+"""
+class MeterRegistry():
+    def __init__(self):
+        self.floats = array('d')
+        self.longs = array('l')
+        self.counters = array('L')
+        self.groups = []
+
+    def _allocate(self, store, init_values):
+        start = len(store)
+        store.extend(array(store.typecode, init_values))
+        return start
+
+    def simple(self, _type, names, fields, init_values):
+        "A group of meters casting their values to `_type` (float, int or long)."
+        store = self.floats if _type is float else self.longs
+        group = MeterGroup(store, self._allocate(store, map(_type, init_values)), names, fields, _type)
+        self.groups.append(group)
+        return group
+
+    def delta(self, names, fields, init_values, now=None):
+        "A group of counters returning increments, `init_values` read at monotonic time `now`."
+        group = DeltaGroup(self.counters, self._allocate(self.counters, init_values), names, fields, now)
+        self.groups.append(group)
+        return group
+
+    def regroup(self, group, names, init_values, now=None):
+        """
+        A group replacing `group` for a new set of `names` (a device appeared
+        or disappeared). The names `group` had keep their last values, the
+        others start from their values in `init_values`.
+        """
+        last = group.last()
+        values = []
+        for idx, name in enumerate(names):
+            if name in group.offsets:
+                offset = group.offsets[name]
+                values.extend(last[offset:offset + group.width])
+            else:
+                values.extend(init_values[idx * group.width:(idx + 1) * group.width])
+        if isinstance(group, DeltaGroup):
+            new = self.delta(names, group.fields, values, group.last_time)
+            new.wraps = group.wraps
+            new.resets = group.resets
+        else:
+            new = self.simple(group.cast, names, group.fields, values)
+        self._release(group)
+        return new
+
+    def _release(self, group):
+        "Drop `group`, compacting its array once it holds more unused slots than used ones."
+        self.groups.remove(group)
+        store = group.store
+        live = [g for g in self.groups if g.store is store]
+        if sum(g.end - g.start for g in live) * 2 >= len(store):
+            return
+        values = [store[g.start:g.end] for g in live]
+        del store[:]
+        for g, value in zip(live, values):
+            g.start = len(store)
+            store.extend(value)
+            g.end = len(store)
+
+    def clear(self):
+        del self.floats[:]
+        del self.longs[:]
+        del self.counters[:]
+        self.groups = []
+
+    def __len__(self):
+        return len(self.floats) + len(self.longs) + len(self.counters)
+
+
+class _DeltaMeter():
+    "The per-metric meter metrics-to-syslog.py used, for the benchmark."
+    def __init__(self, init_value=0L):
+        self.last = long(init_value)
+
+    def update_and_get(self, value):
+        v = long(value)
+        delta = abs(v - self.last)
+        self.last = v
+        return delta
+
+
+def bench(interfaces, ticks):
+    "Per-tick cost of updating the network and disk meters of a host."
+    net_fields = ["bytes_sent", "bytes_recv", "packets_sent", "packets_recv"]
+    disk_fields = ["read_count", "write_count", "read_bytes", "write_bytes", "read_time", "write_time"]
+    nics = ["veth{}".format(n) for n in range(interfaces)]
+    disks = ["dm-{}".format(n) for n in range(interfaces)]
+
+    def sample(tick):
+        net = dict((nic, [tick * 1000 + n] * len(net_fields)) for n, nic in enumerate(nics))
+        disk = dict((d, [tick * 100 + n] * len(disk_fields)) for n, d in enumerate(disks))
+        return net, disk
+    samples = [sample(tick) for tick in range(ticks)]
+
+    measures = {}
+    net, disk = samples[0]
+    for nic in nics:
+        for idx, field in enumerate(net_fields):
+            measures[nic + "." + field] = _DeltaMeter(net[nic][idx])
+    for d in disks:
+        for idx, field in enumerate(disk_fields):
+            measures[d + "." + field] = _DeltaMeter(disk[d][idx])
+    start = time.time()
+    for net, disk in samples:
+        for nic in nics:
+            values = net[nic]
+            dict((field, measures[nic + "." + field].update_and_get(values[idx])) for idx, field in enumerate(net_fields))
+        for d in disks:
+            values = disk[d]
+            dict((field, measures[d + "." + field].update_and_get(values[idx])) for idx, field in enumerate(disk_fields))
+    meter_dict = (time.time() - start) / ticks
+
+    registry = MeterRegistry()
+    net, disk = samples[0]
+    net_group = registry.delta(nics, net_fields, [value for nic in nics for value in net[nic]])
+    disk_group = registry.delta(disks, disk_fields, [value for d in disks for value in disk[d]])
+    start = time.time()
+    for net, disk in samples:
+        deltas = net_group.update([value for nic in nics for value in net[nic]])
+        for nic in nics:
+            net_group.row(deltas, nic)
+        deltas = disk_group.update([value for d in disks for value in disk[d]])
+        for d in disks:
+            disk_group.row(deltas, d)
+    meter_registry = (time.time() - start) / ticks
+
+    print "{} interfaces + {} disks, {} meters".format(interfaces, interfaces, len(measures))
+    print "{:<16} {:>10.0f} us/tick".format("dict of meters", meter_dict * 1e6)
+    print "{:<16} {:>10.0f} us/tick".format("meter registry", meter_registry * 1e6)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    bench(*(args + [500, 200][len(args):]))
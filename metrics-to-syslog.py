@@ -1,386 +1,22 @@
 #!/usr/bin/env python
 
-from logging.handlers import SysLogHandler
 import ConfigParser
 import os
 import time
-import psutil
-import logging
-import socket
-import json
-import threading
-import math
 import sys
 
+from delta_encoding import KEYFRAME_EVERY, EPSILON
+from plugins import ReporterContext, create_reporters, expected_cpu, reporter_names, rss_mb
+from scheduler import Scheduler, JITTER, WORKERS
+from send_queue import QueuedHandler, QUEUE_SIZE, DROP_OLDEST, SPILL, REPLAY_RATE
+from serialization import Serializer
+from spool import SegmentSpool, MAX_BYTES
+from syslog_transport import create_transport, parse_addresses
 
-def time_in_ms():
-    return long(math.floor(time.time() * 1000))
-
-
-"""
-    DeltaMeter provides an easy way to compute metric increments.
-"""
-class DeltaMeter():
-    def __init__(self, init_value=0L):
-        self.last_update = time_in_ms()
-        self.last = long(init_value)
-
-    def update_and_get(self, value):
-        v = long(value)
-        delta = abs(v - self.last)
-        self.last = v
-        return delta
-
-"""
-    SimpleMeter is a simple typed meter. You can use it when you need cast a string -> my_type
-"""
-class SimpleMeter():
-    def __init__(self, _type, init_value):
-        self.last_update = time_in_ms()
-        self.last = _type(init_value)
-        self.type = _type
-
-    def update_and_get(self, value):
-        self.last = self.type(value)
-        return self.last
-
-"""
-    TaskThread is a simple thread scheduler. It's call the run method every XX seconds.
-"""
-class TaskThread(threading.Thread):
-
-    def __init__(self, interval):
-        threading.Thread.__init__(self)
-        self.finished = threading.Event()
-        self.interval = interval
-
-    def set_interval(self, interval):
-        self.interval = interval
-
-    def shutdown(self):
-        self.finished.set()
-
-    def run(self):
-        while 1:
-            if self.finished.isSet():
-                return
-            self.task()
-
-            # sleep for interval or until shutdown
-            self.finished.wait(self.interval)
-
-    def task(self):
-        pass
-
-"""
-    AReporter is the base class for all reporters.
-    It handles the following operations:
-        - register the metrics
-        - collect data
-        - process data
-        - flush every XX seconds
-"""
-class AReporter(TaskThread):
-
-    def __init__(self, app_name, syslog_host, syslog_hostname, syslog_port, interval):
-        super(AReporter, self).__init__(interval)
-        self.app_name = app_name
-        self.syslog_host = syslog_host
-        self.syslog_port = syslog_port
-        self.logger = logging.getLogger(self.app_name)
-        self.logger.setLevel(logging.INFO)
-
-        f = ContextFilter()
-        self.logger.addFilter(f)
-
-        syslog = SysLogHandler(address=(self.syslog_host, self.syslog_port))
-        formatter = logging.Formatter("%(asctime)s {1} {0}: %(message)s".format(self.app_name, syslog_hostname), datefmt='%b %d %H:%M:%S')
-        syslog.setFormatter(formatter)
-
-        self.logger.addHandler(syslog)
-
-        self.measures = {}
-
-    def prestart(self):
-        self.collect()
-        self.register()
-
-    def collect(self):
-        pass
-
-    def register(self):
-        pass
-
-    def task(self):
-        try:
-            start = AReporter.time_in_s()
-            self.collect()
-            took = AReporter.time_in_s() - start
-
-            # if collecting data is taking too long we're
-            # skipping the current step and try after
-            if took > self.interval:
-                self.logger.error("collecting data take too long")
-            else:
-                data = self.process()
-
-                if not isinstance(data, list):
-                    to_push = [data]
-                else:
-                    to_push = data
-
-                for d in to_push:
-                    m = d
-                    # m = {
-                    #     "m": {
-                    #         self.app_name: d
-                    #     },
-                    #     "message": "Report "+ (' & '.join(key for key, value in d.items())) +" metrics"
-                    # }
-                    # print json.dumps(m)
-                    self.logger.info(json.dumps(m))
-
-        except Exception as e:
-            # raise e
-            self.logger.error("Error during report processing:" + e.message)
-            # reset the reporter
-            self.prestart()
-
-    @staticmethod
-    def time_in_s():
-        return long(math.floor(time.time()))
-
-
-class SystemReporter(AReporter):
-
-    def __init__(self, syslog_host, syslog_hostname, syslog_port, interval, paths, latitude, longitude, province, city, store):
-        super(SystemReporter, self).__init__("monitoring-agent", syslog_host, syslog_hostname, syslog_port, interval)
-        self.paths = paths
-
-        # attributes
-        self.io_data = None
-        self.cpu_percent_data = None
-        self.cpu_times_percent_data = None
-        self.paths_data = None
-        self.mem_virtual_data = None
-        self.mem_swap_data = None
-        self.io_disk_data = None
-        self.process_data = None
-        self.latitude_data = latitude
-        self.longitude_data = longitude
-        self.province_data = province
-        self.city_data = city
-        self.store_data = store
-
-    def register(self):
-        super(SystemReporter, self).register()
-
-        self.measures["cpu"]                   = SimpleMeter(float, self.cpu_percent_data)
-        self.measures["cpu.user"]              = SimpleMeter(float, self.cpu_times_percent_data.user)
-        self.measures["cpu.system"]            = SimpleMeter(float, self.cpu_times_percent_data.system)
-        self.measures["cpu.idle"]              = SimpleMeter(float, self.cpu_times_percent_data.idle)
-        self.measures["cpu.nice"]              = SimpleMeter(float, self.cpu_times_percent_data.nice)
-        self.measures["cpu.irq"]               = SimpleMeter(float, self.cpu_times_percent_data.irq)
-        self.measures["cpu.softirq"]           = SimpleMeter(float, self.cpu_times_percent_data.softirq)
-        self.measures["cpu.iowait"]            = SimpleMeter(float, self.cpu_times_percent_data.iowait)
-        self.measures["cpu.steal"]             = SimpleMeter(float, self.cpu_times_percent_data.steal)
-        self.measures["mem.virtual.total"]     = SimpleMeter(long, self.mem_virtual_data.total)
-        self.measures["mem.virtual.available"] = SimpleMeter(long, self.mem_virtual_data.available)
-        self.measures["mem.virtual.percent"]   = SimpleMeter(float, self.mem_virtual_data.percent)
-        self.measures["mem.virtual.used"]      = SimpleMeter(long, self.mem_virtual_data.used)
-        self.measures["mem.virtual.free"]      = SimpleMeter(long, self.mem_virtual_data.free)
-        self.measures["mem.virtual.active"]    = SimpleMeter(long, self.mem_virtual_data.active)
-        self.measures["mem.virtual.inactive"]  = SimpleMeter(long, self.mem_virtual_data.inactive)
-        self.measures["mem.virtual.buffers"]   = SimpleMeter(long, self.mem_virtual_data.buffers)
-        self.measures["mem.virtual.cached"]    = SimpleMeter(long, self.mem_virtual_data.cached)
-        self.measures["mem.virtual.shared"]    = SimpleMeter(long, self.mem_virtual_data.shared)
-        self.measures["mem.swap.total"]        = SimpleMeter(long, self.mem_swap_data.total)
-        self.measures["mem.swap.used"]         = SimpleMeter(long, self.mem_swap_data.used)
-        self.measures["mem.swap.free"]         = SimpleMeter(long, self.mem_swap_data.free)
-        self.measures["mem.swap.percent"]      = SimpleMeter(float, self.mem_swap_data.percent)
-        # self.measures["mem.swap.sin"]          = SimpleMeter(long, self.mem_swap_data.sin)
-        # self.measures["mem.swap.sout"]         = SimpleMeter(long, self.mem_swap_data.sout)
-
-        network_interfaces = [ni for ni in psutil.net_io_counters(pernic=True)]
-        for network_interface in network_interfaces:
-            self.measures[network_interface + ".bytes_sent"]   = DeltaMeter(self.io_data[network_interface].bytes_sent)
-            self.measures[network_interface + ".bytes_recv"]   = DeltaMeter(self.io_data[network_interface].bytes_recv)
-            self.measures[network_interface + ".packets_sent"] = DeltaMeter(self.io_data[network_interface].packets_sent)
-            self.measures[network_interface + ".packets_recv"] = DeltaMeter(self.io_data[network_interface].packets_recv)
-            # self.measures[network_interface + ".errin"]        = DeltaMeter(self.io_data[network_interface].errin)
-            # self.measures[network_interface + ".errout"]       = DeltaMeter(self.io_data[network_interface].errout)
-            # self.measures[network_interface + ".dropin"]       = DeltaMeter(self.io_data[network_interface].dropin)
-            # self.measures[network_interface + ".dropout"]      = DeltaMeter(self.io_data[network_interface].dropout)
-
-        disks = [disk for disk in psutil.disk_io_counters(perdisk=True)]
-        for disk in disks:
-            self.measures[disk + ".read_count"]  = DeltaMeter(self.io_disk_data[disk].read_count)
-            self.measures[disk + ".write_count"] = DeltaMeter(self.io_disk_data[disk].write_count)
-            self.measures[disk + ".read_bytes"]  = DeltaMeter(self.io_disk_data[disk].read_bytes)
-            self.measures[disk + ".write_bytes"] = DeltaMeter(self.io_disk_data[disk].write_bytes)
-            self.measures[disk + ".read_time"]   = DeltaMeter(self.io_disk_data[disk].read_time)
-            self.measures[disk + ".write_time"]  = DeltaMeter(self.io_disk_data[disk].write_time)
-
-        for idx, path_data in enumerate(self.paths_data):
-            path = self.paths[idx]
-            path_name = path["name"]
-            path_data = psutil.disk_usage(path["path"])
-            self.measures[path_name + ".total"]   = SimpleMeter(long, path_data.total)
-            self.measures[path_name + ".used"]    = SimpleMeter(long, path_data.used)
-            self.measures[path_name + ".free"]    = SimpleMeter(long, path_data.free)
-            self.measures[path_name + ".percent"] = SimpleMeter(float, path_data.percent)
-
-        self.measures["process"] = SimpleMeter(int, self.process_data)
-
-    def collect(self):
-        super(SystemReporter, self).collect()
-        self.io_data = psutil.net_io_counters(pernic=True)
-        self.cpu_percent_data = psutil.cpu_percent(interval=None)
-        self.cpu_times_percent_data = psutil.cpu_times_percent(interval=None)
-        self.mem_virtual_data = psutil.virtual_memory()
-        self.mem_swap_data = psutil.swap_memory()
-        self.paths_data = [psutil.disk_usage(p["path"]) for p in self.paths]
-        self.io_disk_data = psutil.disk_io_counters(perdisk=True)
-        self.process_data = len(psutil.pids())
-
-    def process(self):
-        cpu_data = self.measures["cpu"].update_and_get(self.cpu_percent_data)
-        cpu_times_data = {
-            "user": self.measures["cpu.user"].update_and_get(self.cpu_times_percent_data.user),
-            "system": self.measures["cpu.system"].update_and_get(self.cpu_times_percent_data.system),
-            "idle": self.measures["cpu.idle"].update_and_get(self.cpu_times_percent_data.idle),
-            "nice": self.measures["cpu.nice"].update_and_get(self.cpu_times_percent_data.nice),
-            "irq": self.measures["cpu.irq"].update_and_get(self.cpu_times_percent_data.irq),
-            "softirq": self.measures["cpu.softirq"].update_and_get(self.cpu_times_percent_data.softirq),
-            "iowait": self.measures["cpu.iowait"].update_and_get(self.cpu_times_percent_data.iowait),
-            "steal": self.measures["cpu.steal"].update_and_get(self.cpu_times_percent_data.steal),
-        }
-        mem_data = {
-            "virtual": {
-                "total": self.measures["mem.virtual.total"].update_and_get(self.mem_virtual_data.total),
-                "available": self.measures["mem.virtual.available"].update_and_get(self.mem_virtual_data.available),
-                "percent": self.measures["mem.virtual.percent"].update_and_get(self.mem_virtual_data.percent),
-                "used": self.measures["mem.virtual.used"].update_and_get(self.mem_virtual_data.used),
-                "free": self.measures["mem.virtual.free"].update_and_get(self.mem_virtual_data.free),
-                "active": self.measures["mem.virtual.active"].update_and_get(self.mem_virtual_data.active),
-                "inactive": self.measures["mem.virtual.inactive"].update_and_get(self.mem_virtual_data.inactive),
-                "buffers": self.measures["mem.virtual.buffers"].update_and_get(self.mem_virtual_data.buffers),
-                "cached": self.measures["mem.virtual.cached"].update_and_get(self.mem_virtual_data.cached),
-                "shared": self.measures["mem.virtual.shared"].update_and_get(self.mem_virtual_data.shared),
-            },
-            "swap": {
-                "total": self.measures["mem.swap.total"].update_and_get(self.mem_swap_data.total),
-                "used": self.measures["mem.swap.used"].update_and_get(self.mem_swap_data.used),
-                "free": self.measures["mem.swap.free"].update_and_get(self.mem_swap_data.free),
-                "percent": self.measures["mem.swap.percent"].update_and_get(self.mem_swap_data.percent),
-                # "sin": self.measures["mem.swap.sin"].update_and_get(self.mem_swap_data.sin),
-                # "sout": self.measures["mem.swap.sout"].update_and_get(self.mem_swap_data.sout),
-            }
-        }
-
-        network_data = []
-        for k in self.io_data:
-            if k == 'enp0s25':
-                network_data = [{
-                    "name": k,
-                    "bytes_sent": self.measures[k + ".bytes_sent"].update_and_get(
-                        self.io_data[k].bytes_sent),
-                    "bytes_recv": self.measures[k + ".bytes_recv"].update_and_get(
-                        self.io_data[k].bytes_recv),
-                    "packets_sent": self.measures[k + ".packets_sent"].update_and_get(
-                        self.io_data[k].packets_sent),
-                    "packets_recv": self.measures[k + ".packets_recv"].update_and_get(
-                        self.io_data[k].packets_recv),
-                    # "errin": self.measures[k + ".errin"].update_and_get(self.io_data[k].errin),
-                    # "errout": self.measures[k + ".errout"].update_and_get(self.io_data[k].errout),
-                    # "dropin": self.measures[k + ".dropin"].update_and_get(self.io_data[k].dropin),
-                    # "dropout": self.measures[k + ".dropout"].update_and_get(self.io_data[k].dropout),
-                }]
-
-        paths = []
-        for idx, p in enumerate(self.paths):
-            current_path = self.paths[idx]
-            current_path_data = self.paths_data[idx]
-
-            path_name = current_path["name"]
-            path = current_path["path"]
-            paths.append({
-                "name"   : path_name,
-                "path"   : path,
-                "total"  : self.measures[path_name + ".total"].update_and_get(current_path_data.total),
-                "used"   : self.measures[path_name + ".used"].update_and_get(current_path_data.used),
-                "free"   : self.measures[path_name + ".free"].update_and_get(current_path_data.free),
-                "percent": self.measures[path_name + ".percent"].update_and_get(current_path_data.percent)
-            })
-
-        io_disks = []
-        for k in self.io_disk_data:
-            if k == 'sda6':
-                io_disks = [{
-                    "disk_id"    : k,
-                    "read_count" : self.measures[k + ".read_count"].update_and_get(self.io_disk_data[k].read_count),
-                    "write_count": self.measures[k + ".write_count"].update_and_get(self.io_disk_data[k].write_count),
-                    "read_bytes" : self.measures[k + ".read_bytes"].update_and_get(self.io_disk_data[k].read_bytes),
-                    "write_bytes": self.measures[k + ".write_bytes"].update_and_get(self.io_disk_data[k].write_bytes),
-                    "read_time"  : self.measures[k + ".read_time"].update_and_get(self.io_disk_data[k].read_time),
-                    "write_time" : self.measures[k + ".write_time"].update_and_get(self.io_disk_data[k].write_time)
-                }]
-
-        process_total = self.measures["process"].update_and_get(self.process_data)
-
-        latitude = self.latitude_data
-        longitude = self.longitude_data
-
-        province = self.province_data
-        city = self.city_data
-        store = self.store_data
-
-        location = "{},{}".format(latitude, longitude)
-
-        io_disk = io_disks.pop()
-        ndata = network_data.pop()
-        path1 = paths.pop()
-        path2 = paths.pop()
-        path3 = paths.pop()
-
-        messages = []
-        messages.append({
-            "cpu": cpu_data,
-            "cpu_times": cpu_times_data,
-            "mem": mem_data,
-            "disk0": path1,
-            "disk1": path2,
-            "disk2": path3,
-            "io_disk": io_disk,
-            "network": ndata,
-            "processes": process_total,
-            "location": location,
-            "province": province,
-            "city": city,
-            "store": store
-        })
-
-        # for io_disk in io_disks:
-        #     messages.append({"io_disk": io_disk})
-        #
-        # for path in paths:
-        #     messages.append({"disk": path})
-        #
-        # for ndata in network_data:
-        #     messages.append({"network": ndata})
-
-        return messages
-
-
-class ContextFilter(logging.Filter):
-    hostname = socket.gethostname()
-
-    def filter(self, record):
-        record.hostname = ContextFilter.hostname
-        return True
 
 #########################################
 def main(argv):
+    start = time.time()
     print "Starting the monitoring agent..."
 
     current_path = os.path.dirname(os.path.realpath(__file__))
@@ -394,31 +30,109 @@ def main(argv):
     syslog_host = main_config.get('syslog', 'host')
     syslog_hostname = main_config.get('syslog', 'hostname')
     syslog_port = main_config.getint('syslog', 'port')
-    interval_in_sec = main_config.getint('syslog', 'pollingInSec')
-    latitude = main_config.get('general', 'latitude')
-    longitude = main_config.get('general', 'longitude')
-    province = main_config.get('general', 'province')
-    city = main_config.get('general', 'city')
-    store = main_config.get('general', 'store')
-
-    paths = []
-    reporters = []
-    if main_config.has_option("general", "paths"):
-        for p in main_config.get('general', 'paths').split(","):
-            parts = p.split(":")
-            name = parts[0]
-            path = parts[1]
-            paths.append({"name": name, "path": path})
-
-    reporters.append(SystemReporter(syslog_host, syslog_hostname, syslog_port, interval_in_sec, paths, latitude, longitude, province, city, store))
-
+    interval_in_sec = main_config.getfloat('syslog', 'pollingInSec')
+
+    # batching only pays off with many messages per interval, it is off by default
+    batch_size = 1
+    linger = 0
+    protocol = "udp"
+    nodelay = True
+    if main_config.has_option("syslog", "batchSize"):
+        batch_size = main_config.getint('syslog', 'batchSize')
+    if main_config.has_option("syslog", "lingerMs"):
+        linger = main_config.getint('syslog', 'lingerMs') / 1000.0
+    if main_config.has_option("syslog", "protocol"):
+        protocol = main_config.get('syslog', 'protocol')
+    if main_config.has_option("syslog", "tcpNoDelay"):
+        nodelay = main_config.getboolean('syslog', 'tcpNoDelay')
+
+    # records queued between the reporters and the network, 0 sends from the reporter thread
+    queue_size = QUEUE_SIZE
+    overflow = DROP_OLDEST
+    spool_dir = None
+    spool_bytes = MAX_BYTES
+    replay_rate = REPLAY_RATE
+    if main_config.has_option("syslog", "queueSize"):
+        queue_size = main_config.getint('syslog', 'queueSize')
+    if main_config.has_option("syslog", "overflow"):
+        overflow = main_config.get('syslog', 'overflow')
+    # messages that could not be sent are kept there and replayed when the collector is back
+    if main_config.has_option("syslog", "spoolDir"):
+        spool_dir = main_config.get('syslog', 'spoolDir')
+    if main_config.has_option("syslog", "spoolMaxMb"):
+        spool_bytes = main_config.getint('syslog', 'spoolMaxMb') << 20
+    if main_config.has_option("syslog", "replayRate"):
+        replay_rate = main_config.getint('syslog', 'replayRate')
+    if overflow == SPILL and spool_dir is None:
+        spool_dir = os.path.join(current_path, "spool")
+
+    # host can list several collectors ("host1,host2:1514"), messages are spread over them
+    addresses = parse_addresses(syslog_host, syslog_port)
+    syslog_host, syslog_port = addresses[0]
+
+    # one transport per reporter, each one is drained by the sender thread of its queue
+    def reporter_transport():
+        if protocol != "udp" or batch_size > 1 or len(addresses) > 1:
+            return create_transport(protocol, addresses, batch_size, linger, nodelay, raise_when_down=spool_dir is not None)
+        return None
+
+    # all the reporters run on one scheduler thread; schedulerWorkers > 0 runs them on a pool instead,
+    # so a slow collector does not delay the others. The first runs are spread over jitter * interval
+    workers = WORKERS
+    jitter = JITTER
+    if main_config.has_option("general", "schedulerWorkers"):
+        workers = main_config.getint('general', 'schedulerWorkers')
+    if main_config.has_option("general", "jitter"):
+        jitter = main_config.getfloat('general', 'jitter')
+
+    spool = None
+    if spool_dir is not None and queue_size > 0:
+        spool = SegmentSpool(spool_dir, max_bytes=spool_bytes)
+
+    # the reporters listed in [general] reporters (system,process by default), see plugins.py
+    context = ReporterContext(main_config, syslog_host, syslog_hostname, syslog_port, interval_in_sec, reporter_transport,
+                              queue_size, overflow, spool, replay_rate)
+    # encoding = delta: a full document every keyframeEvery reports, only the fields that changed by more than
+    # deltaEpsilon (relative) in between; python delta_encoding.py decode rebuilds the full documents. The messages
+    # are encoded before they are queued and the decoder needs every message of a reporter, in order: a spool
+    # replays old ones between the live ones, and several collectors each get every other message (round robin),
+    # so the delta encoding does not go with spoolDir, overflow = spill or more than one host
+    if main_config.has_option("syslog", "encoding") and main_config.get('syslog', 'encoding') == "delta":
+        if spool is not None:
+            raise ValueError("encoding = delta cannot be used with spoolDir or overflow = spill")
+        if len(addresses) > 1:
+            raise ValueError("encoding = delta cannot be used with several syslog hosts")
+        keyframe_every = KEYFRAME_EVERY
+        epsilon = EPSILON
+        if main_config.has_option("syslog", "keyframeEvery"):
+            keyframe_every = main_config.getint('syslog', 'keyframeEvery')
+        if main_config.has_option("syslog", "deltaEpsilon"):
+            epsilon = main_config.getfloat('syslog', 'deltaEpsilon')
+        context.delta = (keyframe_every, epsilon)
+    # jsonBackend = auto uses orjson or ujson when installed, see serialization.py
+    if main_config.has_option("syslog", "jsonBackend"):
+        context.serializer = Serializer(main_config.get('syslog', 'jsonBackend'))
+    reporters = create_reporters(context, reporter_names(main_config))
+    print "Reporters: {}, expected CPU {:.2f}%".format(", ".join(reporter.app_name for reporter in reporters),
+                                                       expected_cpu(reporters) * 100)
+
+    scheduler = Scheduler(workers, jitter)
+    context.scheduler = scheduler
     for reporter in reporters:
-        reporter.daemon = True
         reporter.prestart()
-        reporter.start()
-
-    while True:
-        time.sleep(1)
+        for task in reporter.tasks():
+            scheduler.add(task)
+    print "Started in {:.0f} ms, {:.1f} MB resident".format((time.time() - start) * 1000, rss_mb())
+
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.shutdown()
+        print "scheduler: {}".format(scheduler.counters())
+        for reporter in reporters:
+            reporter.handler.close()
+            if isinstance(reporter.handler, QueuedHandler):
+                print "{}: {}".format(reporter.app_name, reporter.handler.counters())
 
 if __name__ == "__main__":
     main(sys.argv)
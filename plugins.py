@@ -0,0 +1,145 @@
+"""
+Reporter plugins of the monitoring agent.
+
+The agent used to import every reporter with its dependencies and always
+run the same ones. The reporters to run are now listed in the config, and a
+reporter module is only imported when it is listed:
+
+    [general]
+    reporters = system,process,filesystem,mypackage.myreporter
+
+A built-in name (system, process, filesystem, self) maps to a module of the agent,
+any other name is a module to import from the Python path. A plugin module
+defines create_reporter(context), which returns its reporter built from the
+ReporterContext, or None when the config disables it. A reporter declares
+its expected CPU seconds per collect() (COLLECT_COST, or collect_cost()),
+from which the agent's expected CPU share is printed at startup. A
+[<name>] pollingInSec option overrides the interval of one reporter.
+
+Usage: python plugins.py [reporter...] prints the startup time and resident
+memory of an agent loading only these reporters, for each prefix of the list.
+"""
+
+import importlib
+import os
+import subprocess
+import sys
+
+from delta_encoding import DeltaEncoder
+from instrumentation import rss_bytes
+from send_queue import SPILL, DROP_OLDEST
+
+
+BUILTIN = {"system": "system_reporter", "process": "process_reporter", "filesystem": "filesystem_reporter",
+           "self": "self_reporter"}
+DEFAULT_REPORTERS = ["system", "process", "self"]
+
+
+"""
+    ReporterContext is what the plugins build their reporter from: the
+    config, and the syslog and queue settings shared by all the reporters.
+"""
+class ReporterContext():
+    def __init__(self, config, syslog_host, syslog_hostname, syslog_port, interval, transport_factory,
+                 queue_size, overflow, spool, replay_rate):
+        self.config = config
+        self.syslog_host = syslog_host
+        self.syslog_hostname = syslog_hostname
+        self.syslog_port = syslog_port
+        self.interval = interval
+        self.transport_factory = transport_factory
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.spool = spool
+        self.replay_rate = replay_rate
+        # filled by create_reporters() and main()
+        self.reporters = []
+        self.scheduler = None
+        # (keyframe_every, epsilon) in delta wire mode
+        self.delta = None
+        # Serializer of the [syslog] jsonBackend, None for the json module
+        self.serializer = None
+
+    def interval_for(self, name):
+        if self.config.has_option(name, "pollingInSec"):
+            return self.config.getfloat(name, "pollingInSec")
+        return self.interval
+
+    def transport(self):
+        "A new transport for a reporter, None for a plain UDP SysLogHandler."
+        return self.transport_factory()
+
+    def encoder(self):
+        "A new DeltaEncoder for a reporter, None when the documents are sent in full."
+        if self.delta is None:
+            return None
+        return DeltaEncoder(*self.delta)
+
+    def take_spool(self):
+        "The spool, for the first reporter asking: a spool directory has a single writer."
+        spool = self.spool
+        self.spool = None
+        return spool
+
+    def overflow_for(self, spool):
+        # spilling needs a spool
+        if self.overflow == SPILL and spool is None:
+            return DROP_OLDEST
+        return self.overflow
+
+
+def reporter_names(config):
+    if config.has_option("general", "reporters"):
+        return [name.strip() for name in config.get("general", "reporters").split(",") if name.strip()]
+    return DEFAULT_REPORTERS
+
+
+def load_plugin(name):
+    return importlib.import_module(BUILTIN.get(name, name))
+
+
+def create_reporters(context, names):
+    reporters = context.reporters
+    for name in names:
+        reporter = load_plugin(name).create_reporter(context)
+        if reporter is not None:
+            reporter.encoder = context.encoder()
+            if context.serializer is not None:
+                reporter.serializer = context.serializer
+            reporters.append(reporter)
+    return reporters
+
+
+def expected_cpu(reporters):
+    "The share of one CPU the reporters are expected to use, from their declared collect cost."
+    return sum(reporter.collect_cost() / reporter.interval for reporter in reporters)
+
+
+def rss_mb():
+    return rss_bytes() / float(1 << 20)
+
+
+MEASURE = """
+import time
+start = time.time()
+import sys
+sys.path.insert(0, {directory!r})
+import plugins, reporter
+for name in {names!r}:
+    plugins.load_plugin(name)
+print (time.time() - start) * 1000, plugins.rss_mb()
+"""
+
+
+def bench(names):
+    "Startup time and RSS of a fresh interpreter loading the base reporter then each prefix of `names`."
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for count in range(len(names) + 1):
+        loaded = names[:count]
+        output = subprocess.check_output([sys.executable, "-c", MEASURE.format(directory=directory, names=loaded)])
+        took, rss = [float(value) for value in output.split()]
+        print "{:<40} {:>8.1f} ms {:>8.1f} MB".format(",".join(loaded) or "(base)", took, rss)
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1:] or sorted(BUILTIN))
@@ -0,0 +1,279 @@
+"""
+Linux /proc collector backend for the monitoring agent.
+
+SystemReporter.collect() makes several psutil calls per tick, each one
+opening and parsing /proc files and building many intermediate objects.
+ProcCollector keeps /proc/stat, /proc/meminfo, /proc/net/dev,
+/proc/diskstats and /proc/self/mounts open, re-reads them from offset 0 every tick and parses them
+with precompiled patterns. It returns the same fields as the psutil calls,
+so the reporter does not care which backend filled them.
+
+Usage: python proc_collector.py [ticks] compares the per-tick CPU time of
+the psutil and /proc backends, and the number of objects each tick leaves
+allocated for the reporter.
+"""
+
+import collections
+import gc
+import os
+import re
+import sys
+import threading
+
+
+READ_SIZE = 1 << 16
+CPU_LINE_SIZE = 512
+SECTOR_SIZE = 512
+
+snetio = collections.namedtuple('snetio', ['bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv',
+                                           'errin', 'errout', 'dropin', 'dropout'])
+sdiskio = collections.namedtuple('sdiskio', ['read_count', 'write_count', 'read_bytes', 'write_bytes',
+                                             'read_time', 'write_time', 'read_merged_count', 'write_merged_count',
+                                             'busy_time'])
+scputimes = collections.namedtuple('scputimes', ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq',
+                                                 'steal', 'guest', 'guest_nice'])
+svmem = collections.namedtuple('svmem', ['total', 'available', 'percent', 'used', 'free', 'active', 'inactive',
+                                         'buffers', 'cached', 'shared'])
+sswap = collections.namedtuple('sswap', ['total', 'used', 'free', 'percent'])
+sdiskusage = collections.namedtuple('sdiskusage', ['total', 'used', 'free', 'percent'])
+sdiskpart = collections.namedtuple('sdiskpart', ['device', 'mountpoint', 'fstype', 'opts'])
+
+MEMINFO_LINE = re.compile(r"^(MemTotal|MemFree|MemAvailable|Buffers|Cached|SReclaimable|Active|Inactive|Shmem"
+                          r"|SwapTotal|SwapFree):\s+(\d+)", re.M)
+NET_DEV_LINE = re.compile(r"^\s*([^:\s]+):\s*" + r"(\d+)\s+" * 15 + r"(\d+)", re.M)
+DISKSTATS_LINE = re.compile(r"^\s*\d+\s+\d+\s+(\S+)\s+" + r"(\d+)\s+" * 9 + r"(\d+)", re.M)
+MOUNT_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+def percent(part, total):
+    return round(part * 100.0 / total, 1) if total else 0.0
+
+
+def total_time(times):
+    # guest time is already counted in user/nice
+    return sum(times) - getattr(times, "guest", 0) - getattr(times, "guest_nice", 0)
+
+
+def busy_percent(times, last):
+    "CPU use between two cpu_times() readings, like psutil.cpu_percent()."
+    total = total_time(times) - total_time(last)
+    busy = total - (times.idle - last.idle) - (getattr(times, "iowait", 0) - getattr(last, "iowait", 0))
+    return min(100.0, max(0.0, percent(busy, total)))
+
+
+"""
+    ProcFile is a /proc file kept open and re-read from the start. Reads are
+    serialized, the reporter and the sampler share the collector.
+"""
+class ProcFile():
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.lock = threading.Lock()
+
+    def read(self, size=None):
+        "The whole file, or its first `size` bytes."
+        with self.lock:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            data = os.read(self.fd, size or READ_SIZE)
+            if size or len(data) < READ_SIZE:
+                return data
+            chunks = [data]
+            while data:
+                data = os.read(self.fd, READ_SIZE)
+                chunks.append(data)
+            return "".join(chunks)
+
+    def close(self):
+        os.close(self.fd)
+
+
+"""
+    ProcCollector reads the system metrics straight from /proc.
+
+    The CPU percentages are relative to the previous call, like psutil with
+    interval=None.
+"""
+class ProcCollector():
+    def __init__(self, proc="/proc"):
+        self.stat = ProcFile(os.path.join(proc, "stat"))
+        self.meminfo = ProcFile(os.path.join(proc, "meminfo"))
+        self.net_dev = ProcFile(os.path.join(proc, "net/dev"))
+        self.diskstats = ProcFile(os.path.join(proc, "diskstats"))
+        self.mounts = ProcFile(os.path.join(proc, "self/mounts"))
+        self.proc = proc
+        self.mounts_data = None
+        self.partitions = []
+        # filesystems without a block device (proc, tmpfs, cgroup...) are not reported
+        with open(os.path.join(proc, "filesystems")) as filesystems:
+            self.fstypes = set(line.split()[0] for line in filesystems if line.strip() and not line.startswith("nodev"))
+        self.fstypes.add("zfs")
+        self.last_cpu = self.cpu_times()
+
+    def cpu_times(self):
+        # the aggregated "cpu" line comes first, the rest of /proc/stat is not needed
+        line = self.stat.read(CPU_LINE_SIZE).split("\n", 1)[0]
+        values = [float(v) for v in line.split()[1:]]
+        values += [0.0] * (len(scputimes._fields) - len(values))
+        return scputimes(*values[:len(scputimes._fields)])
+
+    def cpu(self):
+        "(cpu_percent, cpu_times_percent) since the previous call, from one read."
+        times = self.cpu_times()
+        last = self.last_cpu
+        self.last_cpu = times
+        total = total_time(times) - total_time(last)
+        return (busy_percent(times, last),
+                scputimes(*[min(100.0, max(0.0, percent(now - before, total))) for now, before in zip(times, last)]))
+
+    def memory(self):
+        "(virtual_memory, swap_memory) from one read of /proc/meminfo."
+        mem = dict((name, int(value) * 1024) for name, value in MEMINFO_LINE.findall(self.meminfo.read()))
+        return self.virtual_memory(mem), self.swap_memory(mem)
+
+    def virtual_memory(self, mem):
+        total = mem["MemTotal"]
+        free = mem["MemFree"]
+        buffers = mem.get("Buffers", 0)
+        cached = mem.get("Cached", 0) + mem.get("SReclaimable", 0)
+        available = mem.get("MemAvailable", free + buffers + cached)
+        used = total - free - cached - buffers
+        if used < 0:
+            used = total - free
+        return svmem(total, available, percent(total - available, total), used, free,
+                     mem.get("Active", 0), mem.get("Inactive", 0), buffers, cached, mem.get("Shmem", 0))
+
+    def swap_memory(self, mem):
+        total = mem.get("SwapTotal", 0)
+        free = mem.get("SwapFree", 0)
+        return sswap(total, total - free, free, percent(total - free, total))
+
+    def net_io_counters(self):
+        "Per interface counters, like psutil.net_io_counters(pernic=True)."
+        counters = {}
+        for fields in NET_DEV_LINE.findall(self.net_dev.read()):
+            v = [int(value) for value in fields[1:]]
+            counters[fields[0]] = snetio(v[8], v[0], v[9], v[1], v[2], v[10], v[3], v[11])
+        return counters
+
+    def disk_io_counters(self):
+        "Per disk counters, like psutil.disk_io_counters(perdisk=True)."
+        counters = {}
+        for fields in DISKSTATS_LINE.findall(self.diskstats.read()):
+            v = [int(value) for value in fields[1:]]
+            counters[fields[0]] = sdiskio(v[0], v[4], v[2] * SECTOR_SIZE, v[6] * SECTOR_SIZE,
+                                          v[3], v[7], v[1], v[5], v[9])
+        return counters
+
+    def disk_usage(self, path):
+        st = os.statvfs(path)
+        total = st.f_blocks * st.f_frsize
+        free = st.f_bavail * st.f_frsize
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        return sdiskusage(total, used, free, percent(used, used + free))
+
+    def disk_partitions(self):
+        "Mounted block device filesystems, like psutil.disk_partitions(); parsed again only when the mounts change."
+        data = self.mounts.read()
+        if data != self.mounts_data:
+            self.mounts_data = data
+            partitions = []
+            for line in data.splitlines():
+                fields = line.split()
+                if len(fields) < 4 or fields[2] not in self.fstypes or fields[0] == "none":
+                    continue
+                fields = [MOUNT_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field) for field in fields[:4]]
+                partitions.append(sdiskpart(*fields))
+            self.partitions = partitions
+        return self.partitions
+
+    def process_count(self):
+        # /proc/loadavg counts threads, not processes
+        return sum(1 for name in os.listdir(self.proc) if name.isdigit())
+
+    def close(self):
+        for proc_file in [self.stat, self.meminfo, self.net_dev, self.diskstats, self.mounts]:
+            proc_file.close()
+
+
+"""
+    PsutilCollector is the psutil backend, with the ProcCollector interface.
+"""
+class PsutilCollector():
+    def __init__(self):
+        import psutil
+        self.psutil = psutil
+
+    def cpu_times(self):
+        return self.psutil.cpu_times()
+
+    def cpu(self):
+        return self.psutil.cpu_percent(interval=None), self.psutil.cpu_times_percent(interval=None)
+
+    def memory(self):
+        return self.psutil.virtual_memory(), self.psutil.swap_memory()
+
+    def net_io_counters(self):
+        return self.psutil.net_io_counters(pernic=True)
+
+    def disk_io_counters(self):
+        return self.psutil.disk_io_counters(perdisk=True)
+
+    def disk_usage(self, path):
+        return self.psutil.disk_usage(path)
+
+    def disk_partitions(self):
+        return self.psutil.disk_partitions(all=False)
+
+    def process_count(self):
+        return len(self.psutil.pids())
+
+    def close(self):
+        pass
+
+
+COLLECTORS = {"psutil": PsutilCollector, "proc": ProcCollector}
+
+
+def create_collector(name):
+    if name not in COLLECTORS:
+        raise ValueError("unknown collector: {}".format(name))
+    return COLLECTORS[name]()
+
+
+def tick(collector, paths):
+    "What SystemReporter.collect() reads every tick."
+    return (collector.net_io_counters(), collector.cpu(), collector.memory(),
+            [collector.disk_usage(p) for p in paths], collector.disk_io_counters(), collector.process_count())
+
+
+def bench(ticks, paths):
+    "Per-tick CPU time and objects kept by the result of each backend."
+    for name in sorted(COLLECTORS):
+        collector = create_collector(name)
+        tick(collector, paths)
+
+        start = os.times()
+        for _ in xrange(ticks):
+            tick(collector, paths)
+        end = os.times()
+        cpu = (end[0] - start[0]) + (end[1] - start[1])
+
+        # gc counts the container objects (tuples, lists, dicts...) still allocated
+        gc.collect()
+        gc.disable()
+        kept = 0
+        for _ in xrange(min(ticks, 100)):
+            before = gc.get_count()[0]
+            result = tick(collector, paths)
+            kept += gc.get_count()[0] - before
+            del result
+        gc.enable()
+        collector.close()
+
+        print "{:<8} {:>10.1f} us/tick CPU {:>10.0f} objects kept/tick".format(
+            name, cpu * 1e6 / ticks, kept / float(min(ticks, 100)))
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, ["/", "/tmp"])
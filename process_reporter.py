@@ -0,0 +1,56 @@
+"""
+Process reporter plugin: the processes using the most CPU, memory and disk
+I/O (Linux only).
+
+Options, in [general]: topProcesses (0 disables the reporter) and
+processBudgetMs, the CPU time a tick may spend reading /proc.
+"""
+
+import os
+
+from process_table import ProcessTable, BUDGET, TOP
+from reporter import AReporter
+from send_queue import QUEUE_SIZE, DROP_OLDEST, REPLAY_RATE
+
+
+"""
+    ProcessReporter reports the processes using the most CPU, memory and
+    disk I/O, from a ProcessTable updated within `budget` seconds per tick.
+"""
+class ProcessReporter(AReporter):
+
+    def __init__(self, syslog_host, syslog_hostname, syslog_port, interval, top=TOP, budget=BUDGET, transport=None,
+                 queue_size=QUEUE_SIZE, overflow=DROP_OLDEST, spool=None, replay_rate=REPLAY_RATE):
+        super(ProcessReporter, self).__init__("monitoring-agent-processes", syslog_host, syslog_hostname, syslog_port, interval,
+                                              transport, queue_size, overflow, spool, replay_rate)
+        self.top = top
+        self.table = ProcessTable(budget=budget)
+
+    def collect_cost(self):
+        # the scan stops when its budget is spent
+        return self.table.budget
+
+    def collect(self):
+        super(ProcessReporter, self).collect()
+        self.table.update()
+
+    def process(self):
+        top = self.table.top(self.top)
+        top["scan"] = self.table.counters()
+        return {"top_processes": top}
+
+
+def create_reporter(context):
+    config = context.config
+    top_processes = TOP
+    budget = BUDGET
+    if config.has_option("general", "topProcesses"):
+        top_processes = config.getint('general', 'topProcesses')
+    if config.has_option("general", "processBudgetMs"):
+        budget = config.getint('general', 'processBudgetMs') / 1000.0
+    if top_processes <= 0 or not os.path.isdir("/proc"):
+        return None
+    # the top processes are not worth replaying, they do not use the spool
+    return ProcessReporter(context.syslog_host, context.syslog_hostname, context.syslog_port, context.interval_for("process"),
+                           top_processes, budget, context.transport(), context.queue_size, context.overflow_for(None),
+                           None, context.replay_rate)
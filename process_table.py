@@ -0,0 +1,197 @@
+"""
+Incremental process table for the per-process top-N reporter.
+
+Reading every /proc/<pid>/stat on every tick costs more than the rest of the
+agent on a host with thousands of processes, most of them idle. ProcessTable
+keeps one entry per pid across ticks (name, start time, CPU time baseline,
+last readings) and, within a per-tick time budget, rereads:
+    - the new processes and the ones that used CPU since their last read
+    - then 1/IDLE_SWEEP of the idle ones, round robin, so each one is
+      reread at least every IDLE_SWEEP ticks when the budget allows
+The idle processes not reread keep their previous readings.
+Pid reuse is detected with the process start time.
+
+Usage: python process_table.py [ticks] [budget_ms] prints the cost of a tick
+and how many processes it reread.
+"""
+
+import collections
+import heapq
+import os
+import sys
+import time
+
+from meters import monotonic
+
+
+BUDGET = 0.01
+TOP = 5
+# the deadline is checked every CHECK_EVERY reads
+CHECK_EVERY = 16
+IDLE_SWEEP = 10
+CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+"""
+    ProcessEntry is the cached state of one pid.
+"""
+class ProcessEntry():
+    __slots__ = ["pid", "stat_path", "io_path", "name", "start", "cpu_time", "cpu_percent", "rss",
+                 "io_bytes", "io_rate", "read_at", "active"]
+
+    def __init__(self, pid, proc):
+        self.pid = pid
+        self.stat_path = os.path.join(proc, str(pid), "stat")
+        self.io_path = os.path.join(proc, str(pid), "io")
+        self.name = None
+        self.start = None
+        self.cpu_time = 0.0
+        self.cpu_percent = 0.0
+        self.rss = 0
+        # None when /proc/<pid>/io cannot be read (other user without root)
+        self.io_bytes = None
+        self.io_rate = 0.0
+        self.read_at = None
+        self.active = True
+
+    def read(self, now):
+        "Reread the process, False when it is gone."
+        try:
+            with open(self.stat_path, 'rb') as stat_file:
+                data = stat_file.read()
+        except (IOError, OSError):
+            return False
+        # the name can hold spaces and parentheses
+        name_end = data.rfind(")")
+        fields = data[name_end + 2:].split()
+        start = fields[19]
+        cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        io_bytes = self.read_io() if self.io_bytes is not None or self.read_at is None else None
+
+        if start != self.start:
+            # new process, or a new one reusing the pid
+            self.name = data[data.find("(") + 1:name_end]
+            self.start = start
+            self.cpu_percent = 0.0
+            self.io_rate = 0.0
+        elif now > self.read_at:
+            elapsed = now - self.read_at
+            self.cpu_percent = round(max(0.0, cpu_time - self.cpu_time) * 100.0 / elapsed, 1)
+            if io_bytes is not None and self.io_bytes is not None:
+                self.io_rate = round(max(0, io_bytes - self.io_bytes) / elapsed, 1)
+        self.active = cpu_time != self.cpu_time or self.read_at is None
+        self.cpu_time = cpu_time
+        self.rss = int(fields[21]) * PAGE_SIZE
+        self.io_bytes = io_bytes
+        self.read_at = now
+        return True
+
+    def read_io(self):
+        try:
+            with open(self.io_path, 'rb') as io_file:
+                data = io_file.read()
+        except (IOError, OSError):
+            return None
+        total = 0
+        for line in data.splitlines():
+            if line.startswith("read_bytes:") or line.startswith("write_bytes:"):
+                total += int(line.split()[1])
+        return total
+
+    def as_dict(self):
+        return {"pid": self.pid, "name": self.name, "cpu_percent": self.cpu_percent, "rss": self.rss,
+                "io_bytes_per_sec": self.io_rate}
+
+
+"""
+    ProcessTable is the pid -> ProcessEntry table, updated incrementally
+    within `budget` seconds per update().
+"""
+class ProcessTable():
+    def __init__(self, proc="/proc", budget=BUDGET):
+        self.proc = proc
+        self.budget = budget
+        self.entries = {}
+        self.idle = collections.deque()
+
+        self.reread = 0
+        self.skipped = 0
+        self.took = 0.0
+
+    def update(self):
+        start = monotonic()
+        deadline = start + self.budget
+        pids = set(int(name) for name in os.listdir(self.proc) if name.isdigit())
+
+        for pid in [pid for pid in self.entries if pid not in pids]:
+            del self.entries[pid]
+        for pid in pids:
+            if pid not in self.entries:
+                self.entries[pid] = ProcessEntry(pid, self.proc)
+
+        active = [entry for entry in self.entries.itervalues() if entry.active]
+        if not self.idle:
+            self.idle.extend(entry.pid for entry in self.entries.itervalues() if not entry.active)
+
+        reread = 0
+        now = monotonic()
+        for entry in active:
+            if not entry.read(now):
+                del self.entries[entry.pid]
+            reread += 1
+            if reread % CHECK_EVERY == 0:
+                now = monotonic()
+                if now > deadline:
+                    break
+        quota = -(-(len(self.entries) - len(active)) // IDLE_SWEEP)
+        while self.idle and quota > 0 and now <= deadline:
+            entry = self.entries.get(self.idle.popleft())
+            if entry is None or entry.active:
+                continue
+            if not entry.read(now):
+                del self.entries[entry.pid]
+            reread += 1
+            quota -= 1
+            if reread % CHECK_EVERY == 0:
+                now = monotonic()
+
+        self.reread = reread
+        self.skipped = len(self.entries) - reread
+        self.took = monotonic() - start
+
+    def top(self, count=TOP):
+        "The `count` processes using the most CPU, memory and disk I/O."
+        entries = self.entries.values()
+        return {
+            "cpu": [e.as_dict() for e in heapq.nlargest(count, entries, key=lambda e: e.cpu_percent)],
+            "rss": [e.as_dict() for e in heapq.nlargest(count, entries, key=lambda e: e.rss)],
+            "io": [e.as_dict() for e in heapq.nlargest(count, entries, key=lambda e: e.io_rate)],
+        }
+
+    def counters(self):
+        return {"total": len(self.entries), "reread": self.reread, "skipped": self.skipped,
+                "took_ms": round(self.took * 1000, 2)}
+
+
+def bench(ticks, budget):
+    "Cost of a full scan, then of the incremental updates."
+    table = ProcessTable(budget=float("inf"))
+    table.update()
+    print "first scan: {} processes in {:.2f} ms".format(len(table.entries), table.took * 1000)
+
+    table.budget = budget
+    took = []
+    reread = []
+    for _ in xrange(ticks):
+        time.sleep(0.05)
+        table.update()
+        took.append(table.took)
+        reread.append(table.reread)
+    print "incremental: {:.2f} ms/tick (max {:.2f}), {:.0f} processes reread/tick".format(
+        sum(took) * 1000 / ticks, max(took) * 1000, sum(reread) / float(ticks))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    bench(int(args[0]) if args else 20, float(args[1]) / 1000 if len(args) > 1 else BUDGET)
@@ -10,10 +10,113 @@ For more information, see RFC 3164.
 """
 
 import socket
-import json
-import datetime
+import argparse
+import sys
+import time
 from time import sleep
 
+from stats_input import iter_raw_documents
+from syslog_transport import PROTOCOLS, SyslogHeaders, create_transport, parse_addresses, stamp_document
+
+
+JSON_FILE = 'stats.json'
+HOST = '52.169.115.99'
+PORT = 5140
+NHOSTS = 1
+RATE = 1000
+REPORT_INTERVAL = 5
+
+
+parser = argparse.ArgumentParser(__file__,
+                                 description="Syslog replay of JSON stats documents")
+
+parser.add_argument("--input",
+                    "-i",
+                    dest="input",
+                    default=JSON_FILE,
+                    help="JSON array or JSON lines (optionally .gz/.zst) file to replay")
+
+parser.add_argument("--host",
+                    dest="host",
+                    default=HOST,
+                    help="The syslog server, or a comma separated list of servers (host[:port]) to spread the messages over")
+
+parser.add_argument("--port",
+                    "-p",
+                    dest="port",
+                    type=int,
+                    default=PORT,
+                    help="The syslog server port")
+
+parser.add_argument("--protocol",
+                    dest="protocol",
+                    choices=PROTOCOLS,
+                    default="udp",
+                    help="udp, tcp (octet counted framing) or tcp-newline")
+
+parser.add_argument("--rate",
+                    "-r",
+                    dest="rate",
+                    type=float,
+                    default=RATE,
+                    help="Target messages per second (0 sends as fast as possible)")
+
+parser.add_argument("--burst",
+                    "-b",
+                    dest="burst",
+                    type=int,
+                    default=0,
+                    help="Token bucket size, the largest burst sent back to back (default: rate / 100)")
+
+parser.add_argument("--nhosts",
+                    "-c",
+                    dest="nhosts",
+                    type=int,
+                    default=NHOSTS,
+                    help="Number of simulated hostname{n} identities the messages are spread over")
+
+parser.add_argument("--count",
+                    "-n",
+                    dest="count",
+                    type=int,
+                    default=0,
+                    help="Stop after this many messages (0 replays the input once, or forever with --loop)")
+
+parser.add_argument("--loop",
+                    "-l",
+                    dest="loop",
+                    action="store_true",
+                    help="Start the input over when it is exhausted")
+
+parser.add_argument("--report",
+                    dest="report",
+                    type=float,
+                    default=REPORT_INTERVAL,
+                    help="Seconds between rate reports")
+
+parser.add_argument("--batch",
+                    dest="batch",
+                    type=int,
+                    default=1,
+                    help="Messages sent per sendmmsg() call or TCP write (1 sends each message on its own)")
+
+parser.add_argument("--linger",
+                    dest="linger",
+                    type=float,
+                    default=50,
+                    help="Longest time in ms a message waits for its batch to fill")
+
+parser.add_argument("--stamp",
+                    dest="stamp",
+                    action="store_true",
+                    help="Add a per-host sequence number (_seq) and the send time (_ts) to every document, for syslog_receiver.py")
+
+parser.add_argument("--verbose",
+                    "-v",
+                    dest="verbose",
+                    action="store_true",
+                    help="Print every message sent")
+
 
 class Facility:
   "Syslog facilities"
@@ -34,26 +137,114 @@ class Syslog:
   def __init__(self,
     host="52.169.115.99",
     port=5140,
-    facility=Facility.USER):
-    self.host = host
-    self.port = port
+    facility=Facility.USER,
+    echo=True,
+    batch_size=1,
+    linger=0.05,
+    protocol="udp"):
+    addresses = parse_addresses(host, port)
+    self.host, self.port = addresses[0]
     self.facility = facility
+    self.echo = echo
     self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.headers = SyslogHeaders("monitoring-agent", "hostname{}")
+    self.transport = None
+    if protocol != "udp" or batch_size > 1 or len(addresses) > 1:
+      self.transport = create_transport(protocol, addresses, batch_size, linger)
 
   def send(self, message, level, hostnumber):
-    "Send a syslog message to remote host using UDP."
-    data = "<%d>%s %s %s" % (level + self.facility*8, datetime.datetime.now().strftime("%b %d %H:%M:%S"), "hostname{}".format(hostnumber), "monitoring-agent: "+message)
-    self.socket.sendto(data, (self.host, self.port))
-    print data
+    "Send a syslog message to remote host."
+    data = self.headers.get(level + self.facility*8, hostnumber) + message
+    if self.transport is not None:
+      self.transport.send(data)
+    else:
+      self.socket.sendto(data, (self.host, self.port))
+    if self.echo:
+      print data
 
-if __name__ == "__main__":
-    log = Syslog()
-    with open('stats.json') as data_file:
-        data = json.load(data_file)
+  def flush(self):
+    if self.transport is not None:
+      self.transport.flush()
+
+  def close(self):
+    if self.transport is not None:
+      self.transport.close()
 
-    serialized_data = json.dumps(data[0])
+class TokenBucket:
+  """Rate limiter: `rate` tokens per second are added to a bucket holding
+  at most `burst` of them, and every message takes one.
+  """
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.capacity = float(max(burst, 1))
+    self.tokens = self.capacity
+    self.last = time.time()
+
+  def take(self, n=1):
+    "Wait until `n` tokens are available and take them."
+    while True:
+      now = time.time()
+      self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      if self.tokens >= n:
+        self.tokens -= n
+        return
+      sleep((n - self.tokens) / self.rate)
+
+def documents(path, loop):
+  "Stream the raw documents of `path`, over and over with `loop`."
+  while True:
+    empty = True
+    for document in iter_raw_documents(path):
+      empty = False
+      yield document
+    if not loop or empty:
+      return
+
+def report(sent, elapsed, target):
+  rate = sent / elapsed if elapsed > 0 else 0.0
+  if target:
+    print "sent {} messages in {:.1f}s: {:.0f} msg/s, target {:.0f} msg/s ({:.1f}%)".format(sent, elapsed, rate, target, rate * 100 / target)
+  else:
+    print "sent {} messages in {:.1f}s: {:.0f} msg/s, unthrottled".format(sent, elapsed, rate)
+  sys.stdout.flush()
 
-    log.send(serialized_data, Level.INFO, 0)
+def replay(args):
+  log = Syslog(args.host, args.port, echo=args.verbose, batch_size=args.batch, linger=args.linger / 1000.0, protocol=args.protocol)
+  bucket = None
+  if args.rate > 0:
+    bucket = TokenBucket(args.rate, args.burst or max(1, int(args.rate / 100)))
+
+  seqs = [0] * args.nhosts
+  sent = 0
+  start = time.time()
+  next_report = start + args.report
+  try:
+    for document in documents(args.input, args.loop):
+      if bucket is not None:
+        bucket.take()
+      host = sent % args.nhosts
+      if args.stamp and document.startswith("{"):
+        seqs[host] += 1
+        document = stamp_document(document, seqs[host], time.time())
+      log.send(document, Level.INFO, host)
+      sent += 1
+      if sent == args.count:
+        break
+      if args.report > 0 and sent % 256 == 0:
+        now = time.time()
+        if now >= next_report:
+          report(sent, now - start, args.rate)
+          next_report = now + args.report
+  except KeyboardInterrupt:
+    pass
+  log.flush()
+  log.close()
+  report(sent, time.time() - start, args.rate)
+  return sent
+
+if __name__ == "__main__":
+    replay(parser.parse_args())
 
 
 
@@ -5,6 +5,8 @@ import time
 import math
 import sys
 
+from stats_output import open_writer
+
 
 def time_in_ms():
     return long(math.floor(time.time() * 1000))
@@ -38,19 +40,57 @@ class SimpleMeter():
         self.last = self.type(value)
         return self.last
 
+def write_numpy(ndata, paths, snapshot, writer, scenario_file=None):
+    import stats_engine
+
+    seed = random.randint(0, 2 ** 31)
+    # one chunk of documents in memory at a time
+    chunk = min(ndata, stats_engine.RENDER_DOCS)
+    host_json = None
+    if scenario_file is not None:
+        # the first host of the scenario, one document every 10 seconds from now
+        import scenario
+        fleets = scenario.load_scenario(scenario_file, snapshot, paths, time.time(), 10, seed)
+        template = stats_engine.build_template(fleets.nested_pairs())
+        host_json = dict((name, [json.dumps(value) for value in values])
+                         for name, values in fleets.host_values([0]).items())
+        generated = fleets.series([0], ndata, chunk)
+    else:
+        template = stats_engine.nested_template(snapshot, paths, "40.471032,-3.686893", 'M', 'Madrid', 'Vasconcelos')
+        generated = stats_engine.series(snapshot, [seed], ndata, chunk)
+    for t0, columns in generated:
+        writer.write_lines(stats_engine.render(template, columns, host_json))
+
 def main(argv):
 
-    if len(argv) == 2:
+    if len(argv) >= 2:
         ndata = int(argv[1])
     else:
         ndata = 100
 
+    # python (one document at a time) or numpy (vectorized engine)
+    if len(argv) >= 3:
+        engine = argv[2]
+    else:
+        engine = "python"
+
+    # a JSON array, or JSON lines when the name ends with .jsonl
+    if len(argv) >= 4:
+        output = argv[3]
+    else:
+        output = 'stats.json'
+
+    # numpy engine: the series of a scenario file (see scenario.py) instead of random walks
+    if len(argv) >= 5:
+        scenario_file = argv[4]
+    else:
+        scenario_file = None
+
     paths = []
     paths.append({"name": "root", "path": "/"})
     paths.append({"name": "opt", "path": "/opt"})
     paths.append({"name": "tmp", "path": "/tmp"})
 
-    message = []
     measures = {}
 
     io_data = psutil.net_io_counters(pernic=True)
@@ -62,6 +102,23 @@ def main(argv):
     io_disk_data = psutil.disk_io_counters(perdisk=True)
     process_data = len(psutil.pids())
 
+    if engine == "numpy":
+        writer = open_writer(output)
+        try:
+            write_numpy(ndata, paths, {
+                "io_data": dict((k, v._asdict()) for k, v in io_data.items()),
+                "cpu_percent_data": cpu_percent_data,
+                "cpu_times_percent_data": cpu_times_percent_data._asdict(),
+                "mem_virtual_data": mem_virtual_data._asdict(),
+                "mem_swap_data": mem_swap_data._asdict(),
+                "paths_data": [p._asdict() for p in paths_data],
+                "io_disk_data": dict((k, v._asdict()) for k, v in io_disk_data.items()),
+                "process_data": process_data,
+            }, writer, scenario_file)
+        finally:
+            writer.close()
+        return
+
     measures["cpu"] = SimpleMeter(float, cpu_percent_data)
     measures["cpu.user"] = SimpleMeter(float, cpu_times_percent_data.user)
     measures["cpu.system"] = SimpleMeter(float, cpu_times_percent_data.system)
@@ -116,134 +173,137 @@ def main(argv):
 
     mem_virtual_data_used = mem_virtual_data.used
 
-    for i in range(ndata):
-
-        cpu_percent_data = max(min(round(random.uniform(-5, 5) + cpu_percent_data, 1), 100), 0.1)
-        cpu_percent_json = measures["cpu"].update_and_get(cpu_percent_data)
-        cpu_times_percent_json = {
-            "user": measures["cpu.user"].update_and_get(cpu_times_percent_data.user),
-            "system": measures["cpu.system"].update_and_get(cpu_times_percent_data.system),
-            "idle": measures["cpu.idle"].update_and_get(cpu_times_percent_data.idle),
-            "nice": measures["cpu.nice"].update_and_get(cpu_times_percent_data.nice),
-            "irq": measures["cpu.user"].update_and_get(cpu_times_percent_data.irq),
-            "softirq": measures["cpu.user"].update_and_get(cpu_times_percent_data.softirq),
-            "iowait": measures["cpu.user"].update_and_get(cpu_times_percent_data.iowait),
-            "steal": measures["cpu.user"].update_and_get(cpu_times_percent_data.steal),
-        }
-
-        mem_virtual_data_used = max(min(random.randint(-5000, 5000) + mem_virtual_data_used, mem_virtual_data.total), 0)
-        mem_virtual_data_free = min(mem_virtual_data.total - mem_virtual_data.cached - mem_virtual_data_used, 0)
-        mem_json = {
-            "virtual": {
-                "total": measures["mem.virtual.total"].update_and_get(mem_virtual_data.total),
-                "used": measures["mem.virtual.used"].update_and_get(mem_virtual_data.used),
-                "cached": measures["mem.virtual.cached"].update_and_get(mem_virtual_data.cached),
-                "free": measures["mem.virtual.free"].update_and_get(mem_virtual_data_free),
-                "available": measures["mem.virtual.available"].update_and_get(mem_virtual_data.available),
-                "percent": measures["mem.virtual.percent"].update_and_get(mem_virtual_data.percent),
-                "active": measures["mem.virtual.active"].update_and_get(mem_virtual_data.active),
-                "inactive": measures["mem.virtual.inactive"].update_and_get(mem_virtual_data.inactive),
-                "buffers": measures["mem.virtual.buffers"].update_and_get(mem_virtual_data.buffers),
-                "shared": measures["mem.virtual.shared"].update_and_get(mem_virtual_data.shared),
-            },
-            "swap": {
-                "total": measures["mem.swap.total"].update_and_get(mem_swap_data.total),
-                "used": measures["mem.swap.used"].update_and_get(mem_swap_data.used),
-                "free": measures["mem.swap.free"].update_and_get(mem_swap_data.free),
-                "percent": measures["mem.swap.percent"].update_and_get(mem_swap_data.percent),
+    # the documents are written as they are generated, and the output is
+    # closed (a valid JSON array of what was written) even on an error
+    writer = open_writer(output)
+    try:
+        for i in range(ndata):
+
+            cpu_percent_data = max(min(round(random.uniform(-5, 5) + cpu_percent_data, 1), 100), 0.1)
+            cpu_percent_json = measures["cpu"].update_and_get(cpu_percent_data)
+            cpu_times_percent_json = {
+                "user": measures["cpu.user"].update_and_get(cpu_times_percent_data.user),
+                "system": measures["cpu.system"].update_and_get(cpu_times_percent_data.system),
+                "idle": measures["cpu.idle"].update_and_get(cpu_times_percent_data.idle),
+                "nice": measures["cpu.nice"].update_and_get(cpu_times_percent_data.nice),
+                "irq": measures["cpu.user"].update_and_get(cpu_times_percent_data.irq),
+                "softirq": measures["cpu.user"].update_and_get(cpu_times_percent_data.softirq),
+                "iowait": measures["cpu.user"].update_and_get(cpu_times_percent_data.iowait),
+                "steal": measures["cpu.user"].update_and_get(cpu_times_percent_data.steal),
             }
-        }
-
-        io_json = []
-        for k in io_data:
-            if k == 'enp0s25':
-                io_json = [{
-                    "name": k,
-                    "bytes_sent": measures[k + ".bytes_sent"].update_and_get(random.randint(0, 90000)),
-                    "bytes_recv": measures[k + ".bytes_recv"].update_and_get(random.randint(0, 90000)),
-                    "packets_sent": measures[k + ".packets_sent"].update_and_get(random.randint(0, 1000)),
-                    "packets_recv": measures[k + ".packets_recv"].update_and_get(random.randint(0, 1000)),
-                }]
-        paths_json = []
-        for idx, p in enumerate(paths):
-            current_path = paths[idx]
-            current_path_data = paths_data[idx]
-
-            path_name = current_path["name"]
-            path = current_path["path"]
-            paths_json.append({
-                "name": path_name,
-                "path": path,
-                "total": measures[path_name + ".total"].update_and_get(current_path_data.total),
-                "used": measures[path_name + ".used"].update_and_get(current_path_data.used),
-                "free": measures[path_name + ".free"].update_and_get(current_path_data.free),
-                "percent": measures[path_name + ".percent"].update_and_get(current_path_data.percent)
+
+            mem_virtual_data_used = max(min(random.randint(-5000, 5000) + mem_virtual_data_used, mem_virtual_data.total), 0)
+            mem_virtual_data_free = min(mem_virtual_data.total - mem_virtual_data.cached - mem_virtual_data_used, 0)
+            mem_json = {
+                "virtual": {
+                    "total": measures["mem.virtual.total"].update_and_get(mem_virtual_data.total),
+                    "used": measures["mem.virtual.used"].update_and_get(mem_virtual_data.used),
+                    "cached": measures["mem.virtual.cached"].update_and_get(mem_virtual_data.cached),
+                    "free": measures["mem.virtual.free"].update_and_get(mem_virtual_data_free),
+                    "available": measures["mem.virtual.available"].update_and_get(mem_virtual_data.available),
+                    "percent": measures["mem.virtual.percent"].update_and_get(mem_virtual_data.percent),
+                    "active": measures["mem.virtual.active"].update_and_get(mem_virtual_data.active),
+                    "inactive": measures["mem.virtual.inactive"].update_and_get(mem_virtual_data.inactive),
+                    "buffers": measures["mem.virtual.buffers"].update_and_get(mem_virtual_data.buffers),
+                    "shared": measures["mem.virtual.shared"].update_and_get(mem_virtual_data.shared),
+                },
+                "swap": {
+                    "total": measures["mem.swap.total"].update_and_get(mem_swap_data.total),
+                    "used": measures["mem.swap.used"].update_and_get(mem_swap_data.used),
+                    "free": measures["mem.swap.free"].update_and_get(mem_swap_data.free),
+                    "percent": measures["mem.swap.percent"].update_and_get(mem_swap_data.percent),
+                }
+            }
+
+            io_json = []
+            for k in io_data:
+                if k == 'enp0s25':
+                    io_json = [{
+                        "name": k,
+                        "bytes_sent": measures[k + ".bytes_sent"].update_and_get(random.randint(0, 90000)),
+                        "bytes_recv": measures[k + ".bytes_recv"].update_and_get(random.randint(0, 90000)),
+                        "packets_sent": measures[k + ".packets_sent"].update_and_get(random.randint(0, 1000)),
+                        "packets_recv": measures[k + ".packets_recv"].update_and_get(random.randint(0, 1000)),
+                    }]
+            paths_json = []
+            for idx, p in enumerate(paths):
+                current_path = paths[idx]
+                current_path_data = paths_data[idx]
+
+                path_name = current_path["name"]
+                path = current_path["path"]
+                paths_json.append({
+                    "name": path_name,
+                    "path": path,
+                    "total": measures[path_name + ".total"].update_and_get(current_path_data.total),
+                    "used": measures[path_name + ".used"].update_and_get(current_path_data.used),
+                    "free": measures[path_name + ".free"].update_and_get(current_path_data.free),
+                    "percent": measures[path_name + ".percent"].update_and_get(current_path_data.percent)
+                })
+            io_disk_json = []
+            for k in io_disk_data:
+                if k == 'sda6':
+                    io_disk_json = [{
+                        "disk_id": k,
+                        "read_count": measures[k + ".read_count"].update_and_get(io_disk_data[k].read_count),
+                        "write_count": measures[k + ".write_count"].update_and_get(io_disk_data[k].write_count),
+                        "read_bytes": measures[k + ".read_bytes"].update_and_get(random.randint(0, 90000)),
+                        "write_bytes": measures[k + ".write_bytes"].update_and_get(random.randint(0, 90000)),
+                        "read_time": measures[k + ".read_time"].update_and_get(io_disk_data[k].read_time),
+                        "write_time": measures[k + ".write_time"].update_and_get(io_disk_data[k].write_time)
+                    }]
+            process_json = measures["process"].update_and_get(max(min(random.randint(-20, 20) + process_data, 1000), 0))
+
+            # store_id = random.randint(0,2)
+            store_id = 0
+
+            if (store_id == 0):
+                latitude = 40.471032
+                longitude = -3.686893
+                province = 'M'
+                city = 'Madrid'
+                store = 'Vasconcelos'
+
+            if (store_id == 1):
+                latitude = 39.469215
+                longitude = -0.373368
+                province = 'V'
+                city = 'Valencia'
+                store = 'Lloria'
+
+            if (store_id == 2):
+                latitude = 43.262437
+                longitude = -2.907181
+                province = 'BI'
+                city = 'Bilbao'
+                store = 'Zumarkalea'
+
+            location = "{},{}".format(latitude, longitude)
+
+            io_disk = io_disk_json.pop()
+            io_net = io_json.pop()
+            path1 = paths_json.pop()
+            path2 = paths_json.pop()
+            path3 = paths_json.pop()
+
+            writer.write({
+                "cpu": cpu_percent_json,
+                "cpu_times": cpu_times_percent_json,
+                "mem": mem_json,
+                "disk0": path1,
+                "disk1": path2,
+                "disk2": path3,
+                "io_disk": io_disk,
+                "network": io_net,
+                "processes": process_json,
+                "location": location,
+                "province": province,
+                "city": city,
+                "store": store
             })
-        io_disk_json = []
-        for k in io_disk_data:
-            if k == 'sda6':
-                io_disk_json = [{
-                    "disk_id": k,
-                    "read_count": measures[k + ".read_count"].update_and_get(io_disk_data[k].read_count),
-                    "write_count": measures[k + ".write_count"].update_and_get(io_disk_data[k].write_count),
-                    "read_bytes": measures[k + ".read_bytes"].update_and_get(random.randint(0, 90000)),
-                    "write_bytes": measures[k + ".write_bytes"].update_and_get(random.randint(0, 90000)),
-                    "read_time": measures[k + ".read_time"].update_and_get(io_disk_data[k].read_time),
-                    "write_time": measures[k + ".write_time"].update_and_get(io_disk_data[k].write_time)
-                }]
-        process_json = measures["process"].update_and_get(max(min(random.randint(-20, 20) + process_data, 1000), 0))
-
-        # store_id = random.randint(0,2)
-        store_id = 0
-
-        if (store_id == 0):
-            latitude = 40.471032
-            longitude = -3.686893
-            province = 'M'
-            city = 'Madrid'
-            store = 'Vasconcelos'
-
-        if (store_id == 1):
-            latitude = 39.469215
-            longitude = -0.373368
-            province = 'V'
-            city = 'Valencia'
-            store = 'Lloria'
-
-        if (store_id == 2):
-            latitude = 43.262437
-            longitude = -2.907181
-            province = 'BI'
-            city = 'Bilbao'
-            store = 'Zumarkalea'
-
-        location = "{},{}".format(latitude, longitude)
-
-        io_disk = io_disk_json.pop()
-        io_net = io_json.pop()
-        path1 = paths_json.pop()
-        path2 = paths_json.pop()
-        path3 = paths_json.pop()
-
-        message.append({
-            "cpu": cpu_percent_json,
-            "cpu_times": cpu_times_percent_json,
-            "mem": mem_json,
-            "disk0": path1,
-            "disk1": path2,
-            "disk2": path3,
-            "io_disk": io_disk,
-            "network": io_net,
-            "processes": process_json,
-            "location": location,
-            "province": province,
-            "city": city,
-            "store": store
-        })
-        # sleep (0.005)
-
-    with open('stats.json', 'w') as outfile:
-        json.dump(message, outfile)
+            # sleep (0.005)
+    finally:
+        writer.close()
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -5,9 +5,15 @@ import time
 import math
 import sys
 import os
-import errno
 import argparse
 import datetime
+import heapq
+import multiprocessing
+import re
+
+from serialization import AUTO, BACKENDS, Serializer, TemplatedSerializer
+from stats_output import ShardedWriter, COMPRESSIONS, BATCH_SIZE, read_lines, silentremove
+from solr_output import SolrError, SolrWriter, CONCURRENCY, RETRIES, COMMIT_WITHIN
 
 
 JSON_FILE = 'stats.json'
@@ -17,6 +23,14 @@ NDATA = 10
 NHOST = 1
 INTERVAL = 10
 START_DATE = time.time()
+TEMPLATE = "template"
+# the fields of a python engine document that change from one document to the next, see serialization.py
+VARYING_FIELDS = ["cpu", "processes", "time", "mem_virtual_used", "mem_virtual_free",
+                  "io_disk_read_bytes", "io_disk_write_bytes", "network_bytes_recv", "network_bytes_sent",
+                  "network_packets_recv", "network_packets_sent"]
+# the sort key of a written document, whatever the key order and separators of the serializer
+TIME_KEY = re.compile(r'"time": ?"([^"]*)"')
+HOST_KEY = r'"host": ?"{}(\d+)"'
 
 
 parser = argparse.ArgumentParser(__file__,
@@ -69,13 +83,97 @@ parser.add_argument("--interval",
                     default=INTERVAL,
                     help="Interval between documents tiemstamp in seconds")
 
+parser.add_argument("--batch-size",
+                    "-b",
+                    dest="batch_size",
+                    type=int,
+                    default=BATCH_SIZE,
+                    help="Number of documents buffered in memory between writes")
+
+parser.add_argument("--compression",
+                    "-z",
+                    dest="compression",
+                    choices=COMPRESSIONS,
+                    default="none",
+                    help="Output compression")
+
+parser.add_argument("--shard-size",
+                    dest="shard_size",
+                    type=int,
+                    default=0,
+                    help="Rotate the output into <output>-NNNNNN.jsonl shards of this many MB (0 disables sharding)")
 
-def silentremove(filename):
-    try:
-        os.remove(filename)
-    except OSError as e:
-        if e.errno != errno.ENOENT: # errno.ENOENT = no such file or directory
-            raise # re-raise exception if a different error occured
+parser.add_argument("--workers",
+                    "-w",
+                    dest="workers",
+                    type=int,
+                    default=1,
+                    help="Number of worker processes. Each worker writes its hosts to <output>-wNNN")
+
+parser.add_argument("--merge",
+                    dest="merge",
+                    action="store_true",
+                    help="Merge the worker parts into one output ordered by time and host")
+
+parser.add_argument("--seed",
+                    dest="seed",
+                    type=int,
+                    default=None,
+                    help="Random seed. Same seed and snapshot give the same documents")
+
+parser.add_argument("--snapshot",
+                    dest="snapshot",
+                    default=None,
+                    help="JSON file with the initial host values. Created from this host if missing")
+
+parser.add_argument("--engine",
+                    "-e",
+                    dest="engine",
+                    choices=["python", "numpy"],
+                    default="python",
+                    help="Document generator: python (per document) or numpy (vectorized). Both write the documents "
+                         "ordered by time then host; the python engine used to write them host by host")
+
+parser.add_argument("--format",
+                    "-f",
+                    dest="format",
+                    choices=["jsonl", "npy", "npz"],
+                    default="jsonl",
+                    help="Output format: JSON lines, a directory of memory-mappable .npy columns, or a compressed .npz")
+
+parser.add_argument("--scenario",
+                    dest="scenario",
+                    default=None,
+                    help="Generate the fleets and incidents of this scenario file (see scenario.py) with the numpy engine; --nhost and --store come from the fleets")
+
+parser.add_argument("--solr",
+                    dest="solr",
+                    default=None,
+                    help="Index the documents straight into this Solr core (http://host:8983/solr/core), in --batch-size batches, instead of writing --output")
+
+parser.add_argument("--solr-concurrency",
+                    dest="solr_concurrency",
+                    type=int,
+                    default=CONCURRENCY,
+                    help="Batches in flight to Solr at once, per worker")
+
+parser.add_argument("--solr-retries",
+                    dest="solr_retries",
+                    type=int,
+                    default=RETRIES,
+                    help="Retries of a batch failing with a connection error or a 429/5xx status, with exponential backoff")
+
+parser.add_argument("--commit-within",
+                    dest="commit_within",
+                    type=int,
+                    default=COMMIT_WITHIN,
+                    help="Solr commitWithin of the batches in ms (0 leaves the commits to Solr)")
+
+parser.add_argument("--serializer",
+                    dest="serializer",
+                    choices=[TEMPLATE, AUTO] + BACKENDS,
+                    default=TEMPLATE,
+                    help="JSON serialization of the python engine documents: pre-encoded templates, or a JSON backend (auto picks the fastest installed)")
 
 
 def time_in_ms():
@@ -108,28 +206,87 @@ class SimpleMeter():
     def update_and_get(self, value):
         self.last = self.type(value)
         return self.last
+def store_location(store_id):
+    if (store_id == 0):
+        latitude = 40.471032
+        longitude = -3.686893
+        province = 'M'
+        city = 'Madrid'
+        store = 'Vasconcelos'
 
-def main(argv):
+    if (store_id == 1):
+        latitude = 39.469215
+        longitude = -0.373368
+        province = 'V'
+        city = 'Valencia'
+        store = 'Lloria'
 
-    args = parser.parse_args()
+    if (store_id == 2):
+        latitude = 43.262437
+        longitude = -2.907181
+        province = 'BI'
+        city = 'Bilbao'
+        store = 'Zumarkalea'
 
-    silentremove(args.output)
+    return latitude, longitude, province, city, store
 
-    paths = []
-    paths.append({"name": "root", "path": "/"})
-    paths.append({"name": "opt", "path": "/opt"})
-    paths.append({"name": "tmp", "path": "/tmp"})
+
+"""
+    Record gives attribute access to a snapshot entry, like the psutil named tuples do.
+"""
+class Record():
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def take_snapshot(paths):
+    "Read the host values every simulated host starts from, as plain (picklable, JSON-able) data."
+    return {
+        "io_data": dict((k, v._asdict()) for k, v in psutil.net_io_counters(pernic=True).items()),
+        "cpu_percent_data": psutil.cpu_percent(interval=None),
+        "cpu_times_percent_data": psutil.cpu_times_percent(interval=None)._asdict(),
+        "mem_virtual_data": psutil.virtual_memory()._asdict(),
+        "mem_swap_data": psutil.swap_memory()._asdict(),
+        "paths_data": [psutil.disk_usage(p["path"])._asdict() for p in paths],
+        "io_disk_data": dict((k, v._asdict()) for k, v in psutil.disk_io_counters(perdisk=True).items()),
+        "process_data": len(psutil.pids()),
+    }
+
+
+def load_snapshot(filename, paths):
+    "Reuse the snapshot stored in `filename` if any, so a seeded run can be replayed byte for byte."
+    if filename and os.path.exists(filename):
+        with open(filename) as snapshot_file:
+            return json.load(snapshot_file)
+    snapshot = take_snapshot(paths)
+    if filename:
+        with open(filename, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+    return snapshot
+
+
+def host_seed(seed, host):
+    return seed * 1000003 + host
+
+
+def documents(args, snapshot, paths, host, seed):
+    """
+    Generate the documents of one simulated host. Every host has its own RNG
+    and meter state, so its documents do not depend on how hosts are split
+    between workers.
+    """
+    rng = random.Random(host_seed(seed, host))
 
     measures = {}
 
-    io_data = psutil.net_io_counters(pernic=True)
-    cpu_percent_data = psutil.cpu_percent(interval=None)
-    cpu_times_percent_data = psutil.cpu_times_percent(interval=None)
-    mem_virtual_data = psutil.virtual_memory()
-    mem_swap_data = psutil.swap_memory()
-    paths_data = [psutil.disk_usage(p["path"]) for p in paths]
-    io_disk_data = psutil.disk_io_counters(perdisk=True)
-    process_data = len(psutil.pids())
+    io_data = dict((k, Record(v)) for k, v in snapshot["io_data"].items())
+    cpu_percent_data = snapshot["cpu_percent_data"]
+    cpu_times_percent_data = Record(snapshot["cpu_times_percent_data"])
+    mem_virtual_data = Record(snapshot["mem_virtual_data"])
+    mem_swap_data = Record(snapshot["mem_swap_data"])
+    paths_data = [Record(p) for p in snapshot["paths_data"]]
+    io_disk_data = dict((k, Record(v)) for k, v in snapshot["io_disk_data"].items())
+    process_data = snapshot["process_data"]
 
     measures["cpu"] = SimpleMeter(float, cpu_percent_data)
     measures["cpu.user"] = SimpleMeter(float, cpu_times_percent_data.user)
@@ -155,15 +312,13 @@ def main(argv):
     measures["mem.swap.free"] = SimpleMeter(long, mem_swap_data.free)
     measures["mem.swap.percent"] = SimpleMeter(float, mem_swap_data.percent)
 
-    network_interfaces = [ni for ni in psutil.net_io_counters(pernic=True)]
-    for network_interface in network_interfaces:
+    for network_interface in io_data:
         measures[network_interface + ".bytes_sent"] = DeltaMeter(io_data[network_interface].bytes_sent)
         measures[network_interface + ".bytes_recv"] = DeltaMeter(io_data[network_interface].bytes_recv)
         measures[network_interface + ".packets_sent"] = DeltaMeter(io_data[network_interface].packets_sent)
         measures[network_interface + ".packets_recv"] = DeltaMeter(io_data[network_interface].packets_recv)
 
-    disks = [disk for disk in psutil.disk_io_counters(perdisk=True)]
-    for disk in disks:
+    for disk in io_disk_data:
         measures[disk + ".read_count"] = DeltaMeter(io_disk_data[disk].read_count)
         measures[disk + ".write_count"] = DeltaMeter(io_disk_data[disk].write_count)
         measures[disk + ".read_bytes"] = DeltaMeter(io_disk_data[disk].read_bytes)
@@ -174,7 +329,6 @@ def main(argv):
     for idx, path_data in enumerate(paths_data):
         path = paths[idx]
         path_name = path["name"]
-        path_data = psutil.disk_usage(path["path"])
         measures[path_name + ".total"] = SimpleMeter(long, path_data.total)
         measures[path_name + ".used"] = SimpleMeter(long, path_data.used)
         measures[path_name + ".free"] = SimpleMeter(long, path_data.free)
@@ -182,267 +336,436 @@ def main(argv):
 
     measures["process"] = SimpleMeter(int, process_data)
 
+    latitude, longitude, province, city, store = store_location(args.store)
 
-    if (args.store == 0):
-        latitude = 40.471032
-        longitude = -3.686893
-        province = 'M'
-        city = 'Madrid'
-        store = 'Vasconcelos'
+    location = "{},{}".format(latitude, longitude)
 
-    if (args.store == 1):
-        latitude = 39.469215
-        longitude = -0.373368
-        province = 'V'
-        city = 'Valencia'
-        store = 'Lloria'
+    mem_virtual_data_used = mem_virtual_data.used
 
-    if (args.store == 2):
-        latitude = 43.262437
-        longitude = -2.907181
-        province = 'BI'
-        city = 'Bilbao'
-        store = 'Zumarkalea'
+    for doc in range(args.ndata):
+
+        cpu_percent_data = max(min(round(rng.uniform(-5, 5) + cpu_percent_data, 1), 100), 0.1)
+        cpu_percent_json = measures["cpu"].update_and_get(cpu_percent_data)
+        # cpu_times_percent_json = {
+        #     "user": measures["cpu.user"].update_and_get(cpu_times_percent_data.user),
+        #     "system": measures["cpu.system"].update_and_get(cpu_times_percent_data.system),
+        #     "idle": measures["cpu.idle"].update_and_get(cpu_times_percent_data.idle),
+        #     "nice": measures["cpu.nice"].update_and_get(cpu_times_percent_data.nice),
+        #     "irq": measures["cpu.user"].update_and_get(cpu_times_percent_data.irq),
+        #     "softirq": measures["cpu.user"].update_and_get(cpu_times_percent_data.softirq),
+        #     "iowait": measures["cpu.user"].update_and_get(cpu_times_percent_data.iowait),
+        #     "steal": measures["cpu.user"].update_and_get(cpu_times_percent_data.steal),
+        # }
+        cpu_times_percent_user_json = measures["cpu.user"].update_and_get(cpu_times_percent_data.user)
+        cpu_times_percent_system_json = measures["cpu.system"].update_and_get(cpu_times_percent_data.system)
+        cpu_times_percent_idle_json = measures["cpu.idle"].update_and_get(cpu_times_percent_data.idle)
+        cpu_times_percent_nice_json = measures["cpu.nice"].update_and_get(cpu_times_percent_data.nice)
+        cpu_times_percent_irq_json = measures["cpu.irq"].update_and_get(cpu_times_percent_data.irq)
+        cpu_times_percent_softirq_json = measures["cpu.softirq"].update_and_get(cpu_times_percent_data.softirq)
+        cpu_times_percent_iowait_json = measures["cpu.iowait"].update_and_get(cpu_times_percent_data.iowait)
+        cpu_times_percent_steal_json = measures["cpu.steal"].update_and_get(cpu_times_percent_data.steal)
+
+        mem_virtual_data_used = max(min(rng.randint(-5000, 5000) + mem_virtual_data_used, mem_virtual_data.total), 0)
+        mem_virtual_data_free = min(mem_virtual_data.total - mem_virtual_data.cached - mem_virtual_data_used, 0)
+        # mem_json = {
+        #     "virtual": {
+        #         "total": measures["mem.virtual.total"].update_and_get(mem_virtual_data.total),
+        #         "used": measures["mem.virtual.used"].update_and_get(mem_virtual_data_used),
+        #         "cached": measures["mem.virtual.cached"].update_and_get(mem_virtual_data.cached),
+        #         "free": measures["mem.virtual.free"].update_and_get(mem_virtual_data_free),
+        #         "available": measures["mem.virtual.available"].update_and_get(mem_virtual_data.available),
+        #         "percent": measures["mem.virtual.percent"].update_and_get(mem_virtual_data.percent),
+        #         "active": measures["mem.virtual.active"].update_and_get(mem_virtual_data.active),
+        #         "inactive": measures["mem.virtual.inactive"].update_and_get(mem_virtual_data.inactive),
+        #         "buffers": measures["mem.virtual.buffers"].update_and_get(mem_virtual_data.buffers),
+        #         "shared": measures["mem.virtual.shared"].update_and_get(mem_virtual_data.shared),
+        #     },
+        #     "swap": {
+        #         "total": measures["mem.swap.total"].update_and_get(mem_swap_data.total),
+        #         "used": measures["mem.swap.used"].update_and_get(mem_swap_data.used),
+        #         "free": measures["mem.swap.free"].update_and_get(mem_swap_data.free),
+        #         "percent": measures["mem.swap.percent"].update_and_get(mem_swap_data.percent),
+        #     }
+        # }
+        mem_virtual_total_json = measures["mem.virtual.total"].update_and_get(mem_virtual_data.total)
+        mem_virtual_used_json = measures["mem.virtual.used"].update_and_get(mem_virtual_data_used)
+        mem_virtual_cached_json = measures["mem.virtual.cached"].update_and_get(mem_virtual_data.cached)
+        mem_virtual_free_json = measures["mem.virtual.free"].update_and_get(mem_virtual_data_free)
+        mem_virtual_available_json = measures["mem.virtual.available"].update_and_get(mem_virtual_data.available)
+        mem_virtual_percent_json = measures["mem.virtual.percent"].update_and_get(mem_virtual_data.percent)
+        mem_virtual_active_json = measures["mem.virtual.active"].update_and_get(mem_virtual_data.active)
+        mem_virtual_inactive_json = measures["mem.virtual.inactive"].update_and_get(mem_virtual_data.inactive)
+        mem_virtual_buffers_json = measures["mem.virtual.buffers"].update_and_get(mem_virtual_data.buffers)
+        mem_virtual_shared_json = measures["mem.virtual.shared"].update_and_get(mem_virtual_data.shared)
+
+        mem_swap_total_json = measures["mem.swap.total"].update_and_get(mem_swap_data.total)
+        mem_swap_used_json = measures["mem.swap.used"].update_and_get(mem_swap_data.used)
+        mem_swap_free_json = measures["mem.swap.free"].update_and_get(mem_swap_data.free)
+        mem_swap_percent_json = measures["mem.swap.percent"].update_and_get(mem_swap_data.percent)
+
+        # io_json = []
+        # for k in io_data:
+        #     if k == 'enp0s25':
+        #         io_json = [{
+        #             "name": k,
+        #             "bytes_sent": measures[k + ".bytes_sent"].update_and_get(rng.randint(0, 90000)),
+        #             "bytes_recv": measures[k + ".bytes_recv"].update_and_get(rng.randint(0, 90000)),
+        #             "packets_sent": measures[k + ".packets_sent"].update_and_get(rng.randint(0, 1000)),
+        #             "packets_recv": measures[k + ".packets_recv"].update_and_get(rng.randint(0, 1000)),
+        #         }]
+        for k in io_data:
+            if k == 'enp0s25':
+                io_name_json = k
+                io_bytes_sent_json = measures[k + ".bytes_sent"].update_and_get(rng.randint(0, 90000))
+                io_bytes_recv_json = measures[k + ".bytes_recv"].update_and_get(rng.randint(0, 90000))
+                io_packets_sent_json = measures[k + ".packets_sent"].update_and_get(rng.randint(0, 1000))
+                io_packets_recv_json = measures[k + ".packets_recv"].update_and_get(rng.randint(0, 1000))
+
+        # paths_json = []
+        # for idx, p in enumerate(paths):
+        #     current_path = paths[idx]
+        #     current_path_data = paths_data[idx]
+        #
+        #     path_name = current_path["name"]
+        #     path = current_path["path"]
+        #     paths_json.append({
+        #         "name": path_name,
+        #         "path": path,
+        #         "total": measures[path_name + ".total"].update_and_get(current_path_data.total),
+        #         "used": measures[path_name + ".used"].update_and_get(current_path_data.used),
+        #         "free": measures[path_name + ".free"].update_and_get(current_path_data.free),
+        #         "percent": measures[path_name + ".percent"].update_and_get(current_path_data.percent)
+        #     })
+        current_path = paths[0]
+        current_path_data = paths_data[0]
+
+        path_name = current_path["name"]
+        path = current_path["path"]
+        disk0_used_json = measures[path_name + ".used"].update_and_get(current_path_data.used)
+        disk0_name_json = path_name
+        disk0_percent_json = measures[path_name + ".percent"].update_and_get(current_path_data.percent)
+        disk0_free_json = measures[path_name + ".free"].update_and_get(current_path_data.free)
+        disk0_path_json = path
+        disk0_total_json = measures[path_name + ".total"].update_and_get(current_path_data.total)
+
+        current_path = paths[0]
+        current_path_data = paths_data[0]
+
+        path_name = current_path["name"]
+        path = current_path["path"]
+        disk1_used_json = measures[path_name + ".used"].update_and_get(current_path_data.used)
+        disk1_name_json = path_name
+        disk1_percent_json = measures[path_name + ".percent"].update_and_get(current_path_data.percent)
+        disk1_free_json = measures[path_name + ".free"].update_and_get(current_path_data.free)
+        disk1_path_json = path
+        disk1_total_json = measures[path_name + ".total"].update_and_get(current_path_data.total)
+
+        current_path = paths[0]
+        current_path_data = paths_data[0]
+
+        path_name = current_path["name"]
+        path = current_path["path"]
+        disk2_used_json = measures[path_name + ".used"].update_and_get(current_path_data.used)
+        disk2_name_json = path_name
+        disk2_percent_json = measures[path_name + ".percent"].update_and_get(current_path_data.percent)
+        disk2_free_json = measures[path_name + ".free"].update_and_get(current_path_data.free)
+        disk2_path_json = path
+        disk2_total_json = measures[path_name + ".total"].update_and_get(current_path_data.total)
+
+        # io_disk_json = []
+        # for k in io_disk_data:
+        #     if k == 'sda6':
+        #         io_disk_json = [{
+        #             "disk_id": k,
+        #             "read_count": measures[k + ".read_count"].update_and_get(io_disk_data[k].read_count),
+        #             "write_count": measures[k + ".write_count"].update_and_get(io_disk_data[k].write_count),
+        #             "read_bytes": measures[k + ".read_bytes"].update_and_get(rng.randint(0, 90000)),
+        #             "write_bytes": measures[k + ".write_bytes"].update_and_get(rng.randint(0, 90000)),
+        #             "read_time": measures[k + ".read_time"].update_and_get(io_disk_data[k].read_time),
+        #             "write_time": measures[k + ".write_time"].update_and_get(io_disk_data[k].write_time)
+        #         }]
+        for k in io_disk_data:
+            if k == 'sda6':
+                io_disk_name_json = k
+                io_disk_read_bytes_json = measures[k + ".read_bytes"].update_and_get(rng.randint(0, 90000))
+                io_disk_read_count_json = measures[k + ".read_count"].update_and_get(io_disk_data[k].read_count)
+                io_disk_read_time_json = measures[k + ".read_time"].update_and_get(io_disk_data[k].read_time)
+                io_disk_write_bytes_json = measures[k + ".write_bytes"].update_and_get(rng.randint(0, 90000))
+                io_disk_write_count_json = measures[k + ".write_count"].update_and_get(io_disk_data[k].write_count)
+                io_disk_write_time_json = measures[k + ".write_time"].update_and_get(io_disk_data[k].write_time)
+
+        process_json = measures["process"].update_and_get(max(min(rng.randint(-20, 20) + process_data, 1000), 0))
+
+        # io_disk = io_disk_json.pop()
+        # ndata = io_json.pop()
+        # path1 = paths_json.pop()
+        # path2 = paths_json.pop()
+        # path3 = paths_json.pop()
+        doc_time = datetime.datetime.fromtimestamp(args.start_date + args.interval*doc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        message = {
+            "store_location": location,
+            "province": province,
+            "city": city,
+            "store": store,
+            "processes": process_json,
+            "cpu": cpu_percent_json,
+            "cpu_times_user": cpu_times_percent_user_json,
+            "cpu_times_system": cpu_times_percent_system_json,
+            "cpu_times_idle": cpu_times_percent_idle_json,
+            "cpu_times_nice": cpu_times_percent_nice_json,
+            "cpu_times_irq": cpu_times_percent_irq_json,
+            "cpu_times_softirq": cpu_times_percent_softirq_json,
+            "cpu_times_iowait": cpu_times_percent_iowait_json,
+            "cpu_times_steal": cpu_times_percent_steal_json,
+            "disk0_used": disk0_used_json,
+            "disk0_name": disk0_name_json,
+            "disk0_percent": disk0_percent_json,
+            "disk0_free": disk0_free_json,
+            "disk0_path": disk0_path_json,
+            "disk0_total": disk0_total_json,
+            "disk1_used": disk1_used_json,
+            "disk1_name": disk1_name_json,
+            "disk1_percent": disk1_percent_json,
+            "disk1_free": disk1_free_json,
+            "disk1_path": disk1_path_json,
+            "disk1_total": disk1_total_json,
+            "disk2_used": disk2_used_json,
+            "disk2_name": disk2_name_json,
+            "disk2_percent": disk2_percent_json,
+            "disk2_free": disk2_free_json,
+            "disk2_path": disk2_path_json,
+            "disk2_total": disk2_total_json,
+            "io_disk_name": io_disk_name_json,
+            "io_disk_read_bytes": io_disk_read_bytes_json,
+            "io_disk_read_count": io_disk_read_count_json,
+            "io_disk_read_time": io_disk_read_time_json,
+            "io_disk_write_bytes": io_disk_write_bytes_json,
+            "io_disk_write_count": io_disk_write_count_json,
+            "io_disk_write_time": io_disk_write_time_json,
+            "mem_swap_free": mem_swap_free_json,
+            "mem_swap_percent": mem_swap_percent_json,
+            "mem_swap_total": mem_swap_total_json,
+            "mem_swap_used": mem_swap_used_json,
+            "mem_virtual_active": mem_virtual_active_json,
+            "mem_virtual_available": mem_virtual_available_json,
+            "mem_virtual_buffers": mem_virtual_buffers_json,
+            "mem_virtual_cached": mem_virtual_cached_json,
+            "mem_virtual_shared": mem_virtual_shared_json,
+            "mem_virtual_free": mem_virtual_free_json,
+            "mem_virtual_inactive": mem_virtual_inactive_json,
+            "mem_virtual_percent": mem_virtual_percent_json,
+            "mem_virtual_total": mem_virtual_total_json,
+            "mem_virtual_used": mem_virtual_used_json,
+            "network_bytes_recv": io_bytes_recv_json,
+            "network_bytes_sent": io_bytes_sent_json,
+            "network_name": io_name_json,
+            "network_packets_recv": io_packets_recv_json,
+            "network_packets_sent": io_packets_sent_json,
+            "host": "{}{}".format(args.hostname,host),
+            "time": doc_time
+        }
+
+        yield message
+
+
+def load_scenario(args, snapshot, paths, seed):
+    import scenario
+    return scenario.load_scenario(args.scenario, snapshot, paths, args.start_date, args.interval, seed)
+
+
+def write_numpy(args, snapshot, paths, hosts, seed, writer):
+    "Write the documents of `hosts` from the vectorized engine, ordered by time then host."
+    import stats_engine
+
+    chunk = stats_engine.chunk_size(args.nhost)
+    if args.scenario:
+        fleets = load_scenario(args, snapshot, paths, seed)
+        pairs = fleets.flat_pairs()
+        host_values = fleets.host_values(hosts)
+        generated = fleets.series(hosts, args.ndata, chunk)
+    else:
+        latitude, longitude, province, city, store = store_location(args.store)
+        location = "{},{}".format(latitude, longitude)
+        pairs = stats_engine.flat_pairs(snapshot, paths, location, province, city, store)
+        host_values = {}
+        seeds = [host_seed(seed, host) for host in hosts]
+        generated = stats_engine.series(snapshot, seeds, args.ndata, chunk)
+    template = stats_engine.build_template(pairs)
+
+    host_values["host"] = ["{}{}".format(args.hostname, host) for host in hosts]
+    host_json = dict((name, [json.dumps(value) for value in values]) for name, values in host_values.items())
+    step = max(1, stats_engine.RENDER_DOCS // len(hosts))
+    for t0, columns in generated:
+        for start in range(0, columns["cpu"].shape[1], step):
+            part = dict((name, values[:, start:start + step]) for name, values in columns.items())
+            times = stats_engine.doc_times(args.start_date, args.interval, t0 + start, part["cpu"].shape[1])
+            if args.format == "jsonl":
+                writer.write_lines(stats_engine.render(template, part, host_json,
+                                                       {"time": [json.dumps(t) for t in times]}))
+            else:
+                writer.write_columns(stats_engine.frame(pairs, part, host_values, {"time": times}))
+
+
+def part_output(output, worker):
+    root, ext = os.path.splitext(output)
+    return "{}-w{:03d}{}".format(root, worker, ext)
+
+
+def new_dumps(args):
+    if args.serializer == TEMPLATE:
+        return TemplatedSerializer(VARYING_FIELDS).dumps
+    return Serializer(args.serializer).dumps
+
+
+def new_writer(args, output, rows):
+    if args.solr:
+        return SolrWriter(args.solr,
+                          batch_size=args.batch_size,
+                          concurrency=args.solr_concurrency,
+                          retries=args.solr_retries,
+                          commit_within=args.commit_within,
+                          dumps=new_dumps(args))
+    if args.format != "jsonl":
+        import stats_columns
+        return stats_columns.ColumnarWriter(output, rows, compressed=args.format == "npz")
+    return ShardedWriter(output,
+                         batch_size=args.batch_size,
+                         compression=args.compression,
+                         shard_size=args.shard_size * 1024 * 1024,
+                         dumps=new_dumps(args))
+
+
+def write_python(args, snapshot, paths, hosts, seed, writer, show_progress=False):
+    """
+    Write the documents of `hosts` from the python engine, ordered by time then
+    host like write_numpy(): one run gives the same output as merged workers.
+    """
+    streams = [documents(args, snapshot, paths, host, seed) for host in hosts]
+    step = max(1, args.ndata // 100)
+    for doc in range(args.ndata):
+        for stream in streams:
+            writer.write(next(stream))
+        if show_progress and ((doc + 1) % step == 0 or doc + 1 == args.ndata):
+            progress(doc + 1, args.ndata)
+
+
+def write_hosts(job):
+    """
+    Worker entry point: write the documents of `hosts` to the worker own part,
+    ordered by time then host, so parts can be merged as streams.
+    """
+    args, snapshot, paths, seed, worker, hosts = job
+    writer = new_writer(args, part_output(args.output, worker), len(hosts) * args.ndata)
+    try:
+        if args.engine == "numpy":
+            write_numpy(args, snapshot, paths, hosts, seed, writer)
+        else:
+            write_python(args, snapshot, paths, hosts, seed, writer)
+    finally:
+        writer.close()
+    return worker, writer.paths
+
+
+def part_documents(part_paths, hostname):
+    "(time, host number, line) of the documents of a part, read from the line text instead of decoding it."
+    host_key = re.compile(HOST_KEY.format(re.escape(hostname)))
+    for path in part_paths:
+        for line in read_lines(path):
+            time_match = TIME_KEY.search(line)
+            host_match = host_key.search(line)
+            if time_match is None or host_match is None:
+                doc = json.loads(line)
+                yield doc["time"], int(doc["host"][len(hostname):]), line
+            else:
+                yield time_match.group(1), int(host_match.group(1)), line
+
+
+def merge_parts(parts, hostname, writer):
+    "Merge the worker parts into one stream ordered by time then host number."
+    streams = [part_documents(part_paths, hostname) for part_paths in parts]
+    for _, _, line in heapq.merge(*streams):
+        writer.write_line(line)
+
+
+def progress(done, total):
+    sys.stdout.write('\r')
+    # the exact output you're looking for:
+    sys.stdout.write("[%-30s] %d%%" % ('=' * (done*30/total), (done*100)/total))
+    sys.stdout.flush()
 
-    location = "{},{}".format(latitude, longitude)
 
-    mem_virtual_data_used = mem_virtual_data.used
+def main(argv):
 
-    actual_time = args.start_date
-
-    for host in range(args.nhost):
-        for doc in range(args.ndata):
-
-            cpu_percent_data = max(min(round(random.uniform(-5, 5) + cpu_percent_data, 1), 100), 0.1)
-            cpu_percent_json = measures["cpu"].update_and_get(cpu_percent_data)
-            # cpu_times_percent_json = {
-            #     "user": measures["cpu.user"].update_and_get(cpu_times_percent_data.user),
-            #     "system": measures["cpu.system"].update_and_get(cpu_times_percent_data.system),
-            #     "idle": measures["cpu.idle"].update_and_get(cpu_times_percent_data.idle),
-            #     "nice": measures["cpu.nice"].update_and_get(cpu_times_percent_data.nice),
-            #     "irq": measures["cpu.user"].update_and_get(cpu_times_percent_data.irq),
-            #     "softirq": measures["cpu.user"].update_and_get(cpu_times_percent_data.softirq),
-            #     "iowait": measures["cpu.user"].update_and_get(cpu_times_percent_data.iowait),
-            #     "steal": measures["cpu.user"].update_and_get(cpu_times_percent_data.steal),
-            # }
-            cpu_times_percent_user_json = measures["cpu.user"].update_and_get(cpu_times_percent_data.user)
-            cpu_times_percent_system_json = measures["cpu.system"].update_and_get(cpu_times_percent_data.system)
-            cpu_times_percent_idle_json = measures["cpu.idle"].update_and_get(cpu_times_percent_data.idle)
-            cpu_times_percent_nice_json = measures["cpu.nice"].update_and_get(cpu_times_percent_data.nice)
-            cpu_times_percent_irq_json = measures["cpu.irq"].update_and_get(cpu_times_percent_data.irq)
-            cpu_times_percent_softirq_json = measures["cpu.softirq"].update_and_get(cpu_times_percent_data.softirq)
-            cpu_times_percent_iowait_json = measures["cpu.iowait"].update_and_get(cpu_times_percent_data.iowait)
-            cpu_times_percent_steal_json = measures["cpu.steal"].update_and_get(cpu_times_percent_data.steal)
-
-            mem_virtual_data_used = max(min(random.randint(-5000, 5000) + mem_virtual_data_used, mem_virtual_data.total), 0)
-            mem_virtual_data_free = min(mem_virtual_data.total - mem_virtual_data.cached - mem_virtual_data_used, 0)
-            # mem_json = {
-            #     "virtual": {
-            #         "total": measures["mem.virtual.total"].update_and_get(mem_virtual_data.total),
-            #         "used": measures["mem.virtual.used"].update_and_get(mem_virtual_data_used),
-            #         "cached": measures["mem.virtual.cached"].update_and_get(mem_virtual_data.cached),
-            #         "free": measures["mem.virtual.free"].update_and_get(mem_virtual_data_free),
-            #         "available": measures["mem.virtual.available"].update_and_get(mem_virtual_data.available),
-            #         "percent": measures["mem.virtual.percent"].update_and_get(mem_virtual_data.percent),
-            #         "active": measures["mem.virtual.active"].update_and_get(mem_virtual_data.active),
-            #         "inactive": measures["mem.virtual.inactive"].update_and_get(mem_virtual_data.inactive),
-            #         "buffers": measures["mem.virtual.buffers"].update_and_get(mem_virtual_data.buffers),
-            #         "shared": measures["mem.virtual.shared"].update_and_get(mem_virtual_data.shared),
-            #     },
-            #     "swap": {
-            #         "total": measures["mem.swap.total"].update_and_get(mem_swap_data.total),
-            #         "used": measures["mem.swap.used"].update_and_get(mem_swap_data.used),
-            #         "free": measures["mem.swap.free"].update_and_get(mem_swap_data.free),
-            #         "percent": measures["mem.swap.percent"].update_and_get(mem_swap_data.percent),
-            #     }
-            # }
-            mem_virtual_total_json = measures["mem.virtual.total"].update_and_get(mem_virtual_data.total)
-            mem_virtual_used_json = measures["mem.virtual.used"].update_and_get(mem_virtual_data_used)
-            mem_virtual_cached_json = measures["mem.virtual.cached"].update_and_get(mem_virtual_data.cached)
-            mem_virtual_free_json = measures["mem.virtual.free"].update_and_get(mem_virtual_data_free)
-            mem_virtual_available_json = measures["mem.virtual.available"].update_and_get(mem_virtual_data.available)
-            mem_virtual_percent_json = measures["mem.virtual.percent"].update_and_get(mem_virtual_data.percent)
-            mem_virtual_active_json = measures["mem.virtual.active"].update_and_get(mem_virtual_data.active)
-            mem_virtual_inactive_json = measures["mem.virtual.inactive"].update_and_get(mem_virtual_data.inactive)
-            mem_virtual_buffers_json = measures["mem.virtual.buffers"].update_and_get(mem_virtual_data.buffers)
-            mem_virtual_shared_json = measures["mem.virtual.shared"].update_and_get(mem_virtual_data.shared)
-
-            mem_swap_total_json = measures["mem.swap.total"].update_and_get(mem_swap_data.total)
-            mem_swap_used_json = measures["mem.swap.used"].update_and_get(mem_swap_data.used)
-            mem_swap_free_json = measures["mem.swap.free"].update_and_get(mem_swap_data.free)
-            mem_swap_percent_json = measures["mem.swap.percent"].update_and_get(mem_swap_data.percent)
-
-            # io_json = []
-            # for k in io_data:
-            #     if k == 'enp0s25':
-            #         io_json = [{
-            #             "name": k,
-            #             "bytes_sent": measures[k + ".bytes_sent"].update_and_get(random.randint(0, 90000)),
-            #             "bytes_recv": measures[k + ".bytes_recv"].update_and_get(random.randint(0, 90000)),
-            #             "packets_sent": measures[k + ".packets_sent"].update_and_get(random.randint(0, 1000)),
-            #             "packets_recv": measures[k + ".packets_recv"].update_and_get(random.randint(0, 1000)),
-            #         }]
-            for k in io_data:
-                if k == 'enp0s25':
-                    io_name_json = k
-                    io_bytes_sent_json = measures[k + ".bytes_sent"].update_and_get(random.randint(0, 90000))
-                    io_bytes_recv_json = measures[k + ".bytes_recv"].update_and_get(random.randint(0, 90000))
-                    io_packets_sent_json = measures[k + ".packets_sent"].update_and_get(random.randint(0, 1000))
-                    io_packets_recv_json = measures[k + ".packets_recv"].update_and_get(random.randint(0, 1000))
-
-            # paths_json = []
-            # for idx, p in enumerate(paths):
-            #     current_path = paths[idx]
-            #     current_path_data = paths_data[idx]
-            #
-            #     path_name = current_path["name"]
-            #     path = current_path["path"]
-            #     paths_json.append({
-            #         "name": path_name,
-            #         "path": path,
-            #         "total": measures[path_name + ".total"].update_and_get(current_path_data.total),
-            #         "used": measures[path_name + ".used"].update_and_get(current_path_data.used),
-            #         "free": measures[path_name + ".free"].update_and_get(current_path_data.free),
-            #         "percent": measures[path_name + ".percent"].update_and_get(current_path_data.percent)
-            #     })
-            current_path = paths[0]
-            current_path_data = paths_data[0]
-
-            path_name = current_path["name"]
-            path = current_path["path"]
-            disk0_used_json = measures[path_name + ".used"].update_and_get(current_path_data.used)
-            disk0_name_json = path_name
-            disk0_percent_json = measures[path_name + ".percent"].update_and_get(current_path_data.percent)
-            disk0_free_json = measures[path_name + ".free"].update_and_get(current_path_data.free)
-            disk0_path_json = path
-            disk0_total_json = measures[path_name + ".total"].update_and_get(current_path_data.total)
-
-            current_path = paths[0]
-            current_path_data = paths_data[0]
-
-            path_name = current_path["name"]
-            path = current_path["path"]
-            disk1_used_json = measures[path_name + ".used"].update_and_get(current_path_data.used)
-            disk1_name_json = path_name
-            disk1_percent_json = measures[path_name + ".percent"].update_and_get(current_path_data.percent)
-            disk1_free_json = measures[path_name + ".free"].update_and_get(current_path_data.free)
-            disk1_path_json = path
-            disk1_total_json = measures[path_name + ".total"].update_and_get(current_path_data.total)
-
-            current_path = paths[0]
-            current_path_data = paths_data[0]
-
-            path_name = current_path["name"]
-            path = current_path["path"]
-            disk2_used_json = measures[path_name + ".used"].update_and_get(current_path_data.used)
-            disk2_name_json = path_name
-            disk2_percent_json = measures[path_name + ".percent"].update_and_get(current_path_data.percent)
-            disk2_free_json = measures[path_name + ".free"].update_and_get(current_path_data.free)
-            disk2_path_json = path
-            disk2_total_json = measures[path_name + ".total"].update_and_get(current_path_data.total)
-
-            # io_disk_json = []
-            # for k in io_disk_data:
-            #     if k == 'sda6':
-            #         io_disk_json = [{
-            #             "disk_id": k,
-            #             "read_count": measures[k + ".read_count"].update_and_get(io_disk_data[k].read_count),
-            #             "write_count": measures[k + ".write_count"].update_and_get(io_disk_data[k].write_count),
-            #             "read_bytes": measures[k + ".read_bytes"].update_and_get(random.randint(0, 90000)),
-            #             "write_bytes": measures[k + ".write_bytes"].update_and_get(random.randint(0, 90000)),
-            #             "read_time": measures[k + ".read_time"].update_and_get(io_disk_data[k].read_time),
-            #             "write_time": measures[k + ".write_time"].update_and_get(io_disk_data[k].write_time)
-            #         }]
-            for k in io_disk_data:
-                if k == 'sda6':
-                    io_disk_name_json = k
-                    io_disk_read_bytes_json = measures[k + ".read_bytes"].update_and_get(random.randint(0, 90000))
-                    io_disk_read_count_json = measures[k + ".read_count"].update_and_get(io_disk_data[k].read_count)
-                    io_disk_read_time_json = measures[k + ".read_time"].update_and_get(io_disk_data[k].read_time)
-                    io_disk_write_bytes_json = measures[k + ".write_bytes"].update_and_get(random.randint(0, 90000))
-                    io_disk_write_count_json = measures[k + ".write_count"].update_and_get(io_disk_data[k].write_count)
-                    io_disk_write_time_json = measures[k + ".write_time"].update_and_get(io_disk_data[k].write_time)
-
-            process_json = measures["process"].update_and_get(max(min(random.randint(-20, 20) + process_data, 1000), 0))
-
-            # io_disk = io_disk_json.pop()
-            # ndata = io_json.pop()
-            # path1 = paths_json.pop()
-            # path2 = paths_json.pop()
-            # path3 = paths_json.pop()
-            doc_time = datetime.datetime.fromtimestamp(actual_time + args.interval*doc).strftime("%Y-%m-%dT%H:%M:%SZ")
-
-            message = {
-                "store_location": location,
-                "province": province,
-                "city": city,
-                "store": store,
-                "processes": process_json,
-                "cpu": cpu_percent_json,
-                "cpu_times_user": cpu_times_percent_user_json,
-                "cpu_times_system": cpu_times_percent_system_json,
-                "cpu_times_idle": cpu_times_percent_idle_json,
-                "cpu_times_nice": cpu_times_percent_nice_json,
-                "cpu_times_irq": cpu_times_percent_irq_json,
-                "cpu_times_softirq": cpu_times_percent_softirq_json,
-                "cpu_times_iowait": cpu_times_percent_iowait_json,
-                "cpu_times_steal": cpu_times_percent_steal_json,
-                "disk0_used": disk0_used_json,
-                "disk0_name": disk0_name_json,
-                "disk0_percent": disk0_percent_json,
-                "disk0_free": disk0_free_json,
-                "disk0_path": disk0_path_json,
-                "disk0_total": disk0_total_json,
-                "disk1_used": disk1_used_json,
-                "disk1_name": disk1_name_json,
-                "disk1_percent": disk1_percent_json,
-                "disk1_free": disk1_free_json,
-                "disk1_path": disk1_path_json,
-                "disk1_total": disk1_total_json,
-                "disk2_used": disk2_used_json,
-                "disk2_name": disk2_name_json,
-                "disk2_percent": disk2_percent_json,
-                "disk2_free": disk2_free_json,
-                "disk2_path": disk2_path_json,
-                "disk2_total": disk2_total_json,
-                "io_disk_name": io_disk_name_json,
-                "io_disk_read_bytes": io_disk_read_bytes_json,
-                "io_disk_read_count": io_disk_read_count_json,
-                "io_disk_read_time": io_disk_read_time_json,
-                "io_disk_write_bytes": io_disk_write_bytes_json,
-                "io_disk_write_count": io_disk_write_count_json,
-                "io_disk_write_time": io_disk_write_time_json,
-                "mem_swap_free": mem_swap_free_json,
-                "mem_swap_percent": mem_swap_percent_json,
-                "mem_swap_total": mem_swap_total_json,
-                "mem_swap_used": mem_swap_used_json,
-                "mem_virtual_active": mem_virtual_active_json,
-                "mem_virtual_available": mem_virtual_available_json,
-                "mem_virtual_buffers": mem_virtual_buffers_json,
-                "mem_virtual_cached": mem_virtual_cached_json,
-                "mem_virtual_shared": mem_virtual_shared_json,
-                "mem_virtual_free": mem_virtual_free_json,
-                "mem_virtual_inactive": mem_virtual_inactive_json,
-                "mem_virtual_percent": mem_virtual_percent_json,
-                "mem_virtual_total": mem_virtual_total_json,
-                "mem_virtual_used": mem_virtual_used_json,
-                "network_bytes_recv": io_bytes_recv_json,
-                "network_bytes_sent": io_bytes_sent_json,
-                "network_name": io_name_json,
-                "network_packets_recv": io_packets_recv_json,
-                "network_packets_sent": io_packets_sent_json,
-                "host": "{}{}".format(args.hostname,host),
-                "time": doc_time
-            }
-
-            with open(args.output, 'a') as outfile:
-                json.dump(message, outfile)
-                outfile.write("\n")
-        sys.stdout.write('\r')
-        # the exact output you're looking for:
-        sys.stdout.write("[%-30s] %d%%" % ('=' * ((host+1)*30/args.nhost), ((host+1)*100)/args.nhost))
-        sys.stdout.flush()
-    sys.stdout.write('\n')
+    args = parser.parse_args()
+
+    paths = []
+    paths.append({"name": "root", "path": "/"})
+    paths.append({"name": "opt", "path": "/opt"})
+    paths.append({"name": "tmp", "path": "/tmp"})
+
+    seed = args.seed
+    if seed is None:
+        seed = random.SystemRandom().randint(0, 2 ** 31)
+        print "Using seed {}".format(seed)
+
+    snapshot = load_snapshot(args.snapshot, paths)
+
+    if args.merge and args.format != "jsonl":
+        parser.error("--merge only supports the jsonl format")
+    if args.solr and (args.merge or args.format != "jsonl"):
+        parser.error("--solr indexes JSON documents, without --merge")
+    if args.scenario:
+        args.engine = "numpy"
+        args.nhost = load_scenario(args, snapshot, paths, seed).nhost
+
+    try:
+        write_output(args, snapshot, paths, seed)
+    except SolrError as e:
+        parser.exit(1, "Solr indexing failed: {}\n".format(e))
+
+
+def write_output(args, snapshot, paths, seed):
+    "Generate the documents to args.output (or Solr), in this process or in workers."
+    if args.workers <= 1 and args.engine == "numpy":
+        writer = new_writer(args, args.output, args.nhost * args.ndata)
+        try:
+            write_numpy(args, snapshot, paths, range(args.nhost), seed, writer)
+        finally:
+            writer.close()
+        return
+
+    if args.workers <= 1:
+        writer = new_writer(args, args.output, args.nhost * args.ndata)
+        try:
+            write_python(args, snapshot, paths, range(args.nhost), seed, writer, show_progress=True)
+            sys.stdout.write('\n')
+        finally:
+            writer.close()
+        return
+
+    workers = min(args.workers, args.nhost)
+    jobs = [(args, snapshot, paths, seed, worker, range(worker, args.nhost, workers)) for worker in range(workers)]
+    parts = [None] * workers
+    pool = multiprocessing.Pool(workers)
+    try:
+        for done, (worker, part_paths) in enumerate(pool.imap_unordered(write_hosts, jobs)):
+            parts[worker] = part_paths
+            progress(done + 1, workers)
+        sys.stdout.write('\n')
+    finally:
+        pool.close()
+        pool.join()
+
+    if args.merge:
+        writer = new_writer(args, args.output, args.nhost * args.ndata)
+        try:
+            merge_parts(parts, args.hostname, writer)
+        finally:
+            writer.close()
+        for part_paths in parts:
+            for path in part_paths:
+                silentremove(path)
 
 if __name__ == "__main__":
     main(sys.argv)
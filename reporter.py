@@ -0,0 +1,166 @@
+"""
+Base classes of the monitoring agent reporters.
+
+A reporter collects metrics every `interval` seconds and logs them as JSON
+documents to syslog, through its own handler and send queue. The reporters
+of the agent are plugins, see plugins.py.
+"""
+
+from logging.handlers import SysLogHandler
+import logging
+import socket
+import threading
+import math
+import time
+
+from instrumentation import STAGES, timings
+from meters import MeterRegistry, monotonic_ns
+from send_queue import QueuedHandler, QUEUE_SIZE, DROP_OLDEST, REPLAY_RATE
+from serialization import Serializer
+from syslog_transport import TransportSysLogHandler, CachedHeaderFormatter, create_transport
+
+
+def time_in_ms():
+    return long(math.floor(time.time() * 1000))
+
+
+"""
+    TaskThread is a simple thread scheduler. It's call the run method every XX seconds.
+    The agent runs its tasks on a Scheduler instead, see scheduler.py.
+"""
+class TaskThread(threading.Thread):
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.finished = threading.Event()
+        self.interval = interval
+
+    def set_interval(self, interval):
+        self.interval = interval
+
+    def shutdown(self):
+        self.finished.set()
+
+    def run(self):
+        while 1:
+            if self.finished.isSet():
+                return
+            self.task()
+
+            # sleep for interval or until shutdown
+            self.finished.wait(self.interval)
+
+    def task(self):
+        pass
+
+"""
+    AReporter is the base class for all reporters.
+    It handles the following operations:
+        - register the metrics
+        - collect data
+        - process data
+        - flush every XX seconds
+"""
+class AReporter(TaskThread):
+    # expected CPU seconds of one collect(), declared by each reporter
+    COLLECT_COST = 0.0
+
+    def __init__(self, app_name, syslog_host, syslog_hostname, syslog_port, interval, transport=None,
+                 queue_size=QUEUE_SIZE, overflow=DROP_OLDEST, spool=None, replay_rate=REPLAY_RATE):
+        super(AReporter, self).__init__(interval)
+        self.app_name = app_name
+        self.syslog_host = syslog_host
+        self.syslog_port = syslog_port
+        self.logger = logging.getLogger(self.app_name)
+        self.logger.setLevel(logging.INFO)
+
+        f = ContextFilter()
+        self.logger.addFilter(f)
+
+        if transport is None and queue_size > 0:
+            transport = create_transport("udp", [(self.syslog_host, self.syslog_port)])
+        if transport is not None:
+            syslog = TransportSysLogHandler(transport)
+        else:
+            syslog = SysLogHandler(address=(self.syslog_host, self.syslog_port))
+        formatter = CachedHeaderFormatter(self.app_name, syslog_hostname)
+        syslog.setFormatter(formatter)
+
+        # per-stage timing histograms, see instrumentation.py
+        self.timings = dict((stage, timings.histogram(self.app_name, stage)) for stage in STAGES)
+
+        # the records are sent from a separate thread, a slow collector does not delay collect()
+        self.handler = syslog
+        if queue_size > 0:
+            self.handler = QueuedHandler(syslog, queue_size, overflow, spool, replay_rate)
+            self.handler.timing = self.timings["deliver"]
+
+        self.logger.addHandler(self.handler)
+
+        self.meters = MeterRegistry()
+        # DeltaEncoder in delta wire mode, see delta_encoding.py
+        self.encoder = None
+        # the JSON backend, see serialization.py
+        self.serializer = Serializer("json")
+
+    def prestart(self):
+        self.collect()
+        self.register()
+
+    def collect(self):
+        pass
+
+    def register(self):
+        self.meters.clear()
+
+    def collect_cost(self):
+        return self.COLLECT_COST
+
+    def tasks(self):
+        "What the scheduler runs for this reporter."
+        return [self]
+
+    def task(self):
+        try:
+            # a collection overrunning the interval makes the scheduler skip (and count) the missed ticks
+            start = monotonic_ns()
+            self.collect()
+            collected = monotonic_ns()
+            self.timings["collect"].record(collected - start)
+            data = self.process()
+            self.timings["process"].record(monotonic_ns() - collected)
+
+            if not isinstance(data, list):
+                to_push = [data]
+            else:
+                to_push = data
+
+            for d in to_push:
+                m = d
+                start = monotonic_ns()
+                if self.encoder is not None:
+                    message = self.serializer.compact(self.encoder.encode(m))
+                else:
+                    message = self.serializer.dumps(m)
+                serialized = monotonic_ns()
+                self.logger.info(message)
+                self.timings["serialize"].record(serialized - start)
+                self.timings["send"].record(monotonic_ns() - serialized)
+
+        except Exception as e:
+            # raise e
+            self.logger.error("Error during report processing:" + e.message)
+            # reset the reporter
+            self.prestart()
+
+    @staticmethod
+    def time_in_s():
+        return long(math.floor(time.time()))
+
+
+class ContextFilter(logging.Filter):
+    hostname = socket.gethostname()
+
+    def filter(self, record):
+        record.hostname = ContextFilter.hostname
+        return True
@@ -0,0 +1,84 @@
+"""
+High-frequency sampling for the monitoring agent.
+
+The agent reports every pollingInSec seconds, so a CPU or network spike
+shorter than that never shows up. In high-frequency mode a sampler reads a
+few fields every samplingMs milliseconds into fixed-size ring buffers, and
+each report carries min/max/mean/p95/last of the samples taken since the
+previous report instead of more messages.
+"""
+
+import math
+import threading
+from array import array
+
+
+AGGREGATES = ["min", "max", "mean", "p95", "last"]
+
+
+def summarize(values):
+    "min/max/mean/p95/last of a list of samples, None when there is none."
+    if not values:
+        return None
+    ordered = sorted(values)
+    # nearest rank
+    p95 = ordered[max(0, int(math.ceil(0.95 * len(ordered))) - 1)]
+    return {"min": ordered[0], "max": ordered[-1], "mean": round(sum(values) / len(values), 2),
+            "p95": p95, "last": values[-1]}
+
+
+"""
+    RingBuffer keeps the last `capacity` float samples in an array('d').
+"""
+class RingBuffer():
+    def __init__(self, capacity):
+        self.values = array('d', [0.0] * capacity)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+
+    def append(self, value):
+        end = (self.start + self.size) % self.capacity
+        self.values[end] = value
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def take(self):
+        "The samples in order, emptying the buffer."
+        end = self.start + self.size
+        if end <= self.capacity:
+            values = self.values[self.start:end].tolist()
+        else:
+            values = self.values[self.start:].tolist() + self.values[:end - self.capacity].tolist()
+        self.start = 0
+        self.size = 0
+        return values
+
+
+"""
+    SampleWindow holds one ring buffer per sampled field.
+"""
+class SampleWindow():
+    def __init__(self, fields, capacity):
+        self.fields = fields
+        self.buffers = dict((field, RingBuffer(capacity)) for field in fields)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, sample):
+        with self.lock:
+            for field in self.fields:
+                self.buffers[field].append(sample[field])
+            self.count += 1
+
+    def summary(self):
+        "field -> aggregates of the samples since the last call."
+        with self.lock:
+            values = dict((field, self.buffers[field].take()) for field in self.fields)
+            count = self.count
+            self.count = 0
+        summary = dict((field, summarize(values[field])) for field in self.fields)
+        summary["count"] = min(count, self.buffers[self.fields[0]].capacity) if self.fields else 0
+        return summary
@@ -0,0 +1,467 @@
+"""
+Scenario engine for the synthetic stats datasets.
+
+stats_engine.series() walks cpu and memory at random around the snapshot and
+draws the traffic uniformly; everything else is the snapshot value. A
+scenario instead drives every host from a load level:
+
+    - diurnal and weekly seasonality: the load peaks at the fleet's peakHour
+      (local time, utcOffset hours from UTC) and is weekendLoad times lower on
+      Saturdays and Sundays, each host scaled by its own factor
+    - cpu, cpu times, network and disk traffic, disk latency, memory and
+      processes all follow the load, so they are correlated, with noise and
+      a slow bounded cpu drift per host
+    - incidents over time windows on a share of the hosts: a load spike, a
+      disk filling up, a memory leak growing until the process restarts
+    - disks growing by diskGrowth bytes a day
+
+Fleets and incidents come from a config file:
+
+    [fleet madrid]
+    hosts = 200
+    province = M
+    city = Madrid
+    store = Vasconcelos
+    latitude = 40.471032
+    longitude = -3.686893
+    peakHour = 13
+
+    [incident disk-full]
+    kind = diskfill             (spike, diskfill or leak)
+    fleet = madrid              (all the fleets when missing)
+    hosts = 10%                 (a share of the fleet, or a number of hosts)
+    start = 2017-10-18T10:00:00 (or seconds after the first document)
+    duration = 7200
+    magnitude = 0.9             (spike: extra load, diskfill: share of the free
+                                 space filled, leak: share of the memory leaked)
+    disk = 0
+
+See FLEET_DEFAULTS for the other fleet options. Everything is computed on
+(hosts, timestamps) arrays, chunk by chunk like stats_engine.series(), and
+each (host, chunk) has its own RNG.
+
+Usage: python scenario.py <scenario.cfg> [days] [interval] prints the
+generation speed and the mean cpu per hour of the day.
+"""
+
+import ConfigParser
+import calendar
+import datetime
+import math
+import sys
+import time
+
+import numpy
+
+from serialization import Field
+from stats_engine import NETWORK_NAME, DISK_NAME, chunk_size, clipped_walk
+
+
+FLEET_SECTION = "fleet "
+INCIDENT_SECTION = "incident "
+KINDS = ["spike", "diskfill", "leak"]
+FLEET_DEFAULTS = {
+    "hosts": 10,
+    "latitude": 40.471032,
+    "longitude": -3.686893,
+    "province": "M",
+    "city": "Madrid",
+    "store": "Vasconcelos",
+    # cpu percent at night and at the peak
+    "baseCpu": 8.0,
+    "peakCpu": 60.0,
+    "peakHour": 13.0,
+    "utcOffset": 1.0,
+    "weekendLoad": 0.4,
+    # cpu noise standard deviation, in percent
+    "noise": 2.0,
+    # share of the memory used by the load at the peak
+    "memLoad": 0.3,
+    # bytes per second received and written at the peak
+    "networkPeak": 2e6,
+    "diskPeak": 5e5,
+    "diskGrowth": float(1 << 30),
+    "processes": 150,
+    "processesPeak": 100,
+}
+STRING_OPTIONS = ["province", "city", "store"]
+# spread of the host load factors (log-normal sigma)
+HOST_SPREAD = 0.15
+# cpu drift per host, in tenths of percent
+DRIFT_STEP = 5
+DRIFT_MAX = 100
+# mean packet sizes
+RECV_PACKET = 900
+SENT_PACKET = 500
+READ_OP = 16384
+WRITE_OP = 8192
+# noise series drawn per (host, timestamp): cpu, network, sent, disk, memory, processes
+NOISE_SERIES = 6
+CPU_TIMES = ["user", "system", "idle", "nice", "irq", "softirq", "iowait", "steal"]
+
+
+def parse_hosts(name, value, candidates):
+    "Number of hosts of the incident `name` among `candidates` hosts: a share with a % suffix, or a count."
+    try:
+        if value.endswith("%"):
+            return int(round(float(value[:-1]) / 100 * candidates))
+        return min(int(value), candidates)
+    except ValueError:
+        raise ValueError("invalid hosts in [incident {}]: {} (a number of hosts, or a share like 10%)".format(name, value))
+
+
+def parse_time(value, start_date):
+    "Seconds since the epoch of an incident start: an ISO UTC date, or seconds after `start_date`."
+    try:
+        return start_date + float(value)
+    except ValueError:
+        return calendar.timegm(datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S").timetuple())
+
+
+"""
+    Incident is one incident window, on the hosts of `mask`.
+"""
+class Incident():
+    def __init__(self, name, kind, mask, start, duration, magnitude, disk):
+        if kind not in KINDS:
+            raise ValueError("unknown incident kind for {}: {}".format(name, kind))
+        self.name = name
+        self.kind = kind
+        self.mask = mask
+        self.start = start
+        self.duration = max(duration, 1.0)
+        self.magnitude = magnitude
+        self.disk = disk
+
+
+"""
+    Scenario generates the columns of the flat documents for the hosts of
+    its fleets, numbered in the order of the fleets in the config.
+"""
+class Scenario():
+    def __init__(self, fleets, incidents, snapshot, paths, start_date, interval, seed):
+        self.fleets = fleets
+        self.snapshot = snapshot
+        self.paths = paths
+        self.start_date = start_date
+        self.interval = interval
+        self.seed = seed
+        self.nhost = sum(fleet["hosts"] for fleet in fleets)
+        self.fleet_of = numpy.repeat(numpy.arange(len(fleets)), [fleet["hosts"] for fleet in fleets])
+        # per host parameters
+        self.params = dict((key, numpy.array([float(fleets[f][key]) for f in self.fleet_of]))
+                           for key, value in FLEET_DEFAULTS.items() if key not in STRING_OPTIONS)
+        self.scale = numpy.random.RandomState(seed % 2 ** 32).lognormal(0.0, HOST_SPREAD, self.nhost)
+        self.incidents = self._place(incidents)
+
+    def _place(self, incidents):
+        "Pick the hosts of each incident, (name, options) pairs."
+        placed = []
+        names = [fleet["name"] for fleet in self.fleets]
+        for idx, (name, options) in enumerate(incidents):
+            if options.get("fleet"):
+                if options["fleet"] not in names:
+                    raise ValueError("unknown fleet in [incident {}]: {}".format(name, options["fleet"]))
+                candidates = numpy.flatnonzero(self.fleet_of == names.index(options["fleet"]))
+            else:
+                candidates = numpy.arange(self.nhost)
+            count = parse_hosts(name, options.get("hosts", "100%").strip(), len(candidates))
+            rs = numpy.random.RandomState([self.seed % 2 ** 32, idx])
+            mask = numpy.zeros(self.nhost, dtype=bool)
+            mask[rs.permutation(candidates)[:count]] = True
+            placed.append(Incident(name, options.get("kind", "spike"), mask,
+                                   parse_time(options.get("start", "0"), self.start_date),
+                                   float(options.get("duration", 3600)), float(options.get("magnitude", 1.0)),
+                                   int(options.get("disk", 0))))
+        return placed
+
+    def flat_pairs(self):
+        "(key, value) pairs of the flat schema of random-json-stats_writer_solr.py, every metric being generated."
+        mem_virtual = self.snapshot["mem_virtual_data"]
+        mem_swap = self.snapshot["mem_swap_data"]
+        pairs = [(key, Field(key)) for key in ["store_location", "province", "city", "store", "processes", "cpu"]]
+        pairs.extend(("cpu_times_" + name, Field("cpu_times_" + name)) for name in CPU_TIMES)
+        for idx, disk in enumerate(["disk0", "disk1", "disk2"]):
+            pairs.extend([
+                (disk + "_used", Field(disk + "_used")),
+                (disk + "_name", self.paths[idx]["name"]),
+                (disk + "_percent", Field(disk + "_percent")),
+                (disk + "_free", Field(disk + "_free")),
+                (disk + "_path", self.paths[idx]["path"]),
+                (disk + "_total", long(self.snapshot["paths_data"][idx]["total"])),
+            ])
+        pairs.append(("io_disk_name", DISK_NAME))
+        pairs.extend(("io_disk_" + name, Field("io_disk_" + name))
+                     for name in ["read_bytes", "read_count", "read_time", "write_bytes", "write_count", "write_time"])
+        pairs.extend([
+            ("mem_swap_free", Field("mem_swap_free")),
+            ("mem_swap_percent", Field("mem_swap_percent")),
+            ("mem_swap_total", long(mem_swap["total"])),
+            ("mem_swap_used", Field("mem_swap_used")),
+            ("mem_virtual_active", long(mem_virtual["active"])),
+            ("mem_virtual_available", Field("mem_virtual_available")),
+            ("mem_virtual_buffers", long(mem_virtual["buffers"])),
+            ("mem_virtual_cached", long(mem_virtual["cached"])),
+            ("mem_virtual_shared", long(mem_virtual["shared"])),
+            ("mem_virtual_free", Field("mem_virtual_free")),
+            ("mem_virtual_inactive", long(mem_virtual["inactive"])),
+            ("mem_virtual_percent", Field("mem_virtual_percent")),
+            ("mem_virtual_total", long(mem_virtual["total"])),
+            ("mem_virtual_used", Field("mem_virtual_used")),
+            ("network_bytes_recv", Field("network_bytes_recv")),
+            ("network_bytes_sent", Field("network_bytes_sent")),
+            ("network_name", NETWORK_NAME),
+            ("network_packets_recv", Field("network_packets_recv")),
+            ("network_packets_sent", Field("network_packets_sent")),
+            ("host", Field("host")),
+            ("time", Field("time")),
+        ])
+        return pairs
+
+    def nested_pairs(self):
+        "(key, value) pairs of the nested schema of random-json-stats_writer.py, every metric being generated."
+        mem_virtual = self.snapshot["mem_virtual_data"]
+        mem_swap = self.snapshot["mem_swap_data"]
+        pairs = [
+            ("cpu", Field("cpu")),
+            ("cpu_times", [(name, Field("cpu_times_" + name)) for name in CPU_TIMES]),
+            ("mem", [
+                ("virtual", [
+                    ("total", long(mem_virtual["total"])),
+                    ("used", Field("mem_virtual_used")),
+                    ("cached", long(mem_virtual["cached"])),
+                    ("free", Field("mem_virtual_free")),
+                    ("available", Field("mem_virtual_available")),
+                    ("percent", Field("mem_virtual_percent")),
+                    ("active", long(mem_virtual["active"])),
+                    ("inactive", long(mem_virtual["inactive"])),
+                    ("buffers", long(mem_virtual["buffers"])),
+                    ("shared", long(mem_virtual["shared"])),
+                ]),
+                ("swap", [
+                    ("total", long(mem_swap["total"])),
+                    ("used", Field("mem_swap_used")),
+                    ("free", Field("mem_swap_free")),
+                    ("percent", Field("mem_swap_percent")),
+                ]),
+            ]),
+        ]
+        # like stats_engine.nested_template(), disk0 is the last path
+        for disk, idx in zip(["disk0", "disk1", "disk2"], [2, 1, 0]):
+            column = "disk{}_".format(idx)
+            pairs.append((disk, [
+                ("name", self.paths[idx]["name"]),
+                ("path", self.paths[idx]["path"]),
+                ("total", long(self.snapshot["paths_data"][idx]["total"])),
+                ("used", Field(column + "used")),
+                ("free", Field(column + "free")),
+                ("percent", Field(column + "percent")),
+            ]))
+        pairs.extend([
+            ("io_disk", [("disk_id", DISK_NAME)] +
+                        [(name, Field("io_disk_" + name))
+                         for name in ["read_count", "write_count", "read_bytes", "write_bytes", "read_time", "write_time"]]),
+            ("network", [("name", NETWORK_NAME)] +
+                        [(name, Field("network_" + name))
+                         for name in ["bytes_sent", "bytes_recv", "packets_sent", "packets_recv"]]),
+            ("processes", Field("processes")),
+            ("location", Field("store_location")),
+            ("province", Field("province")),
+            ("city", Field("city")),
+            ("store", Field("store")),
+        ])
+        return pairs
+
+    def host_values(self, hosts):
+        "The per host fields of `hosts` (store location, province, city, store), as lists of raw values."
+        fleets = [self.fleets[f] for f in self.fleet_of[hosts]]
+        return {
+            "store_location": ["{},{}".format(fleet["latitude"], fleet["longitude"]) for fleet in fleets],
+            "province": [fleet["province"] for fleet in fleets],
+            "city": [fleet["city"] for fleet in fleets],
+            "store": [fleet["store"] for fleet in fleets],
+        }
+
+    def series(self, hosts, ndata, chunk):
+        """
+        Generate the columns of `hosts` (host numbers), like
+        stats_engine.series(): yields (t0, columns) for each chunk of
+        timestamps, the columns being (hosts, timestamps) arrays.
+        """
+        hosts = numpy.asarray(hosts, dtype=numpy.int64)
+        nhost = len(hosts)
+        p = dict((key, values[hosts, None]) for key, values in self.params.items())
+        scale = self.scale[hosts, None]
+        incidents = [(incident, incident.mask[hosts]) for incident in self.incidents]
+        incidents = [(incident, mask) for incident, mask in incidents if mask.any()]
+
+        mem_virtual = self.snapshot["mem_virtual_data"]
+        mem_total = float(mem_virtual["total"])
+        mem_base = float(mem_virtual["used"]) * 0.5
+        swap_total = float(self.snapshot["mem_swap_data"]["total"])
+        disks = [(float(data["total"]), float(data["used"])) for data in self.snapshot["paths_data"][:3]]
+        drift = numpy.zeros(nhost, dtype=numpy.int64)
+
+        for c, t0 in enumerate(range(0, ndata, chunk)):
+            n = min(chunk, ndata - t0)
+            t = self.start_date + self.interval * numpy.arange(t0, t0 + n, dtype=numpy.float64)
+
+            noise = numpy.empty((NOISE_SERIES, nhost, n))
+            steps = numpy.empty((nhost, n), dtype=numpy.int64)
+            for i, host in enumerate(hosts):
+                rs = numpy.random.RandomState([self.seed % 2 ** 32, int(host), c])
+                noise[:, i] = rs.standard_normal((NOISE_SERIES, n))
+                steps[i] = rs.randint(-DRIFT_STEP, DRIFT_STEP + 1, n)
+            walk = clipped_walk(drift, steps, -DRIFT_MAX, DRIFT_MAX)
+            drift = walk[:, -1]
+
+            # seasonality
+            local = t + p["utcOffset"] * 3600
+            hour = local % 86400 / 3600
+            weekday = (local // 86400 + 3) % 7
+            load = (0.5 + 0.5 * numpy.cos((hour - p["peakHour"]) * (2 * math.pi / 24)))
+            load = load * numpy.where(weekday >= 5, p["weekendLoad"], 1.0) * scale
+
+            # incidents
+            leak = numpy.zeros((nhost, n))
+            fill = numpy.zeros((len(disks), nhost, n))
+            for incident, mask in incidents:
+                window = (t >= incident.start) & (t < incident.start + incident.duration)
+                ramp = numpy.clip((t - incident.start) / incident.duration, 0.0, 1.0)
+                if incident.kind == "spike":
+                    load[mask] += incident.magnitude * window
+                elif incident.kind == "leak":
+                    # the memory comes back when the process restarts, at the end of the window
+                    leak[mask] += incident.magnitude * ramp * window
+                else:
+                    # the files stay after the window
+                    fill[incident.disk % len(disks)][mask] += incident.magnitude * ramp
+
+            cpu = numpy.round(numpy.clip(p["baseCpu"] + (p["peakCpu"] - p["baseCpu"]) * load + walk / 10.0 +
+                                         noise[0] * p["noise"], 0.1, 100.0), 1)
+            recv = p["networkPeak"] * (0.05 + load) * numpy.exp(noise[1] * 0.2) * self.interval
+            sent = recv * 0.4 * numpy.exp(noise[2] * 0.1)
+            disk_rate = p["diskPeak"] * (0.05 + load) * numpy.exp(noise[3] * 0.3) * self.interval
+            read_bytes = disk_rate * 0.3
+            write_bytes = disk_rate * 0.7
+            read_count = numpy.ceil(read_bytes / READ_OP)
+            write_count = numpy.ceil(write_bytes / WRITE_OP)
+            # the latency of an operation grows with the load
+            latency = 1.0 + 4.0 * load
+
+            columns = {
+                "cpu": cpu,
+                "processes": numpy.maximum(p["processes"] + p["processesPeak"] * load + noise[5] * 5, 1).astype(numpy.int64),
+                "network_bytes_recv": recv.astype(numpy.int64),
+                "network_bytes_sent": sent.astype(numpy.int64),
+                "network_packets_recv": numpy.ceil(recv / RECV_PACKET).astype(numpy.int64),
+                "network_packets_sent": numpy.ceil(sent / SENT_PACKET).astype(numpy.int64),
+                "io_disk_read_bytes": read_bytes.astype(numpy.int64),
+                "io_disk_write_bytes": write_bytes.astype(numpy.int64),
+                "io_disk_read_count": read_count.astype(numpy.int64),
+                "io_disk_write_count": write_count.astype(numpy.int64),
+                "io_disk_read_time": (read_count * latency).astype(numpy.int64),
+                "io_disk_write_time": (write_count * latency * 1.5).astype(numpy.int64),
+            }
+
+            # the cpu use splits into the busy cpu times; iowait follows the disk latency, softirq the traffic
+            system = cpu * 0.2
+            irq = cpu * 0.02
+            softirq = cpu * 0.05 * numpy.minimum(load, 1.0)
+            steal = numpy.minimum(numpy.abs(noise[4]) * 0.1, cpu * 0.1)
+            iowait = numpy.minimum(latency * 0.5 * (0.05 + load), 100 - cpu)
+            busy = {
+                "user": cpu - system - irq - softirq - steal,
+                "system": system,
+                "nice": numpy.zeros_like(cpu),
+                "irq": irq,
+                "softirq": softirq,
+                "iowait": iowait,
+                "steal": steal,
+                "idle": numpy.maximum(100 - cpu - iowait, 0.0),
+            }
+            for name in CPU_TIMES:
+                columns["cpu_times_" + name] = numpy.round(busy[name], 1)
+
+            # memory above 95% of the total goes to the swap
+            demand = mem_base + (p["memLoad"] * load + leak) * mem_total + noise[4] * (mem_total * 0.002)
+            used = numpy.clip(demand, 0, mem_total * 0.95)
+            swap_used = numpy.clip(demand - used, 0, swap_total)
+            columns.update({
+                "mem_virtual_used": used.astype(numpy.int64),
+                "mem_virtual_free": numpy.maximum(mem_total - float(mem_virtual["cached"]) - used, 0).astype(numpy.int64),
+                "mem_virtual_available": (mem_total - used).astype(numpy.int64),
+                "mem_virtual_percent": numpy.round(used * 100 / mem_total, 1),
+                "mem_swap_used": swap_used.astype(numpy.int64),
+                "mem_swap_free": (swap_total - swap_used).astype(numpy.int64),
+                "mem_swap_percent": numpy.round(swap_used * 100 / swap_total, 1) if swap_total else numpy.zeros_like(used),
+            })
+
+            days = (t - self.start_date) / 86400
+            for idx, (total, start_used) in enumerate(disks):
+                grown = numpy.minimum(start_used + p["diskGrowth"] * days, total)
+                disk_used = numpy.minimum(grown + fill[idx] * (total - grown), total)
+                columns.update({
+                    "disk{}_used".format(idx): disk_used.astype(numpy.int64),
+                    "disk{}_free".format(idx): (total - disk_used).astype(numpy.int64),
+                    "disk{}_percent".format(idx): numpy.round(disk_used * 100 / total, 1),
+                })
+            yield t0, columns
+
+
+def load_scenario(filename, snapshot, paths, start_date, interval, seed):
+    config = ConfigParser.RawConfigParser()
+    # the option names are camelCase
+    config.optionxform = str
+    if not config.read(filename):
+        raise IOError("cannot read the scenario {}".format(filename))
+    fleets = []
+    incidents = []
+    for section in config.sections():
+        if section.startswith(FLEET_SECTION):
+            fleet = dict(FLEET_DEFAULTS)
+            for key, value in config.items(section):
+                if key not in FLEET_DEFAULTS:
+                    raise ValueError("unknown fleet option in [{}]: {}".format(section, key))
+                fleet[key] = value if key in STRING_OPTIONS else type(FLEET_DEFAULTS[key])(value)
+            fleet["name"] = section[len(FLEET_SECTION):].strip()
+            fleets.append(fleet)
+        elif section.startswith(INCIDENT_SECTION):
+            incidents.append((section[len(INCIDENT_SECTION):].strip(), dict(config.items(section))))
+    if not fleets:
+        raise ValueError("no [fleet <name>] section in {}".format(filename))
+    return Scenario(fleets, incidents, snapshot, paths, start_date, interval, seed)
+
+
+def default_snapshot():
+    "Host values to start from when no snapshot is given: 16 GB of memory, 4 GB of swap, 3 disks of 200 GB."
+    return {
+        "mem_virtual_data": {"total": 16 << 30, "used": 6 << 30, "cached": 4 << 30, "active": 8 << 30,
+                             "inactive": 3 << 30, "buffers": 300 << 20, "shared": 500 << 20},
+        "mem_swap_data": {"total": 4 << 30},
+        "paths_data": [{"total": 200 << 30, "used": used << 30} for used in [60, 20, 5]],
+    }
+
+
+def bench(filename, days, interval):
+    paths = [{"name": "root", "path": "/"}, {"name": "opt", "path": "/opt"}, {"name": "tmp", "path": "/tmp"}]
+    # a Monday, midnight UTC
+    start_date = calendar.timegm((2017, 10, 16, 0, 0, 0))
+    scenario = load_scenario(filename, default_snapshot(), paths, start_date, interval, 1)
+    ndata = int(days * 86400 / interval)
+    hourly = numpy.zeros(24)
+    counts = numpy.zeros(24)
+    start = time.time()
+    for t0, columns in scenario.series(range(scenario.nhost), ndata, chunk_size(scenario.nhost)):
+        hours = ((start_date + interval * numpy.arange(t0, t0 + columns["cpu"].shape[1])) % 86400 // 3600).astype(int)
+        hourly += numpy.bincount(hours, weights=columns["cpu"].sum(axis=0), minlength=24)
+        counts += numpy.bincount(hours, minlength=24) * scenario.nhost
+    took = time.time() - start
+    cells = scenario.nhost * ndata
+    print "{} hosts x {} timestamps: {:.2f} s, {:.0f} documents/s".format(scenario.nhost, ndata, took, cells / took)
+    print "mean cpu per hour (UTC): " + " ".join("{:.0f}".format(v) for v in hourly / numpy.maximum(counts, 1))
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 30,
+          int(sys.argv[3]) if len(sys.argv) > 3 else 300)
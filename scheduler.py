@@ -0,0 +1,216 @@
+"""
+Single-thread scheduler for the reporters of the monitoring agent.
+
+Every reporter used to be a TaskThread sleeping `interval` seconds after each
+task(), so each new reporter added a thread, and the reports drifted by the
+collection time on every tick. Scheduler keeps all the tasks in one heap,
+ordered by due time, and sleeps until the next one is due:
+    - fixed rate: a task is due every `interval` seconds from its first run,
+      however long it took
+    - jitter: the first run is delayed by up to `jitter` * interval, so
+      reporters with the same interval do not all collect at the same time
+    - missed ticks: when a task overruns its next slot, the slots it missed
+      are skipped and counted instead of running late back-to-back
+    - workers: with a pool, tasks run on worker threads and a slow collector
+      does not delay the others; a task still running when due misses the
+      tick
+
+Usage: python scheduler.py [tasks] [seconds] compares the thread per task
+and the scheduler for tasks running every 50 ms.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import Queue
+
+from meters import monotonic
+
+
+JITTER = 0.1
+WORKERS = 0
+# longest sleep, shutdown() is seen at least that often
+MAX_SLEEP = 1.0
+
+
+"""
+    Job is a task scheduled every `interval` seconds, with its counters.
+"""
+class Job():
+    def __init__(self, task, interval, slot):
+        self.task = task
+        self.name = getattr(task, "app_name", task.__class__.__name__)
+        self.interval = interval
+        self.slot = slot
+        self.running = False
+        self.runs = 0
+        self.missed = 0
+        self.max_late = 0.0
+
+    def counters(self):
+        return {"runs": self.runs, "missed": self.missed, "max_late_ms": round(self.max_late * 1000, 1)}
+
+
+"""
+    Scheduler runs the task() of objects with an `interval` attribute
+    (reporters, samplers) at a fixed rate, from the thread calling run().
+"""
+class Scheduler():
+    def __init__(self, workers=WORKERS, jitter=JITTER):
+        self.jitter = jitter
+        self.heap = []
+        self.jobs = []
+        self.sequence = itertools.count()
+        self.stopped = False
+        # the job counters are updated from the worker threads
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+        self.pool = None
+        self.workers = []
+        if workers > 0:
+            self.pool = Queue.Queue()
+            for _ in range(workers):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def add(self, task, interval=None):
+        interval = interval or task.interval
+        job = Job(task, interval, monotonic() + random.uniform(0, self.jitter * interval))
+        self.jobs.append(job)
+        heapq.heappush(self.heap, (job.slot, next(self.sequence), job))
+        return job
+
+    def counters(self):
+        with self.lock:
+            return dict((job.name, job.counters()) for job in self.jobs)
+
+    def _execute(self, job, slot):
+        "Run the task of `job` for its tick due at `slot` (job.slot is already the next one with a pool)."
+        start = monotonic()
+        with self.lock:
+            job.max_late = max(job.max_late, start - slot)
+        try:
+            job.task.task()
+        except Exception:
+            self.logger.exception("task %s failed", job.name)
+        finally:
+            with self.lock:
+                job.runs += 1
+                job.running = False
+
+    def _work(self):
+        while True:
+            item = self.pool.get()
+            if item is None:
+                return
+            self._execute(*item)
+
+    def _dispatch(self, job):
+        with self.lock:
+            if job.running:
+                # still busy with the previous tick, in a worker
+                job.missed += 1
+                return
+            job.running = True
+        if self.pool is None:
+            self._execute(job, job.slot)
+        else:
+            self.pool.put((job, job.slot))
+
+    def _reschedule(self, job, now):
+        job.slot += job.interval
+        if job.slot <= now:
+            missed = int((now - job.slot) // job.interval) + 1
+            with self.lock:
+                job.missed += missed
+            job.slot += missed * job.interval
+        heapq.heappush(self.heap, (job.slot, next(self.sequence), job))
+
+    def run(self):
+        "Run the tasks until shutdown()."
+        while not self.stopped and self.heap:
+            due = self.heap[0][0]
+            delay = due - monotonic()
+            if delay > 0:
+                time.sleep(min(delay, MAX_SLEEP))
+                continue
+            job = heapq.heappop(self.heap)[2]
+            self._dispatch(job)
+            self._reschedule(job, monotonic())
+
+    def shutdown(self):
+        self.stopped = True
+        if self.pool is not None:
+            for _ in self.workers:
+                self.pool.put(None)
+
+
+class _DelayThread(threading.Thread):
+    "The thread per reporter metrics-to-syslog.py used (TaskThread), for the benchmark."
+    def __init__(self, task, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.finished = threading.Event()
+        self.task = task
+        self.interval = interval
+
+    def run(self):
+        while not self.finished.isSet():
+            self.task()
+            self.finished.wait(self.interval)
+
+
+class _Counter():
+    "A task taking a little CPU time, counting its runs."
+    def __init__(self, interval):
+        self.interval = interval
+        self.runs = 0
+
+    def task(self):
+        self.runs += 1
+        sum(xrange(2000))
+
+
+def bench(tasks, seconds):
+    "CPU time and runs of `tasks` tasks every 50 ms, for each way of running them."
+    interval = 0.05
+    expected = tasks * seconds / interval
+
+    counters = [_Counter(interval) for _ in range(tasks)]
+    threads = [_DelayThread(counter.task, interval) for counter in counters]
+    start = os.times()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    for thread in threads:
+        thread.finished.set()
+    end = os.times()
+    print "{:<20} {:>8.0f} ms CPU {:>6.1f}% of the expected runs".format(
+        "thread per task", ((end[0] - start[0]) + (end[1] - start[1])) * 1000,
+        sum(counter.runs for counter in counters) * 100.0 / expected)
+
+    counters = [_Counter(interval) for _ in range(tasks)]
+    scheduler = Scheduler(jitter=1.0)
+    for counter in counters:
+        scheduler.add(counter)
+    timer = threading.Timer(seconds, scheduler.shutdown)
+    start = os.times()
+    timer.start()
+    scheduler.run()
+    end = os.times()
+    print "{:<20} {:>8.0f} ms CPU {:>6.1f}% of the expected runs".format(
+        "scheduler", ((end[0] - start[0]) + (end[1] - start[1])) * 1000,
+        sum(counter.runs for counter in counters) * 100.0 / expected)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    bench(*(args + [50, 5][len(args):]))
@@ -0,0 +1,63 @@
+"""
+Self reporter plugin: the overhead of the agent itself, as a
+monitoring-agent-self document every [self] pollingInSec seconds.
+
+It carries the CPU use (user + system, percent of one CPU) and resident
+memory of the agent process, the stage timing histograms of every reporter
+since the previous document (see instrumentation.py), the scheduler
+counters (runs, missed ticks, lateness) and the send queue counters.
+"""
+
+import os
+import threading
+
+from instrumentation import rss_bytes, timings
+from meters import monotonic
+from reporter import AReporter
+from send_queue import QueuedHandler, QUEUE_SIZE, DROP_OLDEST, REPLAY_RATE
+
+
+"""
+    SelfReporter reports the agent overhead. `context` is the ReporterContext
+    listing the other reporters and the scheduler.
+"""
+class SelfReporter(AReporter):
+    # os.times() and /proc/self/statm
+    COLLECT_COST = 0.0001
+
+    def __init__(self, syslog_host, syslog_hostname, syslog_port, interval, context=None, transport=None,
+                 queue_size=QUEUE_SIZE, overflow=DROP_OLDEST, spool=None, replay_rate=REPLAY_RATE):
+        super(SelfReporter, self).__init__("monitoring-agent-self", syslog_host, syslog_hostname, syslog_port, interval,
+                                           transport, queue_size, overflow, spool, replay_rate)
+        self.context = context
+        self.last_times = None
+        self.cpu_percent = 0.0
+        self.rss = 0
+        self.threads = 0
+
+    def collect(self):
+        super(SelfReporter, self).collect()
+        times = os.times()
+        now = (monotonic(), times[0] + times[1])
+        if self.last_times is not None and now[0] > self.last_times[0]:
+            self.cpu_percent = round((now[1] - self.last_times[1]) * 100.0 / (now[0] - self.last_times[0]), 2)
+        self.last_times = now
+        self.rss = rss_bytes()
+        self.threads = threading.active_count()
+
+    def process(self):
+        data = {
+            "agent": {"pid": os.getpid(), "cpu_percent": self.cpu_percent, "rss": self.rss, "threads": self.threads},
+            "stages": timings.summary(),
+        }
+        if self.context is not None:
+            if self.context.scheduler is not None:
+                data["scheduler"] = self.context.scheduler.counters()
+            data["queues"] = dict((reporter.app_name, reporter.handler.counters()) for reporter in self.context.reporters
+                                  if isinstance(reporter.handler, QueuedHandler))
+        return data
+
+
+def create_reporter(context):
+    return SelfReporter(context.syslog_host, context.syslog_hostname, context.syslog_port, context.interval_for("self"),
+                        context, context.transport(), context.queue_size, context.overflow_for(None), None, context.replay_rate)
@@ -0,0 +1,326 @@
+"""
+Non-blocking send pipeline for the monitoring agent.
+
+The reporters used to call the syslog handler from the collection thread, so
+a slow collector delayed the next collect(). QueuedHandler encodes the
+records and puts them in a bounded queue instead, and a sender thread hands
+them to the transport. When the queue is full the overflow policy decides:
+    - drop-oldest: the oldest queued message is dropped (default)
+    - block: the reporter waits for room in the queue
+    - spill: the message goes to the disk spool and is sent when the queue
+      has drained
+
+With a spool (see spool.py), messages the transport fails to send are kept
+on disk instead of being lost, and replayed at a limited rate once the
+collector is back. Live messages always go first. A message failing with
+an error of its own (EMSGSIZE, EINVAL) is dropped instead of being retried,
+and a spooled message is given up after REPLAY_ATTEMPTS failed replays, so
+one bad record cannot keep the live stream on disk.
+
+Usage: python send_queue.py checks that an oversized message, live or at
+the head of the spool, is dropped and the other messages are delivered.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import Queue
+
+from meters import monotonic_ns
+
+
+QUEUE_SIZE = 1000
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
+SPILL = "spill"
+POLICIES = [DROP_OLDEST, BLOCK, SPILL]
+REPLAY_RATE = 200
+RETRY_INTERVAL = 10
+IDLE_WAIT = 0.1
+REPLAY_ATTEMPTS = 10
+# send errors of the message itself, that no retry will fix
+PERMANENT_ERRORS = (errno.EMSGSIZE, errno.EINVAL)
+
+
+"""
+    QueuedHandler is a logging handler that queues the messages of a
+    TransportSysLogHandler, whose transport is called from a dedicated
+    sender thread.
+
+    Counters: queued, sent, dropped, spilled (queue overflow), spooled (send
+    failures) and replayed messages.
+"""
+class QueuedHandler(logging.Handler):
+    def __init__(self, handler, size=QUEUE_SIZE, policy=DROP_OLDEST, spool=None,
+                 replay_rate=REPLAY_RATE, retry=RETRY_INTERVAL):
+        logging.Handler.__init__(self)
+        if policy not in POLICIES:
+            raise ValueError("unknown overflow policy: {}".format(policy))
+        if policy == SPILL and spool is None:
+            raise ValueError("the spill policy needs a spool")
+        self.handler = handler
+        self.transport = handler.transport
+        self.policy = policy
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.retry = retry
+        self.queue = Queue.Queue(max(1, size))
+        self.counter_lock = threading.Lock()
+        self.spool_lock = threading.Lock()
+
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.down_until = 0
+        # failed replays of the message at the head of the spool
+        self.replay_failures = 0
+        self.replay_allowance = 0.0
+        self.last_replay = time.time()
+        # histogram of the transport writes, set by the reporter
+        self.timing = None
+
+        self.closed = threading.Event()
+        self.sender = threading.Thread(target=self._send_loop)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def counters(self):
+        return {"queued": self.queued, "sent": self.sent, "dropped": self.dropped, "spilled": self.spilled,
+                "spooled": self.spooled, "replayed": self.replayed, "pending": self.queue.qsize(),
+                "evicted_segments": self.spool.evicted if self.spool is not None else 0}
+
+    def emit(self, record):
+        try:
+            # encoded now: the header keeps the collection time
+            data = self.handler.encode(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+            return
+        if self.policy == BLOCK:
+            self.queue.put(data)
+        else:
+            self._put_nowait(data)
+        with self.counter_lock:
+            self.queued += 1
+
+    def _put_nowait(self, data):
+        while True:
+            try:
+                self.queue.put_nowait(data)
+                return
+            except Queue.Full:
+                pass
+            if self.policy == SPILL:
+                self._to_spool([data])
+                with self.counter_lock:
+                    self.spilled += 1
+                return
+            try:
+                self.queue.get_nowait()
+                with self.counter_lock:
+                    self.dropped += 1
+            except Queue.Empty:
+                pass
+
+    def _to_spool(self, messages):
+        with self.spool_lock:
+            for data in messages:
+                self.spool.append(data)
+
+    def _failed(self, error, failing, replaying=False):
+        """
+        The transport failed to send `failing`: keep what it still held and,
+        unless the message itself is at fault, wait before retrying.
+        """
+        permanent = error.errno in PERMANENT_ERRORS
+        if not permanent:
+            self.down_until = time.time() + self.retry
+        messages = self.transport.drain()
+        if replaying or permanent:
+            # a replayed message is still at the head of the spool, a permanent failure is not kept
+            for idx in range(len(messages) - 1, -1, -1):
+                if messages[idx] is failing:
+                    del messages[idx]
+                    break
+        if replaying:
+            self.replay_failures += 1
+            if permanent or self.replay_failures >= REPLAY_ATTEMPTS:
+                with self.spool_lock:
+                    self.spool.advance()
+                self.replay_failures = 0
+                with self.counter_lock:
+                    self.dropped += 1
+        elif permanent:
+            with self.counter_lock:
+                self.dropped += 1
+        if self.spool is None:
+            with self.counter_lock:
+                self.dropped += len(messages)
+            return
+        self._to_spool(messages)
+        with self.counter_lock:
+            self.spooled += len(messages)
+
+    def _send(self, data):
+        if time.time() < self.down_until:
+            # the collector is down, keep the live stream in order behind the spool
+            if self.spool is not None:
+                self._to_spool([data])
+                with self.counter_lock:
+                    self.spooled += 1
+            else:
+                with self.counter_lock:
+                    self.dropped += 1
+            return
+        start = monotonic_ns()
+        try:
+            self.transport.send(data)
+        except socket.error as e:
+            self._failed(e, data)
+            return
+        if self.timing is not None:
+            self.timing.record(monotonic_ns() - start)
+        with self.counter_lock:
+            self.sent += 1
+
+    def _replay(self):
+        "Send spooled messages at `replay_rate`, as long as there is no live message."
+        now = time.time()
+        self.replay_allowance = min(self.replay_rate, self.replay_allowance + (now - self.last_replay) * self.replay_rate)
+        self.last_replay = now
+        if self.spool is None or now < self.down_until:
+            return
+        while self.replay_allowance >= 1 and self.queue.empty():
+            with self.spool_lock:
+                data = self.spool.peek()
+            if data is None:
+                return
+            try:
+                self.transport.send(data)
+            except socket.error as e:
+                self._failed(e, data, replaying=True)
+                return
+            with self.spool_lock:
+                self.spool.advance()
+            self.replay_failures = 0
+            self.replay_allowance -= 1
+            with self.counter_lock:
+                self.replayed += 1
+
+    def _send_loop(self):
+        while True:
+            try:
+                data = self.queue.get(timeout=IDLE_WAIT)
+            except Queue.Empty:
+                if self.closed.is_set():
+                    return
+                self._replay()
+                continue
+            if data is None:
+                return
+            self._send(data)
+            self._replay()
+
+    def flush(self):
+        try:
+            self.transport.flush()
+        except socket.error as e:
+            self._failed(e, None)
+
+    def close(self):
+        if not self.closed.is_set():
+            self.closed.set()
+            self.queue.put(None)
+            self.sender.join()
+            self.flush()
+            if self.spool is not None:
+                self.spool.close()
+            self.handler.close()
+        logging.Handler.close(self)
+
+
+class _DatagramTransport():
+    "A transport sending each message with its own send() and raising the errors, for the check."
+    stream = False
+
+    def __init__(self, address):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(address)
+        self.queue = []
+
+    def send(self, data):
+        self.queue.append(data)
+        self.flush()
+
+    def flush(self):
+        while self.queue:
+            self.socket.send(self.queue[0])
+            del self.queue[0]
+
+    def drain(self):
+        queue = self.queue
+        self.queue = []
+        return queue
+
+    def close(self):
+        self.socket.close()
+
+
+def _received(receiver):
+    count = 0
+    try:
+        while True:
+            receiver.recv(1 << 17)
+            count += 1
+    except socket.timeout:
+        return count
+
+
+def check():
+    "Send an oversized datagram, live then at the head of the spool, followed by normal messages."
+    from spool import SegmentSpool
+    from syslog_transport import TransportSysLogHandler, create_transport
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(0.5)
+    logger = logging.getLogger("send_queue.check")
+    logger.propagate = False
+    directory = tempfile.mkdtemp()
+    try:
+        for name, transport, spooled in [("batched UDP transport", create_transport("udp", [receiver.getsockname()]), 0),
+                                         ("raising transport", _DatagramTransport(receiver.getsockname()), 0),
+                                         ("raising transport, spooled", _DatagramTransport(receiver.getsockname()), 5)]:
+            spool = SegmentSpool(os.path.join(directory, str(len(os.listdir(directory)))))
+            if spooled:
+                spool.append("x" * 70000)
+                for n in range(spooled):
+                    spool.append("spooled {}".format(n))
+            handler = QueuedHandler(TransportSysLogHandler(transport), spool=spool, retry=0.5)
+            logger.addHandler(handler)
+            if not spooled:
+                logger.error("x" * 70000)
+            for n in range(20):
+                logger.error("message {}".format(n))
+            time.sleep(1)
+            received = _received(receiver)
+            logger.removeHandler(handler)
+            handler.close()
+            ok = received == 20 + spooled and spool.empty()
+            print "{:<28} {:>3} received {} {}".format(name, received, handler.counters(), "ok" if ok else "FAILED")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    check()
@@ -0,0 +1,263 @@
+"""
+JSON serialization of the metric documents.
+
+Serializer wraps the fastest JSON backend available (orjson, ujson, then the
+standard json module) behind dumps() and compact(), so the agent and the
+writers do not depend on which one is installed:
+
+    [syslog]
+    jsonBackend = auto            (or orjson, ujson, json)
+
+Most fields of a generated document are the same from one document to the
+next (store, location, disk names and paths...). A DocumentTemplate
+pre-encodes the document once with its varying fields left out, and then
+only encodes these fields per document: the JSON text is a format string
+filled with the encoded values. TemplatedSerializer builds and reuses the
+templates of documents whose constant fields are known.
+
+Usage: python serialization.py [count] prints the documents per second of
+each backend and of the templates.
+"""
+
+import json
+import operator
+import sys
+import time
+
+
+BACKENDS = ["orjson", "ujson", "json"]
+AUTO = "auto"
+MAX_TEMPLATES = 4096
+
+
+def load_backend(name):
+    "(dumps, compact dumps) of the backend `name`, ImportError when it is not installed."
+    if name == "orjson":
+        import orjson
+        dumps = lambda obj: orjson.dumps(obj).decode("utf-8")
+        # orjson output is always compact
+        return dumps, dumps
+    if name == "ujson":
+        import ujson
+        dumps = lambda obj: ujson.dumps(obj, escape_forward_slashes=False)
+        return dumps, dumps
+    if name == "json":
+        return json.dumps, lambda obj: json.dumps(obj, separators=(",", ":"))
+    raise ValueError("unknown JSON backend: {}".format(name))
+
+
+def available_backends():
+    names = []
+    for name in BACKENDS:
+        try:
+            load_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+"""
+    Serializer is one JSON backend, the first installed one of BACKENDS
+    with "auto".
+"""
+class Serializer():
+    def __init__(self, backend=AUTO):
+        if backend == AUTO:
+            backend = available_backends()[0]
+        self.backend = backend
+        self.dumps, self.compact = load_backend(backend)
+
+
+# the values formatted straight into the template, all the others go through json.dumps
+DIRECT = {int: "%d", long: "%d", float: "%r"}
+
+
+"""
+    Field marks a per-document value in a document template.
+"""
+class Field():
+    def __init__(self, name):
+        self.name = name
+
+
+def build_template(pairs):
+    """
+    Pre-encode a document given as a list of (key, value) pairs. Values are
+    constants, Field markers or nested lists of pairs.
+
+    Returns the constant JSON fragments and the ordered names of the fields
+    that go between them: a document is pieces[0] + field0 + pieces[1] + ...
+    """
+    pieces = [""]
+    fields = []
+
+    def encode(items):
+        pieces[-1] += "{"
+        for idx, (key, value) in enumerate(items):
+            if idx:
+                pieces[-1] += ", "
+            pieces[-1] += json.dumps(key) + ": "
+            if isinstance(value, Field):
+                fields.append(value.name)
+                pieces.append("")
+            elif isinstance(value, list):
+                encode(value)
+            else:
+                pieces[-1] += json.dumps(value)
+        pieces[-1] += "}"
+
+    encode(pairs)
+    return pieces, fields
+
+
+def _getter(keys):
+    "A function returning the tuple of the values of `keys` in a dict."
+    if len(keys) > 1:
+        return operator.itemgetter(*keys)
+    return lambda doc: tuple(doc[key] for key in keys)
+
+
+"""
+    DocumentTemplate renders the documents of one build_template() layout
+    from the values of their fields. The text of the document is a format
+    string of the constant fragments, with a %d or %r (what json.dumps writes
+    for floats) for each number field: a document is rendered by a single
+    format operation, the other values (strings...) are encoded first. There
+    is one format per combination of value types. NaN and infinite floats
+    are not valid JSON and are written as Python writes them.
+"""
+class DocumentTemplate():
+    def __init__(self, pairs):
+        self.pieces, self.fields = build_template(pairs)
+        self.get_values = _getter(self.fields)
+        # value types -> (format, indexes of the values to encode)
+        self.formats = {}
+
+    @classmethod
+    def from_document(cls, doc, constants):
+        "The template of a flat document whose keys in `constants` keep their current value."
+        return cls([(key, value if key in constants else Field(key)) for key, value in doc.iteritems()])
+
+    def _format(self, types):
+        specifiers = [DIRECT.get(value_type, "%s") for value_type in types]
+        text = self.pieces[0].replace("%", "%%")
+        for specifier, piece in zip(specifiers, self.pieces[1:]):
+            text += specifier + piece.replace("%", "%%")
+        encoded = [idx for idx, value_type in enumerate(types) if value_type not in DIRECT]
+        self.formats[types] = (text, encoded)
+        return text, encoded
+
+    def render(self, values):
+        "The JSON text of the document whose fields have the `values` (a tuple), in the order of self.fields."
+        types = tuple(map(type, values))
+        text, encoded = self.formats.get(types) or self._format(types)
+        if encoded:
+            values = list(values)
+            for idx in encoded:
+                values[idx] = json.dumps(values[idx])
+            values = tuple(values)
+        return text % values
+
+    def render_document(self, doc):
+        "The JSON text of `doc`, a document of this template given as a dict."
+        return self.render(self.get_values(doc))
+
+
+"""
+    TemplatedSerializer serializes flat documents in which only the keys in
+    `fields` change from one document to the next, through one
+    DocumentTemplate per combination of the values of the other keys (a
+    host, a store...). Documents it cannot template (other keys, unhashable
+    values, too many combinations) go through json.dumps.
+"""
+class TemplatedSerializer():
+    def __init__(self, fields, max_templates=MAX_TEMPLATES):
+        self.fields = frozenset(fields)
+        self.max_templates = max_templates
+        # document size -> getter of the constant values
+        self.constants = {}
+        self.templates = {}
+
+    def dumps(self, doc):
+        size = len(doc)
+        constants = self.constants.get(size)
+        if constants is None:
+            constants = self.constants[size] = _getter([key for key in doc if key not in self.fields])
+        try:
+            key = (size, constants(doc))
+            template = self.templates.get(key)
+            if template is None:
+                if len(self.templates) >= self.max_templates:
+                    return json.dumps(doc)
+                template = self.templates[key] = DocumentTemplate.from_document(doc, set(doc) - self.fields)
+            return template.render_document(doc)
+        except (KeyError, TypeError):
+            return json.dumps(doc)
+
+
+def sample_documents():
+    "A nested agent-like document and a flat Solr-like one, with the keys of the varying fields of the latter."
+    nested = {
+        "cpu": 10.0, "cpu_times": dict((name, 1.5) for name in ["user", "system", "idle", "nice", "irq", "softirq", "iowait", "steal"]),
+        "mem": {"virtual": dict((name, 1 << 32) for name in ["total", "available", "used", "free", "active", "inactive", "buffers", "cached", "shared"]),
+                "swap": {"total": 2 << 30, "used": 0, "free": 2 << 30, "percent": 0.0}},
+        "disks": [{"name": name, "path": path, "total": 100 << 30, "used": 40 << 30, "free": 60 << 30, "percent": 40.0}
+                  for name, path in [("root", "/"), ("opt", "/opt"), ("tmp", "/tmp")]],
+        "networks": [{"name": "eth0", "bytes_sent": 12345, "bytes_recv": 67890, "packets_sent": 12, "packets_recv": 34}],
+        "processes": 120, "location": "38.9828591,-4.002638", "province": "CR", "city": "CiudadReal", "store": "Olivo",
+    }
+    flat = {"store_location": "40.471032,-3.686893", "province": "M", "city": "Madrid", "store": "Vasconcelos",
+            "network_name": "enp0s25", "io_disk_name": "sda6", "host": "hostname0", "time": "2017-10-18T13:24:51Z",
+            "processes": 297, "cpu": 12.7}
+    fields = ["cpu", "processes", "time", "mem_virtual_used", "mem_virtual_free", "io_disk_read_bytes", "io_disk_write_bytes",
+              "network_bytes_recv", "network_bytes_sent", "network_packets_recv", "network_packets_sent"]
+    for name in ["user", "system", "idle", "nice", "irq", "softirq", "iowait", "steal"]:
+        flat["cpu_times_" + name] = 1.5
+    for disk, (name, path) in zip(["disk0", "disk1", "disk2"], [("root", "/"), ("opt", "/opt"), ("tmp", "/tmp")]):
+        flat.update({disk + "_name": name, disk + "_path": path, disk + "_used": 40 << 30, disk + "_free": 60 << 30,
+                     disk + "_total": 100 << 30, disk + "_percent": 40.0})
+    for name in ["read_bytes", "read_count", "read_time", "write_bytes", "write_count", "write_time"]:
+        flat["io_disk_" + name] = 1234
+    for name in ["total", "used", "free", "percent"]:
+        flat["mem_swap_" + name] = 1 << 31
+    for name in ["active", "available", "buffers", "cached", "shared", "free", "inactive", "percent", "total", "used"]:
+        flat["mem_virtual_" + name] = 1 << 32
+    for name in ["bytes_recv", "bytes_sent", "packets_recv", "packets_sent"]:
+        flat["network_" + name] = 4321
+    return nested, flat, fields
+
+
+def bench(count):
+    "Documents per second of every installed backend, and of the templates, on the sample documents."
+    nested, flat, fields = sample_documents()
+
+    def rate(dumps, doc, variants):
+        start = time.time()
+        for n in xrange(count):
+            doc["cpu"] = variants[n & 1023]
+            dumps(doc)
+        return count / (time.time() - start)
+
+    variants = [round(n * 0.1, 1) for n in range(1024)]
+    print "{:<24} {:>14} {:>14}".format("serializer", "nested docs/s", "flat docs/s")
+    for backend in available_backends():
+        serializer = Serializer(backend)
+        for label, dumps in [(backend, serializer.dumps), (backend + " compact", serializer.compact)]:
+            print "{:<24} {:>14.0f} {:>14.0f}".format(label, rate(dumps, nested, variants), rate(dumps, flat, variants))
+    templated = TemplatedSerializer(fields)
+    assert templated.dumps(flat) == json.dumps(flat)
+    print "{:<24} {:>14} {:>14.0f}".format("template", "-", rate(templated.dumps, flat, variants))
+    template = DocumentTemplate.from_document(flat, set(flat) - set(fields))
+    values = [flat[name] for name in template.fields]
+    cpu = template.fields.index("cpu")
+
+    start = time.time()
+    for n in xrange(count):
+        values[cpu] = variants[n & 1023]
+        template.render(tuple(values))
+    print "{:<24} {:>14} {:>14.0f}".format("template, values list", "-", count / (time.time() - start))
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,283 @@
+"""
+Direct Solr bulk indexing of the generated stats documents.
+
+SolrWriter takes the documents like ShardedWriter does, but instead of a
+JSON lines file to load afterwards it POSTs them in batches to the
+/update/json/docs handler of a Solr core:
+
+    POST /solr/stats/update/json/docs?commitWithin=10000
+    [{...}, {...}, ...]
+
+`concurrency` sender threads each keep one keep-alive HTTP connection and
+post one batch at a time, so at most `concurrency` batches are in flight and
+as many wait in the queue: the generator blocks instead of buffering when
+Solr is slower than it. A batch failing with a connection error or a 429/5xx
+status is retried with exponential backoff; the writer raises SolrError once
+a batch is given up or refused.
+
+A small stand-in of Solr makes the mode testable offline: it accepts the
+same requests, checks and counts the documents, and can fail a share of the
+requests to exercise the retries.
+
+Usage:
+    python solr_output.py serve [port] [fail_rate]   run the stand-in
+    python solr_output.py bench [count]               docs/s through the stand-in
+"""
+
+import BaseHTTPServer
+import httplib
+import json
+import multiprocessing
+import Queue
+import random
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+
+BATCH_SIZE = 1000
+CONCURRENCY = 2
+RETRIES = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+COMMIT_WITHIN = 10000
+TIMEOUT = 60
+UPDATE_PATH = "/update/json/docs"
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+PORT = 8983
+
+
+class SolrError(Exception):
+    pass
+
+
+"""
+    SolrWriter indexes the documents into the Solr core at `url`
+    (http://host:port/solr/core), `batch_size` documents per request.
+"""
+class SolrWriter():
+    def __init__(self, url, batch_size=BATCH_SIZE, concurrency=CONCURRENCY, retries=RETRIES, backoff=BACKOFF,
+                 commit_within=COMMIT_WITHIN, timeout=TIMEOUT, dumps=None):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme != "http":
+            raise ValueError("unsupported Solr URL: {}".format(url))
+        self.address = (parsed.hostname, parsed.port or PORT)
+        self.path = parsed.path.rstrip("/") + UPDATE_PATH
+        if commit_within:
+            self.path += "?commitWithin={}".format(commit_within)
+        self.batch_size = max(1, batch_size)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.dumps = dumps or json.dumps
+
+        # nothing is written locally
+        self.paths = []
+        self.batch = []
+        self.documents = 0
+        self.batches = 0
+        self.retried = 0
+        self.bytes = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.pending = Queue.Queue(max(1, concurrency))
+        self.senders = [threading.Thread(target=self._send_batches) for _ in range(max(1, concurrency))]
+        for sender in self.senders:
+            sender.daemon = True
+            sender.start()
+
+    def write(self, document):
+        self.write_line(self.dumps(document))
+
+    def write_line(self, line):
+        "Queue one already serialized document."
+        self.batch.append(line)
+        self.documents += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def write_lines(self, lines):
+        for line in lines:
+            self.write_line(line)
+
+    def flush(self):
+        "Hand the current batch to a sender, waiting while all of them are busy."
+        if self.error is not None:
+            raise self.error
+        if self.batch:
+            self.pending.put("[" + ",".join(self.batch) + "]")
+            self.batch = []
+
+    def close(self):
+        if self.senders:
+            try:
+                self.flush()
+            finally:
+                for _ in self.senders:
+                    self.pending.put(None)
+                for sender in self.senders:
+                    sender.join()
+                self.senders = []
+        if self.error is not None:
+            raise self.error
+
+    def counters(self):
+        return {"documents": self.documents, "batches": self.batches, "retried": self.retried, "bytes": self.bytes}
+
+    def _send_batches(self):
+        conn = httplib.HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+        while True:
+            body = self.pending.get()
+            if body is None:
+                break
+            if self.error is not None:
+                # failed already: drain the queue so that flush() does not block
+                continue
+            try:
+                self._post(conn, body)
+            except SolrError as e:
+                self.error = e
+        conn.close()
+
+    def _post(self, conn, body):
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self.lock:
+                    self.retried += 1
+                # exponential backoff with jitter, so the senders do not retry in step
+                time.sleep(min(self.backoff * (1 << (attempt - 1)), MAX_BACKOFF) * random.uniform(0.5, 1.0))
+            try:
+                conn.request("POST", self.path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException) as e:
+                # reconnects on the next request
+                conn.close()
+                reason = str(e)
+                continue
+            if response.status == 200:
+                with self.lock:
+                    self.batches += 1
+                    self.bytes += len(body)
+                return
+            reason = "HTTP {}: {}".format(response.status, data[:200])
+            if response.status not in RETRY_STATUSES:
+                raise SolrError(reason)
+        raise SolrError("batch given up after {} retries, {}".format(self.retries, reason))
+
+
+"""
+    StandInHandler answers the update requests like Solr does, counting the
+    documents of the server.
+"""
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, and no Nagle delay between the header and body writes of a response
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        start = time.time()
+        body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        server = self.server
+        if server.fail_rate and random.random() < server.fail_rate:
+            self._respond(503, {"error": {"msg": "stand-in failure", "code": 503}})
+            with server.lock:
+                server.failed += 1
+            return
+        if not urlparse.urlparse(self.path).path.endswith(UPDATE_PATH):
+            self._respond(404, {"error": {"msg": "unknown handler", "code": 404}})
+            return
+        try:
+            docs = json.loads(body)
+        except ValueError as e:
+            self._respond(400, {"error": {"msg": str(e), "code": 400}})
+            return
+        with server.lock:
+            server.documents += len(docs) if isinstance(docs, list) else 1
+            server.requests += 1
+        self._respond(200, {"responseHeader": {"status": 0, "QTime": int((time.time() - start) * 1000)}})
+
+    def do_GET(self):
+        server = self.server
+        self._respond(200, {"documents": server.documents, "requests": server.requests, "failed": server.failed})
+
+    def _respond(self, status, message):
+        data = json.dumps(message)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fail_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandInHandler)
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.requests = 0
+        self.failed = 0
+
+
+def _serve(conn, fail_rate):
+    "Stand-in process of the benchmark: send its port, serve until told to stop, send the document and failure counts."
+    server = StandInServer(("127.0.0.1", 0), fail_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    conn.send(server.server_address[1])
+    conn.recv()
+    conn.send((server.documents, server.failed))
+    server.shutdown()
+
+
+def bench(count):
+    "Index `count` documents into a stand-in in another process for several batch sizes and concurrencies."
+    doc = json.dumps(dict(("field{}".format(n), n * 1.5) for n in range(60)))
+    print "{:>6} {:>5} {:>6} {:>12} {:>8} {:>8} {:>8}".format("batch", "conc", "fail", "docs/s", "failed", "retried",
+                                                             "indexed")
+    for batch_size, concurrency, fail_rate in [(100, 1, 0.0), (1000, 1, 0.0), (1000, 4, 0.0), (5000, 4, 0.0), (1000, 4, 0.1)]:
+        conn, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve, args=(child, fail_rate))
+        server.start()
+        port = conn.recv()
+
+        writer = SolrWriter("http://127.0.0.1:{}/solr/stats".format(port), batch_size, concurrency, backoff=0.01)
+        start = time.time()
+        for _ in xrange(count):
+            writer.write_line(doc)
+        writer.close()
+        took = time.time() - start
+        conn.send(None)
+        indexed, failed = conn.recv()
+        server.join()
+        print "{:>6} {:>5} {:>6.2f} {:>12.0f} {:>8} {:>8} {:>8}".format(batch_size, concurrency, fail_rate, count / took,
+                                                                        failed, writer.retried, indexed)
+
+
+def serve(port, fail_rate):
+    server = StandInServer(("0.0.0.0", port), fail_rate)
+    print "Solr stand-in on http://{}:{}/solr/<core>{}".format(socket.gethostname(), port, UPDATE_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print "{} documents in {} requests, {} failed".format(server.documents, server.requests, server.failed)
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+    if command == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
+    else:
+        serve(int(sys.argv[2]) if len(sys.argv) > 2 else PORT, float(sys.argv[3]) if len(sys.argv) > 3 else 0.0)
@@ -0,0 +1,194 @@
+"""
+Disk spool for the syslog messages the agent could not send.
+
+Messages are appended to segment files (00000001.seg, 00000002.seg...) in a
+spool directory, each one as a 4-byte length followed by the message bytes.
+Appends are fsync'ed in batches, and when the spool grows over its size cap
+the oldest segment is evicted. The read side walks the segments from the
+oldest one; its position is kept in a small offset file so a restarted agent
+carries on where it stopped (a few messages can be sent twice, none lost).
+"""
+
+import glob
+import os
+import struct
+import time
+
+
+SEGMENT_BYTES = 4 << 20
+MAX_BYTES = 64 << 20
+SYNC_EVERY = 100
+SYNC_INTERVAL = 1.0
+HEADER = struct.Struct("<I")
+OFFSET_FILE = "head.offset"
+
+
+"""
+    SegmentSpool is an append-only, size-capped message spool.
+
+    append() adds a message, peek() returns the oldest unsent one and
+    advance() marks it sent.
+"""
+class SegmentSpool():
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_bytes=MAX_BYTES,
+                 sync_every=SYNC_EVERY, sync_interval=SYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(os.path.basename(path)[:-4])
+                               for path in glob.glob(os.path.join(directory, "[0-9]*.seg")))
+        self.sizes = dict((segment, os.path.getsize(self.segment_path(segment))) for segment in self.segments)
+
+        self.writer = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.reader = None
+        self.reader_segment = None
+        self.offset = 0
+        self.next_offset = None
+        self.unsaved = 0
+        self.last_save = time.time()
+        self.evicted = 0
+
+        if self.segments:
+            self._load_offset()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, "{:08d}.seg".format(segment))
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as offset_file:
+                segment, offset = [int(value) for value in offset_file.read().split()]
+        except (IOError, ValueError):
+            return
+        if segment in self.sizes:
+            while self.segments[0] != segment:
+                self._remove_head()
+            self.offset = offset
+
+    def _save_offset(self):
+        self.unsaved = 0
+        self.last_save = time.time()
+        if not self.segments:
+            return
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(path + ".tmp", 'w') as offset_file:
+            offset_file.write("{} {}".format(self.segments[0], self.offset))
+        os.rename(path + ".tmp", path)
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def empty(self):
+        return not self.segments or (len(self.segments) == 1 and self.offset >= self.sizes[self.segments[0]])
+
+    # write side
+
+    def append(self, data):
+        if self.writer is None or self.sizes[self.segments[-1]] >= self.segment_bytes:
+            self._open_segment()
+        record = HEADER.pack(len(data)) + data
+        self.writer.write(record)
+        self.sizes[self.segments[-1]] += len(record)
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+        if self.size() > self.max_bytes and len(self.segments) > 1:
+            self._evict()
+
+    def sync(self):
+        if self.writer is not None and self.unsynced:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def _open_segment(self):
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+        segment = self.segments[-1] + 1 if self.segments else 1
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+        self.writer = open(self.segment_path(segment), 'ab')
+
+    def _evict(self):
+        "Drop the oldest segments until the spool fits its cap again."
+        while self.size() > self.max_bytes and len(self.segments) > 1:
+            self.evicted += 1
+            self._remove_head()
+        self.offset = 0
+        self._save_offset()
+
+    def _remove_head(self):
+        segment = self.segments.pop(0)
+        del self.sizes[segment]
+        if self.reader_segment == segment:
+            self.reader.close()
+            self.reader = None
+            self.reader_segment = None
+        self.next_offset = None
+        self.offset = 0
+        os.remove(self.segment_path(segment))
+
+    # read side
+
+    def peek(self):
+        "The oldest message not sent yet, or None."
+        while self.segments:
+            head = self.segments[0]
+            if self.offset < self.sizes[head]:
+                break
+            if len(self.segments) == 1:
+                return None
+            self._remove_head()
+            self._save_offset()
+        else:
+            return None
+
+        if head == self.segments[-1] and self.writer is not None:
+            self.writer.flush()
+        if self.reader_segment != head:
+            if self.reader is not None:
+                self.reader.close()
+            self.reader = open(self.segment_path(head), 'rb')
+            self.reader_segment = head
+        self.reader.seek(self.offset)
+        header = self.reader.read(HEADER.size)
+        if len(header) < HEADER.size:
+            # torn write at the end of a segment
+            self.sizes[head] = self.offset
+            return self.peek() if len(self.segments) > 1 else None
+        length = HEADER.unpack(header)[0]
+        data = self.reader.read(length)
+        if len(data) < length:
+            self.sizes[head] = self.offset
+            return self.peek() if len(self.segments) > 1 else None
+        self.next_offset = self.offset + HEADER.size + length
+        return data
+
+    def advance(self):
+        "Mark the message returned by peek() as sent."
+        if self.next_offset is None:
+            return
+        self.offset = self.next_offset
+        self.next_offset = None
+        self.unsaved += 1
+        if self.unsaved >= self.sync_every or time.time() - self.last_save >= self.sync_interval:
+            self._save_offset()
+
+    def close(self):
+        self.sync()
+        self._save_offset()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
@@ -0,0 +1,225 @@
+"""
+Columnar storage for the generated stats datasets.
+
+The flat documents of random-json-stats_writer_solr.py are written column
+by column instead of as JSON lines:
+    - npy: a <name>.columns directory with one .npy file per field, that can
+      be memory-mapped back without parsing anything
+    - npz: the same arrays in one compressed <name>.npz archive
+String fields (host, store, city, disk0_name...) are dictionary encoded:
+the column holds int32 codes and schema.json holds the distinct values.
+
+Usage: python stats_columns.py <dataset> reads a dataset back and reports
+its size and load/iteration times.
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+import zipfile
+
+import numpy
+from numpy.lib import format as npformat
+
+
+SCHEMA = "schema.json"
+FLUSH_ROWS = 10000
+
+
+def dataset_path(output, compressed):
+    root = os.path.splitext(output)[0]
+    return root + (".npz" if compressed else ".columns")
+
+
+def column_dtype(value):
+    if isinstance(value, basestring):
+        return numpy.dtype(numpy.int32)
+    if isinstance(value, float):
+        return numpy.dtype(numpy.float64)
+    return numpy.dtype(numpy.int64)
+
+
+"""
+    ColumnarWriter stores a known number of flat documents column by column.
+
+    Columns are preallocated .npy files filled in place, so the run never
+    holds more than one batch in memory. With `compressed` the columns are
+    packed into a compressed .npz archive on close.
+"""
+class ColumnarWriter():
+    def __init__(self, output, rows, compressed=False):
+        self.rows = rows
+        self.compressed = compressed
+        self.path = dataset_path(output, compressed)
+        self.directory = self.path + ".tmp" if compressed else self.path
+        self.paths = [self.path]
+
+        self.fields = None
+        self.columns = {}
+        self.dictionaries = {}
+        self.codes = {}
+        self.batch = []
+        self.documents = 0
+
+        for path in [self.path, self.directory]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        os.makedirs(self.directory)
+
+    def _open(self, sample):
+        "Create the column files from the field names and value types of a first row."
+        self.fields = list(sample.keys())
+        for name in self.fields:
+            value = sample[name]
+            if isinstance(value, numpy.ndarray):
+                dtype = value.dtype
+                value = value[0] if len(value) else 0
+            else:
+                if isinstance(value, list):
+                    value = value[0] if value else 0
+                dtype = column_dtype(value)
+            if isinstance(value, basestring):
+                dtype = numpy.dtype(numpy.int32)
+                self.dictionaries[name] = []
+                self.codes[name] = {}
+            self.columns[name] = npformat.open_memmap(os.path.join(self.directory, name + ".npy"),
+                                                      mode='w+', dtype=dtype, shape=(self.rows,))
+
+    def encode(self, name, values):
+        "Dictionary-encode a list of strings."
+        codes = self.codes[name]
+        dictionary = self.dictionaries[name]
+        encoded = numpy.empty(len(values), dtype=numpy.int32)
+        for idx, value in enumerate(values):
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(dictionary)
+                dictionary.append(value)
+            encoded[idx] = code
+        return encoded
+
+    def write(self, document):
+        self.batch.append(document)
+        if len(self.batch) >= FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        self.write_columns(dict((name, [doc[name] for doc in batch]) for name in batch[0]))
+
+    def write_columns(self, columns):
+        "Append a block of rows given as field name -> list or 1-D array of values."
+        if self.fields is None:
+            self._open(columns)
+        n = len(columns[self.fields[0]])
+        if self.documents + n > self.rows:
+            raise ValueError("more than {} rows written to {}".format(self.rows, self.path))
+        end = self.documents + n
+        for name in self.fields:
+            values = columns[name]
+            if name in self.dictionaries:
+                values = self.encode(name, values)
+            self.columns[name][self.documents:end] = values
+        self.documents = end
+
+    def schema(self):
+        return {
+            "rows": self.documents,
+            "fields": [{"name": name,
+                        "dtype": self.columns[name].dtype.str,
+                        "dictionary": self.dictionaries.get(name)} for name in self.fields or []],
+        }
+
+    def close(self):
+        if self.columns is None:
+            return
+        self.flush()
+        for column in self.columns.values():
+            column.flush()
+        schema = self.schema()
+        self.columns = None
+        with open(os.path.join(self.directory, SCHEMA), 'w') as schema_file:
+            json.dump(schema, schema_file)
+
+        if self.compressed:
+            with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                for name in os.listdir(self.directory):
+                    archive.write(os.path.join(self.directory, name), name)
+            shutil.rmtree(self.directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load_columns(path, mmap=True):
+    """
+    Load a dataset written by ColumnarWriter.
+
+    Returns (schema, columns): columns maps field names to arrays, memory
+    mapped for a .columns directory. String fields hold dictionary codes,
+    the values are in the schema field "dictionary".
+    """
+    if os.path.isdir(path):
+        with open(os.path.join(path, SCHEMA)) as schema_file:
+            schema = json.load(schema_file)
+        mode = 'r' if mmap else None
+        columns = dict((field["name"], numpy.load(os.path.join(path, field["name"] + ".npy"), mmap_mode=mode)[:schema["rows"]])
+                       for field in schema["fields"])
+        return schema, columns
+
+    archive = numpy.load(path)
+    schema = json.loads(archive.zip.read(SCHEMA))
+    columns = dict((field["name"], archive[field["name"]][:schema["rows"]]) for field in schema["fields"])
+    return schema, columns
+
+
+def iter_documents(path, batch=FLUSH_ROWS):
+    "Rebuild the flat documents of a dataset, in the order they were written."
+    schema, columns = load_columns(path)
+    fields = schema["fields"]
+    for start in range(0, schema["rows"], batch):
+        values = []
+        for field in fields:
+            column = columns[field["name"]][start:start + batch].tolist()
+            if field["dictionary"] is not None:
+                dictionary = field["dictionary"]
+                column = [dictionary[code] for code in column]
+            values.append(column)
+        names = [field["name"] for field in fields]
+        for row in zip(*values):
+            yield dict(zip(names, row))
+
+
+def main(argv):
+    if len(argv) != 2:
+        print "Usage: {} <dataset.columns|dataset.npz>".format(argv[0])
+        return 1
+
+    start = time.time()
+    schema, columns = load_columns(argv[1])
+    cpu = columns["cpu"].mean() if "cpu" in columns else None
+    loaded = time.time() - start
+
+    start = time.time()
+    documents = 0
+    for _ in iter_documents(argv[1]):
+        documents += 1
+    iterated = time.time() - start
+
+    print "{} rows, {} fields, mean cpu {}".format(schema["rows"], len(schema["fields"]), cpu)
+    print "load + column scan: {:.3f}s".format(loaded)
+    print "document rebuild: {:.3f}s ({:.0f} docs/s)".format(iterated, documents / max(iterated, 1e-9))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,351 @@
+"""
+Vectorized synthetic metric engine.
+
+The writers build every document with scalar random calls and dozens of
+meter updates. This engine generates whole series at once with NumPy, for
+all the simulated hosts and a chunk of timestamps, and only turns them into
+JSON lines at the edge, through a pre-encoded document template.
+
+Series follow the same rules as the scalar generators:
+    - cpu is a random walk of +-5% steps, rounded to 0.1 and clamped to [0.1, 100]
+    - mem.virtual.used is a random walk of +-5000 bytes clamped to [0, total]
+    - network/disk bytes and packets are uniform samples reported through a DeltaMeter
+    - processes is the snapshot process count +-20, clamped to [0, 1000]
+"""
+
+import datetime
+import itertools
+
+import numpy
+
+from serialization import Field, build_template
+
+
+NETWORK_NAME = 'enp0s25'
+DISK_NAME = 'sda6'
+
+# cpu is walked in tenths of percent so that the per step rounding is exact
+CPU_STEP = 50
+CPU_MIN = 1
+CPU_MAX = 1000
+MEM_STEP = 5000
+BYTES_MAX = 90000
+PACKETS_MAX = 1000
+PROCESS_STEP = 20
+PROCESS_MAX = 1000
+
+# number of host x timestamp cells generated at once, and rendered at once
+BLOCK_CELLS = 1 << 20
+RENDER_DOCS = 1 << 16
+
+DELTA_SERIES = [
+    ("network_bytes_sent", BYTES_MAX),
+    ("network_bytes_recv", BYTES_MAX),
+    ("network_packets_sent", PACKETS_MAX),
+    ("network_packets_recv", PACKETS_MAX),
+    ("io_disk_read_bytes", BYTES_MAX),
+    ("io_disk_write_bytes", BYTES_MAX),
+]
+
+
+def clipped_walk(start, steps, low, high):
+    """
+    Compute x[:, t] = clip(x[:, t - 1] + steps[:, t], low, high) with x[:, -1] = start.
+
+    A clamped step is the function x -> clip(x + a, l, u), and the composition
+    of two of them is again one of them, so the whole walk is an inclusive
+    prefix scan over (a, l, u) triples done in log2(n) vector passes.
+    """
+    offset = numpy.array(steps, dtype=numpy.int64)
+    lows = numpy.empty_like(offset)
+    lows.fill(low)
+    highs = numpy.empty_like(offset)
+    highs.fill(high)
+
+    n = offset.shape[1]
+    shift = 1
+    while shift < n:
+        later = offset[:, shift:]
+        new_lows = numpy.clip(lows[:, :-shift] + later, lows[:, shift:], highs[:, shift:])
+        new_highs = numpy.clip(highs[:, :-shift] + later, lows[:, shift:], highs[:, shift:])
+        new_offset = offset[:, :-shift] + later
+        offset[:, shift:] = new_offset
+        lows[:, shift:] = new_lows
+        highs[:, shift:] = new_highs
+        shift *= 2
+
+    start = numpy.asarray(start, dtype=numpy.int64).reshape(-1, 1)
+    return numpy.clip(start + offset, lows, highs)
+
+
+def chunk_size(nhost):
+    "Timestamps per chunk. Depends on the total host count only, so chunks are the same whatever the worker split."
+    return max(1, BLOCK_CELLS // max(1, nhost))
+
+
+def series(snapshot, seeds, ndata, chunk, network_name=NETWORK_NAME, disk_name=DISK_NAME):
+    """
+    Generate the varying columns for the hosts whose RNG seeds are `seeds`.
+
+    Yields (t0, columns) for each chunk of timestamps, columns being arrays of
+    shape (hosts, timestamps). Each (host, chunk) pair draws from its own RNG,
+    so a host's series does not depend on the other hosts being generated.
+    """
+    nhost = len(seeds)
+    mem_virtual = snapshot["mem_virtual_data"]
+    nic = snapshot["io_data"][network_name]
+    disk = snapshot["io_disk_data"][disk_name]
+
+    cpu = numpy.empty(nhost, dtype=numpy.int64)
+    cpu.fill(int(round(snapshot["cpu_percent_data"] * 10)))
+    mem_used = numpy.empty(nhost, dtype=numpy.int64)
+    mem_used.fill(mem_virtual["used"])
+    initial = {
+        "network_bytes_sent": nic["bytes_sent"],
+        "network_bytes_recv": nic["bytes_recv"],
+        "network_packets_sent": nic["packets_sent"],
+        "network_packets_recv": nic["packets_recv"],
+        "io_disk_read_bytes": disk["read_bytes"],
+        "io_disk_write_bytes": disk["write_bytes"],
+    }
+    last = {}
+    for name, _ in DELTA_SERIES:
+        last[name] = numpy.empty(nhost, dtype=numpy.int64)
+        last[name].fill(initial[name])
+
+    for c, t0 in enumerate(range(0, ndata, chunk)):
+        n = min(chunk, ndata - t0)
+        cpu_steps = numpy.empty((nhost, n), dtype=numpy.int64)
+        mem_steps = numpy.empty((nhost, n), dtype=numpy.int64)
+        process_noise = numpy.empty((nhost, n), dtype=numpy.int64)
+        samples = dict((name, numpy.empty((nhost, n), dtype=numpy.int64)) for name, _ in DELTA_SERIES)
+
+        for i, seed in enumerate(seeds):
+            rs = numpy.random.RandomState([seed % 2 ** 32, seed // 2 ** 32 % 2 ** 32, c])
+            cpu_steps[i] = rs.randint(-CPU_STEP, CPU_STEP + 1, n)
+            mem_steps[i] = rs.randint(-MEM_STEP, MEM_STEP + 1, n)
+            process_noise[i] = rs.randint(-PROCESS_STEP, PROCESS_STEP + 1, n)
+            for name, high in DELTA_SERIES:
+                samples[name][i] = rs.randint(0, high + 1, n)
+
+        cpu_walk = clipped_walk(cpu, cpu_steps, CPU_MIN, CPU_MAX)
+        cpu = cpu_walk[:, -1]
+        mem_walk = clipped_walk(mem_used, mem_steps, 0, mem_virtual["total"])
+        mem_used = mem_walk[:, -1]
+
+        columns = {
+            "cpu": cpu_walk / 10.0,
+            "mem_virtual_used": mem_walk,
+            "mem_virtual_free": numpy.minimum(mem_virtual["total"] - mem_virtual["cached"] - mem_walk, 0),
+            "processes": numpy.clip(snapshot["process_data"] + process_noise, 0, PROCESS_MAX),
+        }
+        for name, _ in DELTA_SERIES:
+            current = samples[name]
+            previous = numpy.empty_like(current)
+            previous[:, 0] = last[name]
+            previous[:, 1:] = current[:, :-1]
+            columns[name] = numpy.abs(current - previous)
+            last[name] = current[:, -1]
+
+        yield t0, columns
+
+
+def doc_times(start_date, interval, t0, n):
+    return [datetime.datetime.fromtimestamp(start_date + interval * t).strftime("%Y-%m-%dT%H:%M:%SZ")
+            for t in range(t0, t0 + n)]
+
+
+SMALL_INTS = None
+
+
+def small_ints():
+    global SMALL_INTS
+    if SMALL_INTS is None:
+        SMALL_INTS = numpy.array([str(i) for i in range(BYTES_MAX + 1)], dtype=object)
+    return SMALL_INTS
+
+
+def to_strings(values):
+    "JSON text of a column of numbers. Small integers come from a lookup table instead of being formatted one by one."
+    if values.dtype.kind == 'f':
+        return map(repr, values.tolist())
+    table = small_ints()
+    if values.size and values.min() >= 0 and values.max() < len(table):
+        return table[values].tolist()
+    return map(str, values.tolist())
+
+
+def render(template, columns, per_host=None, per_time=None):
+    """
+    Render one chunk of documents, time-major (all hosts for the first
+    timestamp, then the next one...). `template` is a build_template()
+    result; `per_host` and `per_time` map field names to lists of
+    pre-encoded values.
+    """
+    pieces, fields = template
+    per_host = per_host or {}
+    per_time = per_time or {}
+    nhost, n = columns.values()[0].shape
+    values = [itertools.repeat(pieces[0])]
+    for name, piece in zip(fields, pieces[1:]):
+        if name in per_host:
+            values.append(per_host[name] * n)
+        elif name in per_time:
+            values.append([v for v in per_time[name] for _ in range(nhost)])
+        else:
+            values.append(to_strings(columns[name].T.ravel()))
+        values.append(itertools.repeat(piece))
+    return [''.join(row) for row in itertools.izip(*values)]
+
+
+def frame(pairs, columns, per_host=None, per_time=None):
+    """
+    Columns of one chunk of flat documents, time-major like render(): the
+    constants of `pairs` repeated, the generated columns flattened and the
+    raw `per_host` / `per_time` values expanded.
+    """
+    per_host = per_host or {}
+    per_time = per_time or {}
+    nhost, n = columns.values()[0].shape
+    result = {}
+    for key, value in pairs:
+        if not isinstance(value, Field):
+            result[key] = [value] * (nhost * n)
+        elif value.name in per_host:
+            result[key] = per_host[value.name] * n
+        elif value.name in per_time:
+            result[key] = [v for v in per_time[value.name] for _ in range(nhost)]
+        else:
+            result[key] = columns[value.name].T.ravel()
+    return result
+
+
+def flat_template(*args, **kwargs):
+    "Document template of the flat schema written by random-json-stats_writer_solr.py."
+    return build_template(flat_pairs(*args, **kwargs))
+
+
+def flat_pairs(snapshot, paths, location, province, city, store,
+               network_name=NETWORK_NAME, disk_name=DISK_NAME):
+    "(key, value) pairs of the flat schema, Field markers standing for the generated values."
+    cpu_times = snapshot["cpu_times_percent_data"]
+    mem_virtual = snapshot["mem_virtual_data"]
+    mem_swap = snapshot["mem_swap_data"]
+    path = paths[0]
+    path_data = snapshot["paths_data"][0]
+
+    pairs = [
+        ("store_location", location),
+        ("province", province),
+        ("city", city),
+        ("store", store),
+        ("processes", Field("processes")),
+        ("cpu", Field("cpu")),
+    ]
+    for name in ["user", "system", "idle", "nice", "irq", "softirq", "iowait", "steal"]:
+        pairs.append(("cpu_times_" + name, float(cpu_times[name])))
+    for disk in ["disk0", "disk1", "disk2"]:
+        pairs.extend([
+            (disk + "_used", long(path_data["used"])),
+            (disk + "_name", path["name"]),
+            (disk + "_percent", float(path_data["percent"])),
+            (disk + "_free", long(path_data["free"])),
+            (disk + "_path", path["path"]),
+            (disk + "_total", long(path_data["total"])),
+        ])
+    pairs.extend([
+        ("io_disk_name", disk_name),
+        ("io_disk_read_bytes", Field("io_disk_read_bytes")),
+        ("io_disk_read_count", 0L),
+        ("io_disk_read_time", 0L),
+        ("io_disk_write_bytes", Field("io_disk_write_bytes")),
+        ("io_disk_write_count", 0L),
+        ("io_disk_write_time", 0L),
+        ("mem_swap_free", long(mem_swap["free"])),
+        ("mem_swap_percent", float(mem_swap["percent"])),
+        ("mem_swap_total", long(mem_swap["total"])),
+        ("mem_swap_used", long(mem_swap["used"])),
+        ("mem_virtual_active", long(mem_virtual["active"])),
+        ("mem_virtual_available", long(mem_virtual["available"])),
+        ("mem_virtual_buffers", long(mem_virtual["buffers"])),
+        ("mem_virtual_cached", long(mem_virtual["cached"])),
+        ("mem_virtual_shared", long(mem_virtual["shared"])),
+        ("mem_virtual_free", Field("mem_virtual_free")),
+        ("mem_virtual_inactive", long(mem_virtual["inactive"])),
+        ("mem_virtual_percent", float(mem_virtual["percent"])),
+        ("mem_virtual_total", long(mem_virtual["total"])),
+        ("mem_virtual_used", Field("mem_virtual_used")),
+        ("network_bytes_recv", Field("network_bytes_recv")),
+        ("network_bytes_sent", Field("network_bytes_sent")),
+        ("network_name", network_name),
+        ("network_packets_recv", Field("network_packets_recv")),
+        ("network_packets_sent", Field("network_packets_sent")),
+        ("host", Field("host")),
+        ("time", Field("time")),
+    ])
+    return pairs
+
+
+def nested_template(snapshot, paths, location, province, city, store,
+                    network_name=NETWORK_NAME, disk_name=DISK_NAME):
+    "Document template of the nested schema written by random-json-stats_writer.py."
+    cpu_times = snapshot["cpu_times_percent_data"]
+    mem_virtual = snapshot["mem_virtual_data"]
+    mem_swap = snapshot["mem_swap_data"]
+
+    pairs = [
+        ("cpu", Field("cpu")),
+        ("cpu_times", [(name, float(cpu_times[name]))
+                       for name in ["user", "system", "idle", "nice", "irq", "softirq", "iowait", "steal"]]),
+        ("mem", [
+            ("virtual", [
+                ("total", long(mem_virtual["total"])),
+                ("used", long(mem_virtual["used"])),
+                ("cached", long(mem_virtual["cached"])),
+                ("free", Field("mem_virtual_free")),
+                ("available", long(mem_virtual["available"])),
+                ("percent", float(mem_virtual["percent"])),
+                ("active", long(mem_virtual["active"])),
+                ("inactive", long(mem_virtual["inactive"])),
+                ("buffers", long(mem_virtual["buffers"])),
+                ("shared", long(mem_virtual["shared"])),
+            ]),
+            ("swap", [(name, long(mem_swap[name])) for name in ["total", "used", "free"]] +
+                     [("percent", float(mem_swap["percent"]))]),
+        ]),
+    ]
+    # the scalar writer pops its paths list, so disk0 is the last path
+    for disk, idx in zip(["disk0", "disk1", "disk2"], [2, 1, 0]):
+        path_data = snapshot["paths_data"][idx]
+        pairs.append((disk, [
+            ("name", paths[idx]["name"]),
+            ("path", paths[idx]["path"]),
+            ("total", long(path_data["total"])),
+            ("used", long(path_data["used"])),
+            ("free", long(path_data["free"])),
+            ("percent", float(path_data["percent"])),
+        ]))
+    pairs.extend([
+        ("io_disk", [
+            ("disk_id", disk_name),
+            ("read_count", 0L),
+            ("write_count", 0L),
+            ("read_bytes", Field("io_disk_read_bytes")),
+            ("write_bytes", Field("io_disk_write_bytes")),
+            ("read_time", 0L),
+            ("write_time", 0L),
+        ]),
+        ("network", [
+            ("name", network_name),
+            ("bytes_sent", Field("network_bytes_sent")),
+            ("bytes_recv", Field("network_bytes_recv")),
+            ("packets_sent", Field("network_packets_sent")),
+            ("packets_recv", Field("network_packets_recv")),
+        ]),
+        ("processes", Field("processes")),
+        ("location", location),
+        ("province", province),
+        ("city", city),
+        ("store", store),
+    ])
+    return build_template(pairs)
@@ -0,0 +1,135 @@
+"""
+Streaming input for the generated stats documents.
+
+Reads stats.json (one JSON array) or JSON lines files document by document,
+without loading the whole file, and yields the raw JSON text of each
+document so senders can forward it without re-serializing. Uncompressed JSON
+lines are read through mmap, so the memory used does not depend on the file
+size either way.
+"""
+
+import json
+import mmap
+import os
+
+from stats_output import SUFFIXES, read_lines
+
+
+CHUNK_SIZE = 1 << 16
+# a multiple of mmap.ALLOCATIONGRANULARITY
+MAP_WINDOW = 1 << 24
+WHITESPACE = " \t\r\n"
+
+
+def iter_json_array(infile, chunk_size=CHUNK_SIZE):
+    "Yield the raw text of each element of the JSON array read from `infile`."
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # skip separators, reading more when the buffer runs dry
+        while True:
+            while pos < len(buf) and (buf[pos] in WHITESPACE or (started and buf[pos] == ",")):
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            chunk = infile.read(chunk_size)
+            buf, pos = buf[pos:] + chunk, 0
+            eof = not chunk
+
+        if pos >= len(buf):
+            if started:
+                raise ValueError("unterminated JSON array")
+            return
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == "]":
+            return
+
+        try:
+            _, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            chunk = infile.read(chunk_size)
+            buf, pos = buf[pos:] + chunk, 0
+            eof = not chunk
+            continue
+        # the value must be followed by a separator, or a number could go on in the next chunk
+        if not eof and (end == len(buf) or buf[end] not in WHITESPACE + ",]"):
+            chunk = infile.read(chunk_size)
+            buf, pos = buf[pos:] + chunk, 0
+            eof = not chunk
+            continue
+        yield buf[pos:end]
+        pos = end
+
+
+def iter_mmap_lines(path, window=MAP_WINDOW):
+    """
+    Yield the non-blank lines (without newline) of an uncompressed file,
+    mapped `window` bytes at a time instead of read: unmapping a window
+    releases its pages, so the resident memory stays bounded.
+    """
+    with open(path, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        offset = 0
+        pending = ""
+        while offset < size:
+            length = min(window, size - offset)
+            mapped = mmap.mmap(infile.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+            try:
+                pos = 0
+                while True:
+                    end = mapped.find("\n", pos)
+                    if end < 0:
+                        # the line goes on in the next window
+                        pending += mapped[pos:]
+                        break
+                    line = (pending + mapped[pos:end]).rstrip("\r")
+                    pending = ""
+                    pos = end + 1
+                    if line.strip():
+                        yield line
+            finally:
+                mapped.close()
+            offset += length
+        if pending.strip():
+            yield pending.rstrip("\r")
+
+
+def iter_raw_documents(path):
+    "Yield the raw JSON text of every document of a JSON array or JSON lines file."
+    if path.endswith(SUFFIXES["gzip"]) or path.endswith(SUFFIXES["zstd"]):
+        for line in read_lines(path):
+            if line.strip():
+                yield line
+        return
+
+    with open(path, 'rb') as infile:
+        first = ""
+        while True:
+            c = infile.read(1)
+            if not c or c not in WHITESPACE:
+                first = c
+                break
+        infile.seek(0)
+        if first == "[":
+            for document in iter_json_array(infile):
+                yield document
+            return
+    for line in iter_mmap_lines(path):
+        yield line
+
+
+def iter_documents(path):
+    "Yield every document of a JSON array or JSON lines file, decoded."
+    for document in iter_raw_documents(path):
+        yield json.loads(document)
@@ -0,0 +1,221 @@
+"""
+Streaming output for the generated stats documents.
+
+The writers used to reopen the output file for every document. ShardedWriter
+keeps a single handle open for the whole run, buffers documents in memory and
+flushes them in large sequential writes. Output can optionally be compressed
+(gzip/zstd) and rotated into fixed-size shards (stats-000001.jsonl, ...) so it
+can be bulk-loaded in parallel. JSONArrayWriter streams a single JSON array
+(stats.json) the same way, instead of building the list of documents first.
+"""
+
+import glob
+import gzip
+import json
+import os
+import errno
+
+
+COMPRESSIONS = ["none", "gzip", "zstd"]
+SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+BATCH_SIZE = 1000
+BUFFER_SIZE = 1 << 20
+
+
+def silentremove(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT: # errno.ENOENT = no such file or directory
+            raise # re-raise exception if a different error occured
+
+
+def open_output(path, compression="none", level=6):
+    """Open `path` for binary writing with the given compression."""
+    if compression == "gzip":
+        return gzip.open(path, 'wb', level)
+    if compression == "zstd":
+        import zstandard
+        raw = open(path, 'wb', BUFFER_SIZE)
+        return zstandard.ZstdCompressor(level=level).stream_writer(raw)
+    if compression == "none":
+        return open(path, 'wb', BUFFER_SIZE)
+    raise ValueError("unknown compression: {}".format(compression))
+
+
+def read_lines(path, chunk_size=BUFFER_SIZE):
+    "Iterate the lines (without newline) of a file written by ShardedWriter."
+    if path.endswith(SUFFIXES["zstd"]):
+        import zstandard
+        with open(path, 'rb') as raw:
+            pending = ""
+            for chunk in zstandard.ZstdDecompressor().read_to_iter(raw, read_size=chunk_size):
+                lines = (pending + chunk).split("\n")
+                pending = lines.pop()
+                for line in lines:
+                    yield line
+            if pending:
+                yield pending
+        return
+    opener = gzip.open if path.endswith(SUFFIXES["gzip"]) else open
+    with opener(path, 'rb') as infile:
+        for line in infile:
+            yield line.rstrip("\n")
+
+
+"""
+    ShardedWriter writes JSON lines through one open handle, in batches.
+
+    When `shard_size` (bytes of uncompressed JSON) is set, the output is split
+    into <prefix>-000001.jsonl, <prefix>-000002.jsonl... Documents are never
+    split across shards.
+"""
+class ShardedWriter():
+    def __init__(self, output, batch_size=BATCH_SIZE, compression="none", shard_size=0, level=6, dumps=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError("unknown compression: {}".format(compression))
+        self.output = output
+        self.batch_size = max(1, batch_size)
+        self.compression = compression
+        self.shard_size = shard_size
+        self.level = level
+        # json.dumps, or a faster serializer (see serialization.py)
+        self.dumps = dumps or json.dumps
+
+        self.batch = []
+        self.shard = 0
+        self.shard_bytes = 0
+        self.paths = []
+        self.documents = 0
+        self.outfile = None
+
+        self._remove_previous()
+        self._open_next()
+
+    def shard_path(self, shard):
+        suffix = SUFFIXES[self.compression]
+        if not self.shard_size:
+            if suffix and not self.output.endswith(suffix):
+                return self.output + suffix
+            return self.output
+        root = os.path.splitext(self.output)[0]
+        return "{}-{:06d}.jsonl{}".format(root, shard, suffix)
+
+    def _remove_previous(self):
+        if self.shard_size:
+            root = os.path.splitext(self.output)[0]
+            for path in glob.glob(root + "-[0-9][0-9][0-9][0-9][0-9][0-9].jsonl*"):
+                silentremove(path)
+        else:
+            silentremove(self.shard_path(0))
+
+    def _open_next(self):
+        self.shard += 1
+        self.shard_bytes = 0
+        path = self.shard_path(self.shard)
+        self.outfile = open_output(path, self.compression, self.level)
+        self.paths.append(path)
+
+    def _rotate(self):
+        self.flush()
+        self.outfile.close()
+        self._open_next()
+
+    def write(self, document):
+        self.write_line(self.dumps(document))
+
+    def write_line(self, line):
+        "Queue one already serialized document (without the trailing newline)."
+        size = len(line) + 1
+        if self.shard_size and self.shard_bytes and self.shard_bytes + size > self.shard_size:
+            self._rotate()
+        self.batch.append(line)
+        self.shard_bytes += size
+        self.documents += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def write_lines(self, lines):
+        "Write a list of serialized documents at once."
+        if self.shard_size:
+            for line in lines:
+                self.write_line(line)
+            return
+        self.flush()
+        if lines:
+            self.outfile.write("\n".join(lines) + "\n")
+            self.documents += len(lines)
+
+    def flush(self):
+        if self.batch:
+            self.batch.append("")
+            self.outfile.write("\n".join(self.batch))
+            self.batch = []
+
+    def close(self):
+        if self.outfile is not None:
+            self.flush()
+            self.outfile.close()
+            self.outfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+"""
+    JSONArrayWriter writes the documents as one JSON array, as json.dump of
+    their list would, but one document at a time through a buffered handle.
+"""
+class JSONArrayWriter():
+    def __init__(self, output, compression="none", level=6, dumps=None):
+        path = output
+        suffix = SUFFIXES[compression]
+        if suffix and not path.endswith(suffix):
+            path += suffix
+        self.paths = [path]
+        self.documents = 0
+        self.dumps = dumps or json.dumps
+        self.outfile = open_output(path, compression, level)
+        self.outfile.write("[")
+
+    def write(self, document):
+        self.write_line(self.dumps(document))
+
+    def write_line(self, line):
+        "Write one already serialized document."
+        self.outfile.write(", " + line if self.documents else line)
+        self.documents += 1
+
+    def write_lines(self, lines):
+        "Write a list of serialized documents at once."
+        if lines:
+            self.outfile.write((", " if self.documents else "") + ", ".join(lines))
+            self.documents += len(lines)
+
+    def flush(self):
+        self.outfile.flush()
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.write("]")
+            self.outfile.close()
+            self.outfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_writer(output, compression="none", batch_size=BATCH_SIZE, dumps=None):
+    "A ShardedWriter for a .jsonl output, a JSONArrayWriter for anything else."
+    suffix = SUFFIXES[compression]
+    if suffix and output.endswith(suffix):
+        output = output[:-len(suffix)]
+    if output.endswith(".jsonl"):
+        return ShardedWriter(output, batch_size, compression, dumps=dumps)
+    return JSONArrayWriter(output, compression, dumps=dumps)
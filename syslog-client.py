@@ -1,8 +1,9 @@
 """
 Remote syslog client.
 
-Works by sending UDP messages to a remote syslog server. The remote server
-must be configured to accept logs from the network.
+Works by sending UDP messages (or TCP framed messages, see syslog_transport)
+to a remote syslog server. The remote server must be configured to accept
+logs from the network.
 
 License: PUBLIC DOMAIN
 
@@ -11,6 +12,8 @@ For more information, see RFC 3164.
 
 import socket
 
+from syslog_transport import create_transport, parse_addresses
+
 class Facility:
   "Syslog facilities"
   KERN, USER, MAIL, DAEMON, AUTH, SYSLOG, \
@@ -30,16 +33,30 @@ class Syslog:
   def __init__(self,
     host="52.169.115.99",
     port=5140,
-    facility=Facility.DAEMON):
-    self.host = host
-    self.port = port
+    facility=Facility.DAEMON,
+    batch_size=1,
+    linger=0.05,
+    protocol="udp"):
+    addresses = parse_addresses(host, port)
+    self.host, self.port = addresses[0]
     self.facility = facility
     self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.transport = None
+    if protocol != "udp" or batch_size > 1 or len(addresses) > 1:
+      self.transport = create_transport(protocol, addresses, batch_size, linger)
 
   def send(self, message, level):
-    "Send a syslog message to remote host using UDP."
+    "Send a syslog message to remote host."
     data = "<%d> %s" % (level + self.facility*8, message)
-    self.socket.sendto(data, (self.host, self.port))
+    if self.transport is not None:
+      self.transport.send(data)
+    else:
+      self.socket.sendto(data, (self.host, self.port))
+
+  def flush(self):
+    "Send the messages still waiting for their batch."
+    if self.transport is not None:
+      self.transport.flush()
 
 if __name__ == "__main__":
     log = Syslog()
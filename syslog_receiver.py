@@ -0,0 +1,355 @@
+"""
+Local syslog receiver, a stand-in for the collector.
+
+It listens on UDP and TCP on the same port, like a syslog collector, and
+reads the datagrams with recvmmsg() (through ctypes, Linux only; recvfrom()
+elsewhere) and the TCP streams with octet counting or newline framing. Each
+message is parsed as an RFC 3164 line ("<PRI>timestamp host tag: message")
+and its message as JSON, and counted per host. Messages carrying a sequence
+number ("_seq", see delta_encoding.py or random-json-stats_sender.py
+--stamp) are checked for gaps, and the ones carrying their send time ("_ts",
+in seconds since the epoch) give the delivery latency.
+
+Usage:
+    python syslog_receiver.py listen [port]           receive and print the stats every 5 s
+    python syslog_receiver.py bench [count] [rate]   loopback benchmark of the transports, rate 0 unthrottled
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import multiprocessing
+import re
+import select
+import socket
+import sys
+import threading
+import time
+
+from instrumentation import Histogram
+from syslog_transport import IOVec, MMsgHdr, SYSLOG_LINE, SyslogHeaders, create_transport, stamp_document
+
+
+PORT = 5140
+BATCH_SIZE = 64
+DATAGRAM_SIZE = 1 << 16
+RECEIVE_BUFFER = 4 << 20
+POLL_INTERVAL = 0.1
+REPORT_INTERVAL = 5
+MSG_DONTWAIT = 0x40
+RATE = 10000
+# (host, tag) of the messages without a syslog header
+UNKNOWN = ("-", "-")
+PRIORITY = re.compile(r"^<\d+>\s*")
+
+
+def load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+_recvmmsg = load_recvmmsg()
+
+
+"""
+    StreamStats counts the messages of one (host, tag) stream and follows
+    its sequence numbers.
+"""
+class StreamStats():
+    def __init__(self):
+        self.count = 0
+        self.seq = None
+        self.lost = 0
+        self.reordered = 0
+        self.restarts = 0
+
+    def sequence(self, seq):
+        if self.seq is not None:
+            if seq == 1 and self.seq > 1:
+                # the sender started over
+                self.restarts += 1
+            elif seq > self.seq + 1:
+                self.lost += seq - self.seq - 1
+            elif seq <= self.seq:
+                # late, or a duplicate: it was counted as lost when the gap opened
+                self.reordered += 1
+                if self.lost:
+                    self.lost -= 1
+                return
+        self.seq = seq
+
+
+"""
+    DatagramReader reads the pending datagrams of a UDP socket, in batches
+    of `batch_size` with recvmmsg() when available.
+"""
+class DatagramReader():
+    def __init__(self, sock, batch_size=BATCH_SIZE, size=DATAGRAM_SIZE):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.size = size
+        self.recvmmsg = _recvmmsg
+        if self.recvmmsg is not None:
+            # the buffers and vectors are allocated once
+            self.buffers = ctypes.create_string_buffer(batch_size * size)
+            self.iovecs = (IOVec * batch_size)()
+            self.msgs = (MMsgHdr * batch_size)()
+            base = ctypes.addressof(self.buffers)
+            for idx in range(batch_size):
+                self.iovecs[idx].iov_base = base + idx * size
+                self.iovecs[idx].iov_len = size
+                self.msgs[idx].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[idx])
+                self.msgs[idx].msg_hdr.msg_iovlen = 1
+
+    def read(self):
+        "The datagrams waiting on the socket, [] when there is none."
+        if self.recvmmsg is None:
+            datagrams = []
+            while len(datagrams) < self.batch_size:
+                try:
+                    datagrams.append(self.sock.recv(self.size, MSG_DONTWAIT))
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+            return datagrams
+        count = self.recvmmsg(self.sock.fileno(), ctypes.addressof(self.msgs), self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise socket.error(err, "recvmmsg failed")
+        raw = self.buffers.raw
+        size = self.size
+        return [raw[idx * size:idx * size + self.msgs[idx].msg_len] for idx in range(count)]
+
+
+"""
+    Receiver is the UDP + TCP syslog listener, with its counters.
+"""
+class Receiver():
+    def __init__(self, host="127.0.0.1", port=PORT, batch_size=BATCH_SIZE, parse_json=True):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        self.udp.bind((host, port))
+        self.address = self.udp.getsockname()
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(self.address)
+        self.tcp.listen(16)
+        self.reader = DatagramReader(self.udp, batch_size)
+        self.parse_json = parse_json
+        # socket -> pending bytes of the TCP connections
+        self.connections = {}
+        self.stopped = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.received = 0
+        self.bytes = 0
+        self.invalid = 0
+        self.streams = {}
+        self.hosts = {}
+        self.latency = Histogram()
+        self.first = None
+        self.last = None
+
+    def handle(self, data):
+        now = time.time()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.received += 1
+        self.bytes += len(data)
+        line = data.rstrip("\0\n")
+        match = SYSLOG_LINE.match(line)
+        if match is not None:
+            key, payload = (match.group(2), match.group(3)), match.group(4)
+        else:
+            # "<PRI> message", as syslog-client.py sends it
+            key, payload = UNKNOWN, PRIORITY.sub("", line, 1)
+        self.hosts[key[0]] = self.hosts.get(key[0], 0) + 1
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = StreamStats()
+        stream.count += 1
+        if not self.parse_json:
+            return
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            self.invalid += 1
+            return
+        if isinstance(message, dict):
+            if "_seq" in message:
+                stream.sequence(message["_seq"])
+            if "_ts" in message:
+                self.latency.record(max(0, int((now - message["_ts"]) * 1e9)))
+
+    def _read_stream(self, conn):
+        try:
+            data = conn.recv(DATAGRAM_SIZE)
+        except socket.error:
+            data = ""
+        if not data:
+            del self.connections[conn]
+            conn.close()
+            return
+        buf = self.connections[conn] + data
+        while buf:
+            space = buf.find(" ")
+            length = buf[:space] if space >= 0 else buf
+            if length.isdigit():
+                # octet counting: "LEN MSG"
+                if space < 0:
+                    break
+                end = space + 1 + int(length)
+                if len(buf) < end:
+                    break
+                self.handle(buf[space + 1:end])
+                buf = buf[end:]
+            else:
+                # newline framing, also for a line starting with digits that are not a length
+                end = buf.find("\n")
+                if end < 0:
+                    break
+                self.handle(buf[:end])
+                buf = buf[end + 1:]
+        self.connections[conn] = buf
+
+    def poll(self, timeout=POLL_INTERVAL):
+        readable = select.select([self.udp, self.tcp] + self.connections.keys(), [], [], timeout)[0]
+        for sock in readable:
+            if sock is self.udp:
+                datagrams = self.reader.read()
+                while datagrams:
+                    for data in datagrams:
+                        self.handle(data)
+                    datagrams = self.reader.read() if len(datagrams) == self.reader.batch_size else []
+            elif sock is self.tcp:
+                conn = self.tcp.accept()[0]
+                self.connections[conn] = ""
+            else:
+                self._read_stream(sock)
+
+    def serve(self):
+        "Receive until stop()."
+        while not self.stopped.is_set():
+            self.poll()
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        for conn in self.connections.keys():
+            conn.close()
+        self.udp.close()
+        self.tcp.close()
+
+    def stats(self):
+        elapsed = (self.last - self.first) if self.first is not None else 0
+        lost = sum(stream.lost for stream in self.streams.itervalues())
+        return {
+            "received": self.received,
+            "bytes": self.bytes,
+            "invalid": self.invalid,
+            "msgs_per_sec": round(self.received / elapsed, 1) if elapsed > 0 else 0.0,
+            "lost": lost,
+            "loss_percent": round(lost * 100.0 / (self.received + lost), 3) if self.received + lost else 0.0,
+            "reordered": sum(stream.reordered for stream in self.streams.itervalues()),
+            "restarts": sum(stream.restarts for stream in self.streams.itervalues()),
+            "latency_p50_ms": round(self.latency.percentile(50) / 1e6, 3),
+            "latency_p99_ms": round(self.latency.percentile(99) / 1e6, 3),
+            "hosts": dict(self.hosts),
+        }
+
+
+def listen(port):
+    receiver = Receiver("0.0.0.0", port)
+    print "listening on UDP and TCP {}".format(receiver.address)
+    next_report = time.time() + REPORT_INTERVAL
+    try:
+        while True:
+            receiver.poll()
+            if time.time() >= next_report:
+                print json.dumps(receiver.stats(), sort_keys=True)
+                sys.stdout.flush()
+                next_report += REPORT_INTERVAL
+    except KeyboardInterrupt:
+        pass
+    print json.dumps(receiver.stats(), sort_keys=True)
+    receiver.close()
+
+
+def _serve(conn):
+    "Receiver process of the benchmark: send its address, serve until told to stop, send the stats."
+    receiver = Receiver("127.0.0.1", 0)
+    conn.send(receiver.address)
+    while not conn.poll():
+        receiver.poll(POLL_INTERVAL)
+    expected = conn.recv()
+    # let it catch up while messages keep arriving
+    last = -1
+    while receiver.received < expected and receiver.received != last:
+        last = receiver.received
+        deadline = time.time() + 0.5
+        while time.time() < deadline:
+            receiver.poll(POLL_INTERVAL)
+    conn.send(receiver.stats())
+    receiver.close()
+
+
+def bench(count, rate=RATE, hosts=4):
+    """
+    Send `count` stamped messages at `rate` msg/s (0: as fast as possible)
+    through each transport to a receiver in another process (not to share
+    the GIL with it), and report what arrived.
+    """
+    document = json.dumps(dict(("field{}".format(n), n * 1.5) for n in range(40)))
+    print "{:<12} {:>5} {:>12} {:>12} {:>8} {:>10} {:>10}".format(
+        "protocol", "batch", "sent msg/s", "recv msg/s", "loss %", "p50 ms", "p99 ms")
+    for protocol, batch_size in [("udp", 1), ("udp", BATCH_SIZE), ("tcp", 1), ("tcp", BATCH_SIZE), ("tcp-newline", BATCH_SIZE)]:
+        conn, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve, args=(child,))
+        server.start()
+        address = conn.recv()
+
+        transport = create_transport(protocol, [address], batch_size, 0.01)
+        headers = SyslogHeaders("bench", "host{}")
+        seqs = [0] * hosts
+        start = time.time()
+        for n in xrange(count):
+            host = n % hosts
+            seqs[host] += 1
+            transport.send(headers.get(14, host) + stamp_document(document, seqs[host], time.time()))
+            if rate and n % 64 == 63:
+                delay = start + (n + 1) / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        transport.flush()
+        sent_rate = count / (time.time() - start)
+        conn.send(count)
+        stats = conn.recv()
+        transport.close()
+        server.join()
+
+        # a tail lost after the last received message shows as a shortfall, not a gap
+        lost = count - stats["received"]
+        print "{:<12} {:>5} {:>12.0f} {:>12.0f} {:>8.2f} {:>10.3f} {:>10.3f}".format(
+            protocol, batch_size, sent_rate, stats["msgs_per_sec"], lost * 100.0 / count,
+            stats["latency_p50_ms"], stats["latency_p99_ms"])
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "listen"
+    if command == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 50000, int(sys.argv[3]) if len(sys.argv) > 3 else RATE)
+    else:
+        listen(int(sys.argv[2]) if len(sys.argv) > 2 else PORT)
@@ -0,0 +1,592 @@
+"""
+Batched syslog transport.
+
+Each syslog message used to cost one sendto() syscall. BatchedUDPTransport
+queues pre-formatted datagrams and sends a whole batch with one sendmmsg()
+call (through ctypes, Linux only), falling back to a tight send() loop where
+sendmmsg is not available.
+
+TCPTransport keeps one connection open and writes RFC 6587 framed messages
+(octet counting or newline) in coalesced writes; TransportPool spreads them
+over several collectors and fails over when one goes down.
+
+SyslogHeaders caches the RFC 3164 "<PRI>timestamp host tag: " prefix, which
+only changes once per second, so building a message is one concatenation.
+
+Usage: python syslog_transport.py [count] [size] [batch] compares the
+packets/sec of the per-message path and the batched path on loopback, and
+the per-message cost of the formatted and the cached headers.
+"""
+
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import logging
+import re
+import socket
+import sys
+import threading
+import time
+from logging.handlers import SysLogHandler
+
+
+BATCH_SIZE = 64
+LINGER = 0.05
+MAX_PENDING = 10000
+COALESCE_BYTES = 1 << 16
+CONNECT_TIMEOUT = 5
+RETRY_INTERVAL = 10
+OCTET_COUNTING = "octet-counting"
+NEWLINE = "newline"
+FRAMINGS = {"tcp": OCTET_COUNTING, "tcp-newline": NEWLINE}
+PROTOCOLS = ["udp"] + sorted(FRAMINGS)
+TIMESTAMP_FORMAT = "%b %d %H:%M:%S"
+# send errors of the network or the collector being down: the datagrams stay queued and the error is raised.
+# Any other error (no listener, full buffers, a datagram too large...) only drops the datagram that failed
+CONNECTIVITY_ERRORS = (errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN, errno.EHOSTDOWN, errno.ENOTCONN,
+                       errno.EADDRNOTAVAIL, errno.ECONNRESET, errno.EPIPE)
+# "<14>Oct 18 13:24:51 host tag: message", the priority and the timestamp being optional
+SYSLOG_LINE = re.compile(r"^(?:<(\d+)>)?(?:[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d )?(\S+) ([^:\s]+): (.*)$", re.S)
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+_sendmmsg = load_sendmmsg()
+
+
+"""
+    BufferedTransport is the base of the transports: messages are queued and
+    written together when `batch_size` messages or `max_bytes` bytes are
+    queued, or when the oldest one waited `linger` seconds.
+
+    When a write fails the messages stay queued (up to `max_pending`, oldest
+    dropped first) and the error is raised to the caller; writes from the
+    linger thread only record it in `error`.
+"""
+class BufferedTransport():
+    stream = False
+
+    def __init__(self, address, batch_size=BATCH_SIZE, linger=LINGER, max_bytes=0, max_pending=MAX_PENDING):
+        self.address = address
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+
+        self.queue = []
+        self.queued_bytes = 0
+        self.first_queued = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.error = None
+
+        if self.linger > 0:
+            flusher = threading.Thread(target=self._flush_lingering)
+            flusher.daemon = True
+            flusher.start()
+
+    def send(self, data):
+        "Queue one message (bytes), writing the batch if it is full or too old."
+        with self.lock:
+            if not self.queue:
+                self.first_queued = time.time()
+            self.queue.append(data)
+            self.queued_bytes += len(data)
+            if len(self.queue) >= self.batch_size \
+                    or (self.max_bytes and self.queued_bytes >= self.max_bytes) \
+                    or (self.linger > 0 and time.time() - self.first_queued >= self.linger):
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def drain(self):
+        "Take back the messages not written yet."
+        with self.lock:
+            queue = self.queue
+            self.queue = []
+            self.queued_bytes = 0
+            return queue
+
+    def _flush_lingering(self):
+        while True:
+            time.sleep(self.linger)
+            if self.closed.is_set():
+                return
+            with self.lock:
+                if self.queue and time.time() - self.first_queued >= self.linger:
+                    try:
+                        self._flush()
+                    except socket.error:
+                        pass
+
+    def _flush(self):
+        queue = self.queue
+        if not queue:
+            return
+        self.queue = []
+        self.queued_bytes = 0
+        try:
+            self._write(queue)
+            self.error = None
+        except socket.error as e:
+            self.error = e
+            overflow = len(queue) - self.max_pending
+            if overflow > 0:
+                self.dropped += overflow
+                queue = queue[overflow:]
+            self.queue = queue
+            self.queued_bytes = sum(len(data) for data in queue)
+            raise
+
+    def _write(self, messages):
+        raise NotImplementedError()
+
+    def _close(self):
+        pass
+
+    def close(self):
+        self.closed.set()
+        try:
+            self.flush()
+        finally:
+            self._close()
+
+
+"""
+    BatchedUDPTransport sends datagrams to one (host, port) in batches, with
+    one sendmmsg() call per batch.
+
+    Datagrams refused by the destination (no listener) are dropped, like
+    plain UDP sendto() would, and so are the ones that can never be sent
+    (EMSGSIZE...): only CONNECTIVITY_ERRORS keep the batch queued.
+"""
+class BatchedUDPTransport(BufferedTransport):
+    def __init__(self, address, batch_size=BATCH_SIZE, linger=LINGER, use_sendmmsg=True):
+        self.sendmmsg = _sendmmsg if use_sendmmsg else None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(address)
+        self.msgs = None
+        BufferedTransport.__init__(self, address, batch_size, linger)
+
+    def _write(self, datagrams):
+        if self.sendmmsg is not None and len(datagrams) > 1:
+            self._send_batch(datagrams)
+        else:
+            self._send_loop(datagrams)
+
+    def _send_loop(self, datagrams):
+        for data in datagrams:
+            try:
+                self.socket.send(data)
+                self.sent += 1
+            except socket.error as e:
+                if e.errno in CONNECTIVITY_ERRORS:
+                    raise
+                self.dropped += 1
+
+    def _prepare_batch(self):
+        "Allocate the sendmmsg vectors once: message i always points at iovec i."
+        self.iovecs = (ctypes.c_size_t * (2 * self.batch_size))()
+        self.msgs = (MMsgHdr * self.batch_size)()
+        base = ctypes.addressof(self.iovecs)
+        for idx in range(self.batch_size):
+            self.msgs[idx].msg_hdr.msg_iov = ctypes.cast(base + idx * ctypes.sizeof(IOVec), ctypes.POINTER(IOVec))
+            self.msgs[idx].msg_hdr.msg_iovlen = 1
+
+    def _send_batch(self, datagrams):
+        if len(datagrams) > self.batch_size:
+            for start in range(0, len(datagrams), self.batch_size):
+                self._send_batch(datagrams[start:start + self.batch_size])
+            return
+        if self.msgs is None:
+            self._prepare_batch()
+
+        # one contiguous buffer, every iovec points into it
+        n = len(datagrams)
+        buf = "".join(datagrams)
+        address = ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value
+        vectors = []
+        for data in datagrams:
+            size = len(data)
+            vectors.append(address)
+            vectors.append(size)
+            address += size
+        self.iovecs[:2 * n] = vectors
+        msgs = self.msgs
+
+        fd = self.socket.fileno()
+        done = 0
+        while done < n:
+            sent = self.sendmmsg(fd, ctypes.addressof(msgs) + done * ctypes.sizeof(MMsgHdr), n - done, 0)
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err == errno.ENOSYS:
+                    self.sendmmsg = None
+                    self._send_loop(datagrams[done:])
+                    return
+                if err in CONNECTIVITY_ERRORS:
+                    raise socket.error(err, "sendmmsg failed")
+                # skip the datagram that failed and carry on with the batch
+                done += 1
+                self.dropped += 1
+                continue
+            done += sent
+            self.sent += sent
+
+    def _close(self):
+        self.socket.close()
+
+
+"""
+    TCPTransport writes syslog messages over one persistent TCP connection,
+    with RFC 6587 octet counting ("LEN MSG") or newline framing.
+
+    Queued messages are coalesced into large writes. The connection is opened
+    on first use and reopened on the next write after a failure.
+"""
+class TCPTransport(BufferedTransport):
+    stream = True
+
+    def __init__(self, address, framing=OCTET_COUNTING, batch_size=BATCH_SIZE, linger=LINGER,
+                 nodelay=True, coalesce=COALESCE_BYTES, timeout=CONNECT_TIMEOUT):
+        if framing not in (OCTET_COUNTING, NEWLINE):
+            raise ValueError("unknown framing: {}".format(framing))
+        self.framing = framing
+        self.nodelay = nodelay
+        self.timeout = timeout
+        self.socket = None
+        BufferedTransport.__init__(self, address, batch_size, linger, coalesce)
+
+    def frame(self, data):
+        if self.framing == OCTET_COUNTING:
+            return "%d %s" % (len(data), data)
+        return data.replace("\n", " ") + "\n"
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.socket = sock
+
+    def _write(self, messages):
+        if self.socket is None:
+            self._connect()
+        try:
+            self.socket.sendall("".join([self.frame(data) for data in messages]))
+        except socket.error:
+            self._close()
+            raise
+        self.sent += len(messages)
+
+    def _close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            finally:
+                self.socket = None
+
+
+"""
+    TransportPool spreads messages over the transports of several collectors,
+    round robin. A transport that fails is left out for `retry` seconds and
+    the messages it still held go to the next one.
+
+    When every transport is down the messages are dropped, or with
+    `raise_when_down` kept for drain() and socket.error is raised.
+"""
+class TransportPool():
+    def __init__(self, transports, retry=RETRY_INTERVAL, raise_when_down=False):
+        self.transports = transports
+        self.stream = transports[0].stream
+        self.retry = retry
+        self.raise_when_down = raise_when_down
+        self.down_until = [0] * len(transports)
+        self.next = 0
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.undelivered = []
+
+    def _pick(self):
+        with self.lock:
+            now = time.time()
+            for _ in range(len(self.transports)):
+                idx = self.next
+                self.next = (self.next + 1) % len(self.transports)
+                if self.down_until[idx] <= now:
+                    return idx
+            return None
+
+    def _failed(self, idx):
+        self.down_until[idx] = time.time() + self.retry
+        return self.transports[idx].drain()
+
+    def _send(self, pending):
+        while pending:
+            idx = self._pick()
+            if idx is None:
+                if self.raise_when_down:
+                    self.undelivered.extend(pending)
+                    raise socket.error(errno.EHOSTUNREACH, "no syslog collector available")
+                self.dropped += len(pending)
+                return
+            transport = self.transports[idx]
+            sent = 0
+            try:
+                for data in pending:
+                    sent += 1
+                    transport.send(data)
+                pending = []
+            except socket.error:
+                # the failed message is still queued in the transport
+                pending = self._failed(idx) + pending[sent:]
+
+    def send(self, data):
+        self._send([data])
+
+    def drain(self):
+        "Take back the messages not written yet."
+        undelivered = self.undelivered
+        self.undelivered = []
+        for transport in self.transports:
+            undelivered.extend(transport.drain())
+        return undelivered
+
+    def flush(self):
+        for idx, transport in enumerate(self.transports):
+            try:
+                transport.flush()
+            except socket.error:
+                self._send(self._failed(idx))
+
+    def close(self):
+        self.flush()
+        for transport in self.transports:
+            try:
+                transport.close()
+            except socket.error:
+                pass
+
+    @property
+    def sent(self):
+        return sum(transport.sent for transport in self.transports)
+
+
+def parse_addresses(hosts, port):
+    "Split a \"host1,host2:port2\" collector list into (host, port) addresses."
+    addresses = []
+    for host in hosts.split(","):
+        parts = host.strip().split(":")
+        addresses.append((parts[0], int(parts[1]) if len(parts) > 1 else port))
+    return addresses
+
+
+def stamp_document(document, seq, ts):
+    "Splice the \"_seq\" and \"_ts\" keys read by syslog_receiver.py into the JSON object text `document`."
+    rest = document[1:]
+    if rest.lstrip() == "}":
+        return '{"_seq":%d,"_ts":%.6f}' % (seq, ts)
+    return '{"_seq":%d,"_ts":%.6f,%s' % (seq, ts, rest)
+
+
+def create_transport(protocol, addresses, batch_size=1, linger=0, nodelay=True, raise_when_down=False):
+    """
+    Build the transport for `protocol` (udp, tcp or tcp-newline) to a list of
+    collector (host, port) addresses: a pool when there is more than one.
+    """
+    if protocol == "udp":
+        transports = [BatchedUDPTransport(address, batch_size, linger) for address in addresses]
+    elif protocol in FRAMINGS:
+        transports = [TCPTransport(address, FRAMINGS[protocol], batch_size, linger, nodelay) for address in addresses]
+    else:
+        raise ValueError("unknown protocol: {}".format(protocol))
+    if len(transports) == 1:
+        return transports[0]
+    return TransportPool(transports, raise_when_down=raise_when_down)
+
+
+"""
+    TransportSysLogHandler is a SysLogHandler that hands the formatted records
+    to a transport (see create_transport) instead of calling sendto() per
+    record. The trailing NUL of SysLogHandler is only added for datagrams,
+    stream transports do their own framing.
+"""
+class TransportSysLogHandler(SysLogHandler):
+    def __init__(self, transport, facility=SysLogHandler.LOG_USER):
+        logging.Handler.__init__(self)
+        self.facility = facility
+        self.transport = transport
+        self.append_nul = not transport.stream
+
+    def encode(self, record):
+        "The syslog message bytes of a record."
+        msg = self.format(record)
+        if self.append_nul:
+            msg += '\000'
+        prio = '<%d>' % self.encodePriority(self.facility, self.mapPriority(record.levelname))
+        if type(msg) is unicode:
+            msg = msg.encode('utf-8')
+        return prio + msg
+
+    def emit(self, record):
+        try:
+            self.transport.send(self.encode(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        self.transport.flush()
+
+    def close(self):
+        self.transport.close()
+        logging.Handler.close(self)
+
+
+"""
+    BatchedSysLogHandler is a UDP SysLogHandler that hands the formatted
+    records to a BatchedUDPTransport instead of calling sendto() per record.
+"""
+class BatchedSysLogHandler(TransportSysLogHandler):
+    def __init__(self, address, facility=SysLogHandler.LOG_USER, batch_size=BATCH_SIZE, linger=LINGER):
+        TransportSysLogHandler.__init__(self, BatchedUDPTransport(address, batch_size, linger), facility)
+
+
+"""
+    SyslogHeaders builds "<PRI>timestamp host tag: " message prefixes (no
+    "<PRI>" when the priority is None).
+
+    Prefixes are cached per (priority, host) and the cache is dropped when the
+    second ticks over, so the timestamp is formatted once per second instead
+    of once per message.
+"""
+class SyslogHeaders():
+    def __init__(self, tag, host_format="{}"):
+        self.tag = tag
+        self.host_format = host_format
+        self.second = None
+        self.timestamp = None
+        self.cache = {}
+
+    def get(self, priority, host, now=None):
+        second = int(now if now is not None else time.time())
+        if second != self.second:
+            self.second = second
+            self.timestamp = datetime.datetime.fromtimestamp(second).strftime(TIMESTAMP_FORMAT)
+            self.cache = {}
+        headers = self.cache.get(priority)
+        if headers is None:
+            headers = self.cache[priority] = {}
+        header = headers.get(host)
+        if header is None:
+            header = "%s %s %s: " % (self.timestamp, self.host_format.format(host), self.tag)
+            if priority is not None:
+                header = "<%d>%s" % (priority, header)
+            headers[host] = header
+        return header
+
+    def message(self, priority, host, message):
+        return self.get(priority, host) + message
+
+
+"""
+    CachedHeaderFormatter formats records as "timestamp hostname app: message"
+    like the agent Formatter did, reusing the prefix within the same second.
+"""
+class CachedHeaderFormatter(logging.Formatter):
+    def __init__(self, app_name, hostname):
+        logging.Formatter.__init__(self)
+        self.headers = SyslogHeaders(app_name, hostname.replace("{", "{{").replace("}", "}}"))
+
+    def format(self, record):
+        # no priority: SysLogHandler adds it
+        return self.headers.get(None, None, record.created) + record.getMessage()
+
+
+def bench_headers(count):
+    "Per-message cost of formatting the syslog header every time vs the cached header."
+    message = "x" * 512
+    start = time.time()
+    for n in xrange(count):
+        "<%d>%s %s %s" % (14, datetime.datetime.now().strftime(TIMESTAMP_FORMAT), "hostname{}".format(n % 10), "monitoring-agent: " + message)
+    formatted = time.time() - start
+
+    headers = SyslogHeaders("monitoring-agent", "hostname{}")
+    start = time.time()
+    for n in xrange(count):
+        headers.get(14, n % 10) + message
+    cached = time.time() - start
+
+    print "{:<20} {:>10.2f} us/message".format("formatted header", formatted * 1e6 / count)
+    print "{:<20} {:>10.2f} us/message".format("cached header", cached * 1e6 / count)
+
+
+def bench(count, size, batch):
+    "Packets/sec sent on loopback by plain sendto(), the send() loop and sendmmsg()."
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    address = receiver.getsockname()
+    data = "<14>" + "x" * max(0, size - 4)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = time.time()
+    for _ in xrange(count):
+        sock.sendto(data, address)
+    results = [("sendto per message", time.time() - start)]
+
+    for name, use_sendmmsg in [("batched send loop", False), ("batched sendmmsg", True)]:
+        if use_sendmmsg and _sendmmsg is None:
+            continue
+        transport = BatchedUDPTransport(address, batch, 0, use_sendmmsg)
+        start = time.time()
+        for _ in xrange(count):
+            transport.send(data)
+        transport.flush()
+        results.append((name, time.time() - start))
+        transport.close()
+
+    receiver.close()
+    for name, took in results:
+        print "{:<20} {:>10.0f} packets/s".format(name, count / took)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    args = args + [200000, 512, BATCH_SIZE][len(args):]
+    bench(*args)
+    bench_headers(args[0])
@@ -0,0 +1,357 @@
+"""
+System reporter plugin: CPU, memory, network interfaces, disks, mountpoints
+and process count, from the psutil or /proc collector.
+
+Options, in [general]: collector, paths, latitude, longitude, province,
+city, store and the discovery patterns (see discovery.py); in [syslog]:
+samplingMs.
+"""
+
+import math
+import operator
+
+from discovery import Discovery
+from meters import counter_delta, monotonic
+from proc_collector import PsutilCollector, busy_percent, create_collector
+from reporter import AReporter, TaskThread
+from sampling import SampleWindow
+from send_queue import QUEUE_SIZE, DROP_OLDEST, REPLAY_RATE
+
+
+"""
+    Sampler reads CPU use and the network/disk rates of one interface and
+    one disk every `interval` seconds (sub-second) into a SampleWindow.
+    The reporter points it at the first discovered interface and disk.
+"""
+class Sampler(TaskThread):
+    FIELDS = ["cpu", "bytes_sent", "bytes_recv", "packets_sent", "packets_recv", "read_bytes", "write_bytes"]
+
+    def __init__(self, collector, network_interface, disk, interval, capacity):
+        super(Sampler, self).__init__(interval)
+        self.daemon = True
+        self.collector = collector
+        self.network_interface = network_interface
+        self.disk = disk
+        self.window = SampleWindow(Sampler.FIELDS, capacity)
+        self.last = None
+
+    def read(self):
+        net = self.collector.net_io_counters().get(self.network_interface)
+        disk = self.collector.disk_io_counters().get(self.disk)
+        return monotonic(), self.collector.cpu_times(), net, disk
+
+    def task(self):
+        current = self.read()
+        last = self.last
+        self.last = current
+        if last is None:
+            return
+        now, times, net, disk = current
+        elapsed = max(now - last[0], 1e-6)
+
+        def rate(new, old, field):
+            if new is None or old is None:
+                return 0.0
+            return round(counter_delta(getattr(new, field), getattr(old, field)) / elapsed, 1)
+
+        self.window.add({
+            "cpu": busy_percent(times, last[1]),
+            "bytes_sent": rate(net, last[2], "bytes_sent"),
+            "bytes_recv": rate(net, last[2], "bytes_recv"),
+            "packets_sent": rate(net, last[2], "packets_sent"),
+            "packets_recv": rate(net, last[2], "packets_recv"),
+            "read_bytes": rate(disk, last[3], "read_bytes"),
+            "write_bytes": rate(disk, last[3], "write_bytes"),
+        })
+
+    def summary(self):
+        summary = self.window.summary()
+        samples = {
+            "interval_ms": int(self.interval * 1000),
+            "count": summary["count"],
+            "cpu": summary["cpu"],
+            "network": dict((field, summary[field]) for field in ["bytes_sent", "bytes_recv", "packets_sent", "packets_recv"]),
+            "io_disk": dict((field, summary[field]) for field in ["read_bytes", "write_bytes"]),
+        }
+        return samples
+
+
+class SystemReporter(AReporter):
+    # a tick with the /proc collector, about twice that with psutil
+    COLLECT_COST = 0.001
+    CPU_TIMES_FIELDS = ["user", "system", "idle", "nice", "irq", "softirq", "iowait", "steal"]
+    MEM_VIRTUAL_FIELDS = ["total", "available", "used", "free", "active", "inactive", "buffers", "cached", "shared"]
+    MEM_SWAP_FIELDS = ["total", "used", "free"]
+    NETWORK_FIELDS = ["bytes_sent", "bytes_recv", "packets_sent", "packets_recv"]
+    IO_DISK_FIELDS = ["read_count", "write_count", "read_bytes", "write_bytes", "read_time", "write_time"]
+    PATH_FIELDS = ["total", "used", "free"]
+    CPU_TIMES = operator.attrgetter(*CPU_TIMES_FIELDS)
+    MEM_VIRTUAL = operator.attrgetter(*MEM_VIRTUAL_FIELDS)
+    MEM_SWAP = operator.attrgetter(*MEM_SWAP_FIELDS)
+    NETWORK = operator.attrgetter(*NETWORK_FIELDS)
+    IO_DISK_COUNTERS = operator.attrgetter(*IO_DISK_FIELDS)
+    PATH = operator.attrgetter(*PATH_FIELDS)
+
+    def __init__(self, syslog_host, syslog_hostname, syslog_port, interval, paths, latitude, longitude, province, city, store, transport=None,
+                 queue_size=QUEUE_SIZE, overflow=DROP_OLDEST, spool=None, replay_rate=REPLAY_RATE, collector=None, sampling=0, discovery=None):
+        super(SystemReporter, self).__init__("monitoring-agent", syslog_host, syslog_hostname, syslog_port, interval, transport,
+                                             queue_size, overflow, spool, replay_rate)
+        # configured paths, the mountpoints are discovered when there is none
+        self.paths = paths
+        self.collector = collector or PsutilCollector()
+        self.discovery = discovery or Discovery()
+
+        # sub-second samples, summarized in every report
+        self.sampler = None
+        if sampling > 0:
+            capacity = int(math.ceil(interval / sampling)) + 1
+            self.sampler = Sampler(self.collector, None, None, sampling, capacity)
+
+        # attributes
+        self.io_data = None
+        self.cpu_percent_data = None
+        self.cpu_times_percent_data = None
+        self.paths_data = None
+        self.path_names = None
+        self.mem_virtual_data = None
+        self.mem_swap_data = None
+        self.io_disk_data = None
+        self.process_data = None
+        self.collected_at = None
+        self.latitude_data = latitude
+        self.longitude_data = longitude
+        self.province_data = province
+        self.city_data = city
+        self.store_data = store
+
+    def start(self):
+        if self.sampler is not None:
+            self.sampler.start()
+        super(SystemReporter, self).start()
+
+    def shutdown(self):
+        if self.sampler is not None:
+            self.sampler.shutdown()
+        super(SystemReporter, self).shutdown()
+
+    def tasks(self):
+        if self.sampler is not None:
+            return [self, self.sampler]
+        return [self]
+
+    def register(self):
+        super(SystemReporter, self).register()
+
+        # meter handles are resolved once here, process() updates whole groups
+        self.cpu_meter = self.meters.simple(float, ["cpu"], ["percent"], [self.cpu_percent_data])
+        self.cpu_times_meter = self.meters.simple(float, ["cpu_times"], SystemReporter.CPU_TIMES_FIELDS,
+                                                  SystemReporter.CPU_TIMES(self.cpu_times_percent_data))
+        self.mem_virtual_meter = self.meters.simple(long, ["virtual"], SystemReporter.MEM_VIRTUAL_FIELDS,
+                                                    SystemReporter.MEM_VIRTUAL(self.mem_virtual_data))
+        self.mem_swap_meter = self.meters.simple(long, ["swap"], SystemReporter.MEM_SWAP_FIELDS,
+                                                 SystemReporter.MEM_SWAP(self.mem_swap_data))
+        self.mem_percent_meter = self.meters.simple(float, ["virtual", "swap"], ["percent"],
+                                                    [self.mem_virtual_data.percent, self.mem_swap_data.percent])
+
+        self.network_interfaces = self.discovery.interfaces.select(self.io_data)
+        self.network_meter = self.meters.delta(self.network_interfaces, SystemReporter.NETWORK_FIELDS,
+                                               self.network_values(self.io_data), self.collected_at)
+
+        self.disks = self.discovery.disks.select(self.io_disk_data)
+        self.disk_meter = self.meters.delta(self.disks, SystemReporter.IO_DISK_FIELDS,
+                                            self.disk_values(self.io_disk_data), self.collected_at)
+
+        self.path_names = [path["name"] for path, _ in self.paths_data]
+        self.path_meter = self.meters.simple(long, self.path_names, SystemReporter.PATH_FIELDS, self.path_values())
+        self.path_percent_meter = self.meters.simple(float, self.path_names, ["percent"],
+                                                     [usage.percent for _, usage in self.paths_data])
+        self.point_sampler()
+
+        self.process_meter = self.meters.simple(int, ["process"], ["total"], [self.process_data])
+
+    @staticmethod
+    def rate_row(meter, deltas, name):
+        "The per-second rates of `name`, as <field>_per_sec keys."
+        offset = meter.offsets[name]
+        rates = meter.rates(deltas[offset:offset + meter.width])
+        return dict((field + "_per_sec", rate) for field, rate in zip(meter.fields, rates))
+
+    def network_values(self, io_data):
+        getter = SystemReporter.NETWORK
+        return [v for ni in self.network_interfaces for v in getter(io_data[ni])]
+
+    def disk_values(self, io_disk_data):
+        getter = SystemReporter.IO_DISK_COUNTERS
+        return [v for disk in self.disks for v in getter(io_disk_data[disk])]
+
+    def path_values(self):
+        getter = SystemReporter.PATH
+        return [v for _, usage in self.paths_data for v in getter(usage)]
+
+    def point_sampler(self):
+        if self.sampler is not None:
+            self.sampler.network_interface = self.network_interfaces[0] if self.network_interfaces else None
+            self.sampler.disk = self.disks[0] if self.disks else None
+
+    def rediscover(self):
+        """
+        Follow the devices that appeared or disappeared since the previous
+        tick: only the meter groups of a changed selection are rebuilt.
+        """
+        interfaces = self.discovery.interfaces.select(self.io_data)
+        if interfaces is not self.network_interfaces:
+            self.network_interfaces = interfaces
+            self.network_meter = self.meters.regroup(self.network_meter, interfaces,
+                                                     self.network_values(self.io_data), self.collected_at)
+        disks = self.discovery.disks.select(self.io_disk_data)
+        if disks is not self.disks:
+            self.disks = disks
+            self.disk_meter = self.meters.regroup(self.disk_meter, disks,
+                                                  self.disk_values(self.io_disk_data), self.collected_at)
+        path_names = [path["name"] for path, _ in self.paths_data]
+        if path_names != self.path_names:
+            self.path_names = path_names
+            self.path_meter = self.meters.regroup(self.path_meter, path_names, self.path_values())
+            self.path_percent_meter = self.meters.regroup(self.path_percent_meter, path_names,
+                                                          [usage.percent for _, usage in self.paths_data])
+        self.point_sampler()
+
+    def current_paths(self):
+        if self.paths:
+            return self.paths
+        return self.discovery.mountpoints.select(self.collector.disk_partitions())
+
+    def disk_usages(self):
+        "(path, usage) of the reported paths, skipping the ones that cannot be read (unmounted, stale NFS...)."
+        usages = []
+        for path in self.current_paths():
+            try:
+                usages.append((path, self.collector.disk_usage(path["path"])))
+            except OSError:
+                pass
+        return usages
+
+    def collect(self):
+        super(SystemReporter, self).collect()
+        # counter rates are computed over the time between two reads, even when a tick runs late
+        self.collected_at = monotonic()
+        self.io_data = self.collector.net_io_counters()
+        self.cpu_percent_data, self.cpu_times_percent_data = self.collector.cpu()
+        self.mem_virtual_data, self.mem_swap_data = self.collector.memory()
+        self.paths_data = self.disk_usages()
+        self.io_disk_data = self.collector.disk_io_counters()
+        self.process_data = self.collector.process_count()
+
+    def process(self):
+        self.rediscover()
+
+        cpu_data = self.cpu_meter.update([self.cpu_percent_data])[0]
+        cpu_times_data = self.cpu_times_meter.row(
+            self.cpu_times_meter.update(SystemReporter.CPU_TIMES(self.cpu_times_percent_data)), "cpu_times")
+
+        mem_percent = self.mem_percent_meter.update([self.mem_virtual_data.percent, self.mem_swap_data.percent])
+        mem_virtual = self.mem_virtual_meter.row(
+            self.mem_virtual_meter.update(SystemReporter.MEM_VIRTUAL(self.mem_virtual_data)), "virtual")
+        mem_virtual["percent"] = mem_percent[0]
+        mem_swap = self.mem_swap_meter.row(
+            self.mem_swap_meter.update(SystemReporter.MEM_SWAP(self.mem_swap_data)), "swap")
+        mem_swap["percent"] = mem_percent[1]
+        mem_data = {
+            "virtual": mem_virtual,
+            "swap": mem_swap,
+        }
+
+        network_data = []
+        network_deltas = self.network_meter.update(self.network_values(self.io_data), self.collected_at)
+        for ni in self.network_interfaces:
+            ndata = self.network_meter.row(network_deltas, ni)
+            ndata.update(self.rate_row(self.network_meter, network_deltas, ni))
+            ndata["name"] = ni
+            network_data.append(ndata)
+
+        paths = []
+        path_values = self.path_meter.update(self.path_values())
+        path_percents = self.path_percent_meter.update([usage.percent for _, usage in self.paths_data])
+        for idx, (current_path, _) in enumerate(self.paths_data):
+            path_data = self.path_meter.row(path_values, current_path["name"])
+            path_data["name"] = current_path["name"]
+            path_data["path"] = current_path["path"]
+            path_data["percent"] = path_percents[idx]
+            paths.append(path_data)
+
+        io_disks = []
+        disk_deltas = self.disk_meter.update(self.disk_values(self.io_disk_data), self.collected_at)
+        for disk in self.disks:
+            io_disk = self.disk_meter.row(disk_deltas, disk)
+            io_disk.update(self.rate_row(self.disk_meter, disk_deltas, disk))
+            io_disk["disk_id"] = disk
+            io_disks.append(io_disk)
+
+        process_total = self.process_meter.update([self.process_data])[0]
+
+        latitude = self.latitude_data
+        longitude = self.longitude_data
+
+        province = self.province_data
+        city = self.city_data
+        store = self.store_data
+
+        location = "{},{}".format(latitude, longitude)
+
+        messages = []
+        messages.append({
+            "cpu": cpu_data,
+            "cpu_times": cpu_times_data,
+            "mem": mem_data,
+            "disks": paths,
+            "io_disks": io_disks,
+            "networks": network_data,
+            "processes": process_total,
+            "location": location,
+            "province": province,
+            "city": city,
+            "store": store
+        })
+        # the single-device keys of the first reports, for the existing dashboards
+        for idx, path_data in enumerate(reversed(paths[-3:])):
+            messages[0]["disk{}".format(idx)] = path_data
+        if io_disks:
+            messages[0]["io_disk"] = io_disks[0]
+        if network_data:
+            messages[0]["network"] = network_data[0]
+        if self.sampler is not None:
+            messages[0]["samples"] = self.sampler.summary()
+
+        return messages
+
+
+def create_reporter(context):
+    config = context.config
+    # psutil, or proc to read /proc directly (Linux only)
+    collector = "psutil"
+    if config.has_option("general", "collector"):
+        collector = config.get('general', 'collector')
+
+    # high-frequency mode: CPU/network/disk sampled every samplingMs (e.g. 100 to 1000), 0 is off
+    sampling = 0
+    if config.has_option("syslog", "samplingMs"):
+        sampling = config.getint('syslog', 'samplingMs') / 1000.0
+
+    paths = []
+    if config.has_option("general", "paths"):
+        for p in config.get('general', 'paths').split(","):
+            parts = p.split(":")
+            name = parts[0]
+            path = parts[1]
+            paths.append({"name": name, "path": path})
+
+    # interfaces, excludeInterfaces, disks, excludeDisks, mountpoints, excludeMountpoints: comma-separated
+    # globs, or regexes prefixed with "re:" (e.g. "eth*,re:^en"); mountpoints are only discovered without paths
+    discovery = Discovery.from_config(config)
+    spool = context.take_spool()
+
+    return SystemReporter(context.syslog_host, context.syslog_hostname, context.syslog_port, context.interval_for("system"), paths,
+                          config.get('general', 'latitude'), config.get('general', 'longitude'), config.get('general', 'province'),
+                          config.get('general', 'city'), config.get('general', 'store'), context.transport(),
+                          context.queue_size, context.overflow_for(spool), spool, context.replay_rate,
+                          create_collector(collector), sampling, discovery)